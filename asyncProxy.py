@@ -0,0 +1,510 @@
+'''
+sProxy on one asyncio event loop.
+
+    px = asyncProxy.AsyncSProxy('xbee:/dev/ttyUSB0:38400:8N1:True',
+                                'tcpclient:amm042:1883')
+    px.run()
+
+takes the same urls as sProxy.Link. tcpserver, tcpclient and serial links
+are served by the loop: a coroutine per tcp connection instead of a
+thread, and the serial port is read when the loop says it has data
+instead of by a select loop of its own.
+
+an xbee link is an xbeeAsync.AsyncXbeeServer: the radio is read, and
+the messages to it scheduled and sent, by the loop too. only an
+mqttEdge.Edge in front of it (pingresp=true or a journal) keeps a thread,
+for its keepalives and retries. with a journal, what goes through the
+Edge does so on a thread of its own each way, see AsyncLink._use_edge,
+and the clients aren't read while the journal is full.
+
+every link's write may be called from any thread.
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+import traceback
+
+import serial
+
+import sProxy
+import xbeeAsync
+
+class AsyncTCPServer():
+    'like sProxy.LinkedThreadingTCPServer'
+    def __init__(self, server_address, link, loop):
+        self.LOG = logging.getLogger(__name__)
+        self.server_address = server_address
+        self.link = link
+        self.loop = loop
+        self.clients = []
+        # one per connection
+        self._handlers = set()
+        self._server = None
+
+    async def start(self):
+        host, port = self.server_address
+        self._server = await asyncio.start_server(self._handle, host, port, reuse_address=True)
+
+    def is_alive(self):
+        return self._server != None and self._server.is_serving()
+
+    async def _handle(self, reader, writer):
+        'a tcp connection until it is closed by the remote'
+        address = writer.get_extra_info('peername')[0]
+        self.clients.append(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    data = await reader.read(1024)
+                except ConnectionError:
+                    data = b''
+                if len(data) == 0:
+                    self.LOG.debug("client at {} disconnect".format(address))
+                    break
+                self.LOG.debug("got [{}] bytes from {}: {}".format(len(data), address, data))
+                self.link.proxy(data)
+                await self.link.drain()
+        finally:
+            if writer in self.clients:
+                self.clients.remove(writer)
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data):
+        if len(self.clients) == 0:
+            self.LOG.warn("tx [{}] bytes FAILS WITHOUT CLIENT: {}".format(len(data), data))
+            return
+        for c in list(self.clients):
+            if c.is_closing():
+                self.LOG.debug("remove tcp client {}".format(c.get_extra_info('peername')))
+                self.clients.remove(c)
+                continue
+            self.LOG.debug("tx [{}] bytes to {}: {}".format(len(data), c.get_extra_info('peername')[0], data))
+            c.write(data)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        if self._server != None:
+            self._server.close()
+        for c in self.clients:
+            c.close()
+        self.clients = []
+
+    async def wait_closed(self):
+        'wait for the connections to close after shutdown'
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+class AsyncTCPClient():
+    '''like sProxy.ProxyTCPClient, connects on the first write and again
+       on the first one after the server closed the connection'''
+    def __init__(self, server_address, link, loop):
+        self.LOG = logging.getLogger(__name__)
+        self.server_address = server_address
+        self.link = link
+        self.loop = loop
+        self._writer = None
+        self._task = None
+        # writes waiting for the connection
+        self._out = []
+        self._shut_down = False
+
+        self.LOG.info("TCPClient Link to {}".format(server_address))
+
+    async def start(self):
+        pass
+
+    def is_alive(self):
+        return not self._shut_down
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data):
+        if self._shut_down:
+            return
+        self.LOG.debug("tx [{}] bytes to {}: {}".format(len(data), self.server_address, data))
+        if self._writer != None:
+            self._writer.write(data)
+            return
+        self._out.append(data)
+        if self._task == None:
+            self._task = self.loop.create_task(self._serve())
+
+    async def _serve(self):
+        'connect, send what waits for the connection and read until it is closed'
+        try:
+            self.LOG.info("Connecting to {}.".format(self.server_address))
+            try:
+                reader, writer = await asyncio.open_connection(*self.server_address)
+            except OSError as x:
+                # like a failed connect in sProxy, the proxy stops
+                self.LOG.critical("Connecting to {} failed with: {}".format(self.server_address, x))
+                self._out = []
+                self._shut_down = True
+                return
+            self._writer = writer
+            for data in self._out:
+                writer.write(data)
+            self._out = []
+            while True:
+                try:
+                    data = await reader.read(1024)
+                except ConnectionError:
+                    data = b''
+                if len(data) == 0:
+                    self.LOG.info("Server {} closed connection.".format(self.server_address))
+                    break
+                self.LOG.debug("rx [{}] bytes from {}: {}".format(len(data), self.server_address, data))
+                self.link.proxy(data)
+        finally:
+            if self._writer != None:
+                self._writer.close()
+            self._writer = None
+            self._task = None
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self._shut_down = True
+        if self._task != None:
+            self._task.cancel()
+
+    async def wait_closed(self):
+        if self._task != None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+class AsyncSerialServer():
+    'like sProxy.LinkedProxySerialServer'
+    def __init__(self, server_address, link, loop):
+        self.LOG = logging.getLogger(__name__)
+        port, baudrate, bytesize, parity, stopbits = server_address
+        # reads never block, they only happen when the loop says there is data
+        self.serial = serial.Serial(port, baudrate, bytesize, parity, stopbits, timeout = 0)
+        self.link = link
+        self.loop = loop
+        self.loop.add_reader(self.serial.fileno(), self._readable)
+        self.LOG.debug("created.")
+
+    async def start(self):
+        pass
+
+    def is_alive(self):
+        return self.serial != None
+
+    def _readable(self):
+        try:
+            data = self.serial.read(max(1, self.serial.in_waiting))
+        except (serial.SerialException, OSError) as x:
+            self.LOG.critical("{} failed with: {}".format(self.serial.portstr, x))
+            self._close()
+            return
+        if len(data) == 0:
+            return
+        self.LOG.debug("rx [{}] bytes from {}: {}".format(len(data), self.serial.portstr, data))
+        self.link.proxy(data)
+        if self.link.draining():
+            # nothing more is read until the remote took it
+            self.loop.remove_reader(self.serial.fileno())
+            self.loop.create_task(self._resume())
+
+    async def _resume(self):
+        await self.link.drain()
+        if self.serial != None:
+            self.loop.add_reader(self.serial.fileno(), self._readable)
+
+    def write(self, data):
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _write(self, data):
+        if self.serial == None:
+            return
+        self.LOG.debug("tx [{}] bytes to {}: {}".format(len(data), self.serial.portstr, data))
+        self.serial.write(data)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        if self.serial != None:
+            self.loop.remove_reader(self.serial.fileno())
+            self.serial.close()
+        self.serial = None
+
+    async def wait_closed(self):
+        pass
+
+class AsyncLink():
+    'sProxy.Link on an event loop, see sProxy.Link for the urls'
+    def __init__(self, url, loop):
+        self.url = url
+        self.loop = loop
+        self.remote = None
+        self.sessions = False
+        self.edge = None
+        self.link = None
+        self.name = "Link"
+        self.LOG = logging.getLogger(__name__)
+        # what goes up and down through a journaled edge, and the last write
+        self._up = None
+        self._down = None
+        self._written = None
+
+    async def start(self):
+        args = self.url.split(":")
+        if args[0] == 'tcpserver':
+            self.link = AsyncTCPServer((args[1], int(args[2])), self, self.loop)
+            self.name = "LinkTCP server on {}:{}".format(args[1], args[2])
+        elif args[0] == 'tcpclient':
+            self.link = AsyncTCPClient((args[1], int(args[2])), self, self.loop)
+            self.name = "LinkTCP client on {}:{}".format(args[1], args[2])
+        elif args[0] == 'serial':
+            self.link = AsyncSerialServer((args[1], int(args[2]), int(args[3][0]), args[3][1], int(args[3][2])),
+                                          self, self.loop)
+            self.name = "LinkSerial server on {}".format(self.link.serial.portstr)
+        elif args[0] == 'xbee':
+            self.link, self.sessions, edge = sProxy.xbee_server(args, self, xbeeAsync.AsyncXbeeServer)
+            self._use_edge(edge)
+        else:
+            raise NotImplementedError("url format not supported")
+        try:
+            await self.link.start()
+        except Exception as x:
+            if self.edge != None:
+                self.edge.shutdown()
+            raise x
+        if args[0] == 'xbee':
+            self.name = "XBee server on rf address {:x} [base={}]".format(self.link.address,
+                                                                         self.link._basestation)
+        self.LOG.info("Started {}".format(self.name))
+        return self
+
+    def _use_edge(self, edge):
+        '''put edge in front of our link. with a journal, writes to it and
+           what it proxies each go through a thread of their own: a write 
+           may wait for room in the journal that only the broker's acks 
+           coming the other way free, and both sync the journal to disk.'''
+        self.edge = edge
+        if edge != None and edge.journal != None:
+            self._up = concurrent.futures.ThreadPoolExecutor(1)
+            self._down = concurrent.futures.ThreadPoolExecutor(1)
+
+    def is_alive(self):
+        return self.link.is_alive()
+
+    def bind(self, other):
+        '''bind this link to another link,
+           data received on this link will be written to the other'''
+        self.remote = other
+        if self.sessions and isinstance(other.link, AsyncTCPClient):
+            # every remote node gets its own connection to the server
+            self.link.upstream = lambda addr, session: AsyncTCPClient(other.link.server_address, session,
+                                                                      self.loop)
+
+    def proxy(self, data):
+        if self._down != None:
+            try:
+                self._down.submit(self._edge_proxy, data)
+            except RuntimeError:
+                # shut down
+                pass
+        elif self.edge != None:
+            self.edge.proxy(data)
+        else:
+            self._proxy(data)
+
+    def _edge_proxy(self, data):
+        try:
+            self.edge.proxy(data)
+        except Exception as x:
+            self.LOG.critical("{} edge failed with: {}".format(self.name, x))
+            self.LOG.critical(traceback.format_exc())
+
+    def _proxy(self, data):
+        if self.remote:
+            try:
+                self.remote.write(data)
+            except Exception as x:
+                self.LOG.critical("Remote link failed with: {}".format(x))
+                self.LOG.critical(traceback.format_exc())
+                self.shutdown()
+        else:
+            self.LOG.error("cannot proxy data without remote.")
+
+    def write(self, data):
+        'write data to our link'
+        if self._up != None:
+            try:
+                self._written = self._up.submit(self._write, data)
+            except RuntimeError:
+                # shut down
+                pass
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        try:
+            if self.edge != None:
+                self.edge.write(data)
+            else:
+                self.link.write(data)
+        except Exception as x:
+            self.LOG.critical("{} failed with: {}".format(self.name, x))
+            self.LOG.critical(traceback.format_exc())
+            self.shutdown()
+
+    def draining(self):
+        'True while the remote hasn\'t taken everything proxied to it'
+        return self.remote != None and self.remote._written != None and not self.remote._written.done()
+
+    async def drain(self):
+        'wait until the remote took everything proxied to it'
+        if self.draining():
+            await asyncio.wrap_future(self.remote._written)
+
+    def shutdown(self):
+        self.LOG.warn("Shutdown for {}".format(self.name))
+        for e in (self._up, self._down):
+            if e != None:
+                # a write may wait for the journal for good
+                e.shutdown(wait=False)
+        if self.edge != None:
+            self.edge.shutdown()
+        self.link.shutdown()
+
+    async def wait_closed(self):
+        await self.link.wait_closed()
+
+class AsyncSProxy():
+    def __init__(self, local_url, remote_url):
+        '''proxy data between a local and remote port, like sProxy.SProxy,
+           on an event loop of its own that run() runs'''
+        self.LOG = logging.getLogger(__name__)
+        self.LOG.info("Creating AsyncSProxy {} <--> {}".format(local_url, remote_url))
+        self.local_url = local_url
+        self.remote_url = remote_url
+        self.local = None
+        self.remote = None
+
+    async def start(self, loop = None):
+        'open both links and bind them together'
+        if loop == None:
+            loop = asyncio.get_event_loop()
+        try:
+            self.local = await AsyncLink(self.local_url, loop).start()
+        except Exception as x:
+            self.LOG.error("Failed to create local link {}, shutting down.".format(self.local_url))
+            raise x
+        try:
+            self.remote = await AsyncLink(self.remote_url, loop).start()
+        except Exception as x:
+            self.LOG.error("Failed to create remote link {}, shutting down.".format(self.remote_url))
+            self.local.shutdown()
+            raise x
+        self.local.bind(self.remote)
+        self.remote.bind(self.local)
+
+    async def serve(self, timeout = None):
+        'proxy until timeout seconds pass or either link stops'
+        await self.start()
+        self.LOG.info("Proxy server is running.")
+        try:
+            if timeout != None:
+                await asyncio.sleep(timeout)
+            else:
+                while self.local.is_alive() and self.remote.is_alive():
+                    await asyncio.sleep(1)
+        finally:
+            self.local.shutdown()
+            self.remote.shutdown()
+            # the shutdowns above are only scheduled
+            await asyncio.sleep(0)
+            await self.local.wait_closed()
+            await self.remote.wait_closed()
+
+    def run(self, timeout = None):
+        asyncio.run(self.serve(timeout))
+
+if __name__=="__main__":
+    #test
+    import os
+    import shutil
+    import struct
+    import tempfile
+    import time
+    
+    import journal
+    import mqttCodec
+    import mqttEdge
+    
+    # a broker that acks QoS 1 PUBLISHes one at a time, slowly
+    published = []
+    async def broker(reader, writer):
+        split = mqttCodec.Splitter()
+        while True:
+            data = await reader.read(1024)
+            if len(data) == 0:
+                break
+            for whole, p in split.split(data):
+                if p[0] == mqttEdge.CONNECT:
+                    writer.write(b'\x20\x02\x00\x00')
+                elif p[0] >> 4 == mqttCodec.PUBLISH:
+                    published.append(p)
+                    await asyncio.sleep(0.02)
+                    writer.write(mqttEdge.ack(mqttEdge.PUBACK, mqttEdge.packet_id(p)))
+        writer.close()
+    
+    def publish(pid, payload):
+        body = struct.pack(">H", 3) + b'a/b' + struct.pack(">H", pid) + payload
+        return bytes([0x32, len(body)]) + body
+    
+    async def check():
+        d = tempfile.mkdtemp()
+        b = await asyncio.start_server(broker, '127.0.0.1', 0)
+        px = AsyncSProxy('tcpserver:127.0.0.1:0', 'tcpclient:127.0.0.1:{}'.format(b.sockets[0].getsockname()[1]))
+        await px.start()
+        # what an xbee link with journal= has in front of it, with little room
+        j = journal.Journal(os.path.join(d, 'journal'), max_size = 256)
+        px.remote._use_edge(mqttEdge.Edge(px.remote.link.write, px.remote._proxy, lambda seconds: True,
+                                          pingresp = False, journal = j))
+        
+        # how long the loop takes to come back to a coroutine
+        gaps = [0]
+        async def tick():
+            while True:
+                t = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - t)
+        ticker = asyncio.get_event_loop().create_task(tick())
+        
+        reader, writer = await asyncio.open_connection(*px.local.link._server.sockets[0].getsockname())
+        writer.write(b'\x10\x0c\x00\x04MQTT\x04\x02\x00\x3c\x00\x00')
+        assert await reader.readexactly(4) == b'\x20\x02\x00\x00'
+        # ten times what the journal holds, it fills and the client waits
+        n = 40
+        writer.write(b''.join(publish(i, bytes(60)) for i in range(1, n + 1)))
+        acks = await asyncio.wait_for(reader.readexactly(4 * n), 20)
+        assert acks == b''.join(mqttEdge.ack(mqttEdge.PUBACK, i) for i in range(1, n + 1))
+        while len(published) < n or j.stats()['pending'] > 0:
+            await asyncio.sleep(0.01)
+        assert sorted(p[-60:] for p in published) == [bytes(60)] * n
+        assert max(gaps) < 0.5, max(gaps)
+        
+        ticker.cancel()
+        writer.close()
+        for link in (px.local, px.remote):
+            link.shutdown()
+        await asyncio.sleep(0)
+        for link in (px.local, px.remote):
+            await link.wait_closed()
+        b.close()
+        shutil.rmtree(d)
+    
+    asyncio.run(check())
@@ -0,0 +1,284 @@
+'''
+streaming compression for links that carry many small, similar messages.
+
+zlib.compress on each message starts from an empty window every time, so
+short MQTT packets often come out larger than they went in. a Compressor
+keeps one deflate stream open for the life of the link and ends every
+message with Z_SYNC_FLUSH, so each message is still decoded on its own
+by the matching Decompressor but can refer back to earlier ones (same
+topics, same client ids).
+
+every message is framed as
+
+    MAGIC, flags, deflate data (without the 00 00 ff ff sync tail)
+
+where flags holds a 6 bit sequence number, RESET, set when the
+Compressor started a new stream, and BATCH, set when the message is 
+several messages sent together by compress_batch, each prefixed with 
+its varint length. MAGIC can't be the first byte of a
+zlib.compress result (0x78), so receivers can tell the two apart.
+
+the deflate data is raw (no zlib header). RESET messages carry the id 
+of the preset dictionary (zdict) the new stream starts from before the 
+deflate data, 0 for none. the id is the adler32 of the dictionary like 
+zlib's own DICTID, so both ends must load the same file. zdictTrain.py 
+builds one from recorded traffic.
+
+a link may carry several streams that are independent of each other,
+so the messages of one can overtake those of another. the channel a 
+Compressor is made with picks its MAGIC from MAGICS, and receivers keep
+a Decompressor for each.
+
+a Decompressor that sees a sequence gap (a lost or CRC-failed message)
+or a deflate error raises ResyncError and drops everything up to the
+next RESET message. the receiver should ask the sender to reset() its
+Compressor when that happens.
+
+the sequence number is only 6 bits, so a gap of exactly a multiple of 
+64 messages looks like no gap. the sender resets its stream after any 
+message it failed to send, and a CRC failure makes the receiver drop 
+the stream (lost()), so that takes 64 or more messages in a row lost 
+without either end noticing (all fragments of each lost after the radio
+acked them). what comes after such a gap refers to data the 
+Decompressor never had: a reference further back than its window is a 
+deflate error, and so a ResyncError, but one that lands inside it 
+decodes to the wrong bytes, which only the layer above (MQTT framing, 
+say) can catch.
+'''
+
+import zlib
+import struct
+
+from fragmentation16 import varint, read_varint
+
+MAGIC = 0x1b
+# MAGIC of each channel
+MAGICS = (MAGIC, 0x1d)
+RESET = 0x80
+BATCH = 0x40
+SEQ_MASK = 0x3f
+
+# every Z_SYNC_FLUSH ends with an empty stored block, no need to send it
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+# leads the deflate data of RESET messages
+DICT_ID = struct.Struct(">L")
+
+# raw deflate, the frame replaces the zlib header
+WBITS = -15
+
+class ResyncError(Exception): pass
+class DictionaryError(Exception): pass
+
+def dict_id(zdict):
+    'the id sent for a preset dictionary, 0 for None'
+    if zdict == None:
+        return 0
+    return zlib.adler32(zdict)
+
+def load_zdict(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def is_stream(data):
+    'True if data was framed by a Compressor'
+    return len(data) >= 2 and data[0] in MAGICS
+
+def channel(data):
+    'the channel of the stream data is from'
+    return MAGICS.index(data[0])
+
+class Compressor():
+    'one direction of a streaming deflate context'
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, zdict=None, channel=0):
+        self.level = level
+        self._magic = MAGICS[channel]
+        self.zdict = zdict
+        self.dict_id = dict_id(zdict)
+        self._c = None
+        self._seq = 0
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.resets = 0
+
+    def reset(self):
+        'start a new stream with the next message'
+        self._c = None
+
+    def compress(self, data, flags=0):
+        flags |= self._seq
+        header = b''
+        if self._c == None:
+            if self.zdict == None:
+                self._c = zlib.compressobj(self.level, zlib.DEFLATED, WBITS)
+            else:
+                self._c = zlib.compressobj(self.level, zlib.DEFLATED, WBITS, zdict=self.zdict)
+            flags |= RESET
+            header = DICT_ID.pack(self.dict_id)
+            self.resets += 1
+        r = self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+        if r.endswith(SYNC_TAIL):
+            r = r[:-len(SYNC_TAIL)]
+        r = bytes([self._magic, flags]) + header + r
+
+        self._seq = (self._seq + 1) & SEQ_MASK
+        self.bytes_in += len(data)
+        self.bytes_out += len(r)
+        self.messages += 1
+        return r
+
+    def compress_batch(self, messages):
+        'messages as one, the far side gets them back with decompress_batch'
+        if len(messages) == 1:
+            return self.compress(messages[0])
+        return self.compress(b''.join(varint(len(m)) + m for m in messages), BATCH)
+    
+    def ratio(self):
+        'compressed / uncompressed bytes so far'
+        if self.bytes_in == 0:
+            return 1.0
+        return self.bytes_out / float(self.bytes_in)
+
+    def stats(self):
+        return {'messages': self.messages,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.ratio(),
+                'resets': self.resets}
+
+class Decompressor():
+    '''the receiving side of a Compressor. zdict is the preset dictionary
+       this end has loaded, streams may start from it or from none.'''
+    def __init__(self, zdict=None):
+        self.zdict = zdict
+        self.dict_id = dict_id(zdict)
+        self._d = None
+        self._expect = 0
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages = 0
+        self.dropped = 0
+        self.resyncs = 0
+
+    def decompress(self, data):
+        '''the message framed in data, raises ResyncError if it can't be
+           decoded until the sender resets its stream, or DictionaryError 
+           if the stream starts from a dictionary that isn't loaded here'''
+        flags = data[1]
+        seq = flags & SEQ_MASK
+        at = 2
+        if flags & RESET:
+            zid = DICT_ID.unpack_from(data, at)[0]
+            at += DICT_ID.size
+            self._d = None
+            if zid == 0:
+                d = zlib.decompressobj(WBITS)
+            elif zid == self.dict_id:
+                d = zlib.decompressobj(WBITS, zdict=self.zdict)
+            else:
+                self.dropped += 1
+                raise DictionaryError("stream uses dictionary {:08x}, have {:08x}".format(zid, self.dict_id))
+            if self.messages > 0:
+                self.resyncs += 1
+            self._d = d
+        elif self._d == None or seq != self._expect:
+            self._d = None
+            self.dropped += 1
+            raise ResyncError("expected message {} got {}".format(self._expect, seq))
+        try:
+            r = self._d.decompress(bytes(data[at:]) + SYNC_TAIL)
+        except zlib.error as x:
+            self._d = None
+            self.dropped += 1
+            raise ResyncError(str(x))
+
+        self._expect = (seq + 1) & SEQ_MASK
+        self.bytes_in += len(data)
+        self.bytes_out += len(r)
+        self.messages += 1
+        return r
+
+    def decompress_batch(self, data):
+        'the list of messages in data, see decompress'
+        r = self.decompress(data)
+        if data[1] & BATCH == 0:
+            return [r]
+        messages = []
+        at = 0
+        while at < len(r):
+            n, at = read_varint(r, at)
+            messages.append(r[at:at+n])
+            at += n
+        return messages
+    
+    def lost(self):
+        'a message from the sender was lost, drop until the next reset'
+        self._d = None
+
+    def ratio(self):
+        'compressed / uncompressed bytes so far'
+        if self.bytes_out == 0:
+            return 1.0
+        return self.bytes_in / float(self.bytes_out)
+
+    def stats(self):
+        return {'messages': self.messages,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.ratio(),
+                'dropped': self.dropped,
+                'resyncs': self.resyncs}
+
+if __name__=="__main__":
+    #test
+    
+    messages = [b'\x30\x12\x00\x0bsensors/%d/t' % (i % 10) + b'21.%d' % i for i in range(100)]
+    c = Compressor()
+    d = Decompressor()
+    for m in messages:
+        assert d.decompress(c.compress(m)) == m
+    assert c.ratio() < 0.5, c.stats()
+    
+    # coalesced messages come back apart
+    assert d.decompress_batch(c.compress_batch(messages[:3])) == messages[:3]
+    assert d.decompress_batch(c.compress_batch(messages[:1])) == messages[:1]
+    
+    # a lost message is a gap, nothing decodes until the sender resets
+    c.compress(messages[0])
+    for m in messages[1:3]:
+        try:
+            d.decompress(c.compress(m))
+            assert False, "gap not seen"
+        except ResyncError:
+            pass
+    c.reset()
+    assert d.decompress(c.compress(messages[3])) == messages[3]
+    assert d.resyncs == 1 and d.dropped == 2, d.stats()
+    
+    # so after a CRC failure
+    d.lost()
+    try:
+        d.decompress(c.compress(messages[4]))
+        assert False, "lost stream decoded"
+    except ResyncError:
+        pass
+    c.reset()
+    assert d.decompress(c.compress(messages[5])) == messages[5]
+    
+    # streams from a preset dictionary, which both ends need
+    zdict = b''.join(messages)
+    c = Compressor(zdict=zdict, channel=1)
+    r = c.compress(messages[0])
+    assert is_stream(r) and channel(r) == 1
+    assert Decompressor(zdict).decompress(r) == messages[0]
+    try:
+        Decompressor().decompress(r)
+        assert False, "dictionary not checked"
+    except DictionaryError:
+        pass
+    
+    # zlib.compress output isn't mistaken for a stream
+    assert not is_stream(zlib.compress(messages[0]))
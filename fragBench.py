@@ -0,0 +1,228 @@
+'''
+fragmentation benchmarks.
+
+times make_frags, encode, decode and receive_frag of fragmentation and
+fragmentation16 for payloads from 10 B to 1 MB and thresholds of 92, 100
+and 256, reporting fragments/s, MB/s and allocations per message.
+
+    python3 fragBench.py -o bench.json
+    python3 fragBench.py --compare bench.json
+
+--compare exits with status 1 if any case got slower than --tolerance
+times the saved result. --check times reassembly as the message grows
+and exits with status 1 if the cost per fragment is not flat.
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+import struct
+import tracemalloc
+import platform
+import datetime
+
+import fragmentation
+import fragmentation16
+from xTP import xTP, DATA_HEADER
+
+SIZES = [10, 100, 1024, 10*1024, 100*1024, 1024*1024]
+THRESHOLDS = [92, 100, 256]
+MODULES = {'fragmentation': fragmentation, 'fragmentation16': fragmentation16}
+
+# fragmentation can't carry more than 16 fragments
+MAX_FRAGS = {'fragmentation': 16, 'fragmentation16': 0x10000}
+
+def split(data, threshold):
+    return [data[at:at+threshold] for at in range(0, len(data), threshold)]
+
+def setup(mod, data, threshold):
+    'returns (payloads, frames, last fragment number, crc) for data'
+    payloads = split(data, threshold)
+    frames = list(mod.make_frags(data, threshold=threshold))
+    crc = mod.decode(frames[0])[3]
+    if mod == fragmentation:
+        crc = struct.pack(">L", crc)
+    return payloads, frames, len(payloads) - 1, crc
+
+# each op returns the function to time, which returns what the codec
+# produced so allocations can be counted while it is still alive
+
+def op_make_frags(mod, data, threshold):
+    def run():
+        return list(mod.make_frags(data, threshold=threshold))
+    return run
+
+def op_encode(mod, data, threshold):
+    payloads, frames, total, crc = setup(mod, data, threshold)
+    encode = mod.encode
+    def run():
+        return [encode(i, total, crc, p) for i, p in enumerate(payloads)]
+    return run
+
+def op_decode(mod, data, threshold):
+    payloads, frames, total, crc = setup(mod, data, threshold)
+    decode = mod.decode
+    def run():
+        return [decode(f) for f in frames]
+    return run
+
+def op_receive_frag(mod, data, threshold):
+    payloads, frames, total, crc = setup(mod, data, threshold)
+    def run():
+        r = mod.Reassembler(max_bytes=2*len(data))
+        return [r.receive_frag(f, 1) for f in frames]
+    return run
+
+OPS = {'make_frags': op_make_frags,
+       'encode': op_encode,
+       'decode': op_decode,
+       'receive_frag': op_receive_frag}
+
+def allocations(run):
+    '''peak bytes allocated while handling one message, and the number of
+       blocks allocated by the codec modules for it'''
+    codec = [tracemalloc.Filter(True, m.__file__) for m in MODULES.values()]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(codec)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        out = run()
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot().filter_traces(codec)
+        del out
+    finally:
+        tracemalloc.stop()
+    blocks = sum(s.count_diff for s in after.compare_to(before, 'filename') if s.count_diff > 0)
+    return peak - base, blocks
+
+def bench(modname, opname, size, threshold, min_time):
+    mod = MODULES[modname]
+    nfrags = max(1, -(-size // threshold))
+    result = {'module': modname, 'op': opname, 'size': size, 'threshold': threshold,
+              'frags': nfrags}
+    if nfrags > MAX_FRAGS[modname]:
+        result['skipped'] = "too many fragments for this format"
+        return result
+
+    data = os.urandom(size)
+    run = OPS[opname](mod, data, threshold)
+
+    timer = timeit.Timer(run)
+    number, t = timer.autorange()
+    while t < min_time:
+        number *= 2
+        t = timer.timeit(number)
+    per_msg = t / number
+
+    peak, blocks = allocations(run)
+    result.update({'us_per_msg': per_msg * 1e6,
+                   'frags_per_s': nfrags / per_msg,
+                   'mb_per_s': size / per_msg / 1e6,
+                   'alloc_bytes_per_msg': peak,
+                   'alloc_blocks_per_msg': blocks})
+    return result
+
+def key(r):
+    return "{module}.{op}.{size}.{threshold}".format(**r)
+
+def compare(results, baseline, tolerance):
+    '''returns the cases that got slower than tolerance times the baseline,
+       or that allocate more blocks per message than it did'''
+    old = {key(r): r for r in baseline['results'] if 'skipped' not in r}
+    worse = []
+    for r in results:
+        if 'skipped' in r or key(r) not in old:
+            continue
+        ratio = r['us_per_msg'] / old[key(r)]['us_per_msg']
+        if ratio > tolerance:
+            worse.append("SLOWER {} {:.2f}x".format(key(r), ratio))
+        if r['alloc_blocks_per_msg'] > old[key(r)]['alloc_blocks_per_msg']:
+            worse.append("MORE ALLOCATIONS {} {} > {}".format(key(r), r['alloc_blocks_per_msg'], 
+                                                              old[key(r)]['alloc_blocks_per_msg']))
+    return worse
+
+def reassembly_growth(threshold, number):
+    '''time per fragment of fragmentation16.Reassembler.receive_frag and of
+       PartialMessage.add over SEND32_DATA packets (as XTPServer does it) as
+       the message size grows. returns the growth from smallest to largest.'''
+    growth = {}
+    for name in ['receive_frag', 'xtp']:
+        per_frag = []
+        for size in [1024, 6*1024, 24*1024, 96*1024, 384*1024]:
+            data = os.urandom(size)
+            frags = list(fragmentation16.make_frags(data, threshold=threshold, encode=False))
+            if name == 'receive_frag':
+                frames = [fragmentation16.encode(f.num, f.total-1, f.crc, f.data) for f in frags]
+                def run():
+                    r = fragmentation16.Reassembler(max_bytes=2*size)
+                    for f in frames:
+                        r.receive_frag(f, 1)
+            else:
+                packets = [(f.num, DATA_HEADER.pack(xTP.SEND32_DATA, f.num) + f.data) for f in frags]
+                def run():
+                    m = fragmentation16.PartialMessage(len(packets), 0)
+                    for i, d in packets:
+                        m.add(i, memoryview(d)[DATA_HEADER.size:])
+                    m.getvalue()
+                    m.crc32()
+            t = timeit.timeit(run, number=number) / (number * len(frags))
+            per_frag.append(t)
+            print("  {:12s} {:8d} bytes {:6d} frags: {:7.2f} us/frag".format(name, size, len(frags), t*1e6))
+        growth[name] = per_frag[-1] / per_frag[0]
+        print("  {:12s} growth {:.2f}x".format(name, growth[name]))
+    return growth
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("-o", "--output", help="save results as json", default=None)
+    p.add_argument("--compare", help="json results to compare against", default=None)
+    p.add_argument("--tolerance", help="allowed slowdown against --compare, or growth for --check",
+                   type=float, default=1.5)
+    p.add_argument("--min-time", help="seconds to run each case for", type=float, default=0.2)
+    p.add_argument("-m", "--module", help="only this module", choices=list(MODULES), default=None)
+    p.add_argument("--op", help="only this operation", choices=list(OPS), default=None)
+    p.add_argument("--check", help="only check the reassembly cost per fragment stays flat",
+                   action='store_true')
+    args = p.parse_args()
+
+    if args.check:
+        growth = reassembly_growth(92, 20)
+        if max(growth.values()) > args.tolerance:
+            print("per fragment reassembly cost grows with message size.")
+            sys.exit(1)
+        sys.exit(0)
+
+    results = []
+    print("{:16s} {:12s} {:>8s} {:>4s} {:>6s} {:>12s} {:>9s} {:>10s} {:>7s}".format(
+        'module', 'op', 'size', 'thr', 'frags', 'frags/s', 'MB/s', 'alloc B', 'blocks'))
+    for modname in MODULES:
+        if args.module != None and modname != args.module:
+            continue
+        for opname in OPS:
+            if args.op != None and opname != args.op:
+                continue
+            for threshold in THRESHOLDS:
+                for size in SIZES:
+                    r = bench(modname, opname, size, threshold, args.min_time)
+                    results.append(r)
+                    if 'skipped' in r:
+                        continue
+                    print("{module:16s} {op:12s} {size:8d} {threshold:4d} {frags:6d} {frags_per_s:12.0f} "
+                          "{mb_per_s:9.2f} {alloc_bytes_per_msg:10d} {alloc_blocks_per_msg:7d}".format(**r))
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump({'when': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=1)
+
+    if args.compare != None:
+        with open(args.compare) as f:
+            worse = compare(results, json.load(f), args.tolerance)
+        for w in worse:
+            print(w)
+        if len(worse) > 0:
+            sys.exit(1)
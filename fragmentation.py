@@ -3,17 +3,18 @@ quick and dirty fragmentation library.
 
 supports up to 16 fragments. 
 
-uses a global buffer for decoding so you can only have one message
-in flight at a time, or fragments will get lost.
+reassembly is done by fragmentation16.Reassembler using this module's 
+header format, so several messages can be in flight at once.
 '''
 
 
 import zlib
 import math
 import struct
+import fragmentation16
 
 MAGIC = b'\x15'
-class CrcError(Exception): pass
+CrcError = fragmentation16.CrcError
 
 def encode(frag_num, total_frags, crc, frag):        
     h = struct.pack("B", total_frags<<4 | frag_num&0xf )        
@@ -33,7 +34,7 @@ def make_frags(data, threshold=121):
     frag_num =0
     # make total frags the 0-based frag number of the last fragment, 
     # so it is actually total_frags - 1...
-    total_frags = math.floor(len(data) / float(threshold))
+    total_frags = max(0, math.ceil(len(data) / float(threshold)) - 1)
     crc = struct.pack(">L", zlib.crc32(data)) 
     
     if total_frags > 0xf:
@@ -44,26 +45,17 @@ def make_frags(data, threshold=121):
         yield encode(frag_num, total_frags, crc, frag_data)
         frag_num += 1
         
-frag_buf = {} 
-def receive_frag(frag):
-    global frag_buf
+class Reassembler(fragmentation16.Reassembler):
+    'fragmentation16.Reassembler for the 16 fragment header'
+    magics = (MAGIC,)
     
-    magic, total_frags, this_frag, crc, frag_data = decode(frag)
-    if magic != MAGIC:
-        return None
-    frag_buf[this_frag] = (crc, frag_data)
+    def _decode(self, frag):
+        m, tf, cf, crc, data = decode(frag)
+        return m, crc, tf, cf, crc, 0, 0, data
     
-    if this_frag == total_frags: 
-        # attempt to reassemble
-        r = b''
-        for i in range(total_frags+1):
-            r += frag_buf[i][1]
-        mycrc = zlib.crc32(r)
-        if mycrc == crc:
-            return r
-        else:            
-            raise CrcError()
-    return None
+_reassembler = Reassembler()
+def receive_frag(frag, source = None):
+    return _reassembler.receive_frag(frag, source)
 
 if __name__=="__main__":
     #test
@@ -3,16 +3,32 @@ quick and dirty fragmentation library.
 
 supports up to 2**16 fragments. 
 
-uses a global buffer for decoding so you can only have one message
-in flight at a time, or fragments will get lost.
+fragments are put back together by a Reassembler, which keeps a separate
+context per (source, message crc) so many messages can be in flight at 
+once. the module level receive_frag uses a shared default Reassembler.
+
+optional forward error correction (iter_frags(fec=(group, parity))) adds
+XOR parity fragments so the receiver can rebuild lost fragments without
+a retransmit. FEC fragments use their own magic, so peers that only know
+the plain header ignore them instead of misreading them.
+
+iter_frags_compact uses a variable length header (magic, message id and
+varint fragment numbers, 4 bytes for most messages instead of 9) with 
+the crc sent once, after the data in the last fragment. it has its own
+magics too and is only sent to peers that announce it.
 '''
 
 
 import zlib
 import math
 import struct
+import datetime
+import collections
 
 MAGIC = 0x17
+MAGIC_FEC = 0x18
+MAGIC_COMPACT = 0x19
+MAGIC_COMPACT_FEC = 0x1a
 class CrcError(Exception): pass
 
 class Fragment():
@@ -23,63 +39,513 @@ class Fragment():
         self.data = data
 
 
+# packed once, reused for every fragment
+HEADER = struct.Struct(">BHHL")
+# HEADER plus the parity group size and parity fragments per group
+FEC_HEADER = struct.Struct(">BHHLBB")
+# xor of the member lengths, leads every parity payload
+PARITY_LEN = struct.Struct(">H")
+# trails the data of compact messages
+CRC = struct.Struct(">L")
+
 def encode(frag_num, total_frags, crc, frag):        
-    h = struct.pack(">BHHL", MAGIC, total_frags, frag_num, crc )
-    #print(h, frag)        
-    return h + frag
+    return HEADER.pack(MAGIC, total_frags, frag_num, crc) + frag
 def decode(frag):    
      # 0   1 2   3 4   4 5 6 7      
-    m, tf, cf, crc = struct.unpack(">BHHL", frag[0:9])
-    #print(m, tf, cf, crc)
-    return m, tf, cf, crc, frag[9:]
-def make_frags(data, threshold=121, encode = True):
-    '''given some data (binary string) add the fragmentation header and 
-        fragment if necessary. Adds 6 bytes of overhead, so threshold of 
-        121 will generate a max packet length of 127 bytes.
-        returns generated fragments with appropriate headers.    
-       '''   
+    m, tf, cf, crc = HEADER.unpack_from(frag)
+    return m, tf, cf, crc, frag[HEADER.size:]
+def decode_fec(frag):
+    m, tf, cf, crc, group, parity = FEC_HEADER.unpack_from(frag)
+    return m, tf, cf, crc, group, parity, frag[FEC_HEADER.size:]
+
+def varint(n):
+    'unsigned LEB128, 7 bits per byte, low bits first'
+    b = bytearray()
+    while n > 0x7f:
+        b.append(0x80 | (n & 0x7f))
+        n >>= 7
+    b.append(n)
+    return bytes(b)
+def read_varint(buf, at = 0):
+    'returns the varint at buf[at] and the offset just past it'
+    n = 0
+    shift = 0
+    while True:
+        b = buf[at]
+        at += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, at
+        shift += 7
     
-    at=0
-    frag_num =0
+def encode_compact(msgid, frag_num, total_frags, fec = None):
+    'compact header for a fragment, total_frags is the last fragment number'
+    if fec == None:
+        return bytes([MAGIC_COMPACT, msgid]) + varint(total_frags) + varint(frag_num)
+    return bytes([MAGIC_COMPACT_FEC, msgid]) + varint(total_frags) + varint(frag_num) + bytes(fec)
+def decode_compact(frag):
+    m = frag[0]
+    msgid = frag[1]
+    tf, at = read_varint(frag, 2)
+    cf, at = read_varint(frag, at)
+    group = parity = 0
+    if m == MAGIC_COMPACT_FEC:
+        group, parity = frag[at], frag[at+1]
+        at += 2
+    return m, msgid, tf, cf, group, parity, frag[at:]
+
+def parity_payload(members, threshold):
+    'XOR of the members zero padded to threshold, led by the XOR of their lengths'
+    x = 0
+    l = 0
+    for f in members:
+        x ^= int.from_bytes(f, 'big') << 8*(threshold - len(f))
+        l ^= len(f)
+    return PARITY_LEN.pack(l) + x.to_bytes(threshold, 'big')
+
+def make_parity(frags, group, parity, threshold):
+    '''XOR parity over fragment payloads for forward error correction.
+    
+       fragments are taken group at a time and parity fragment j of a group
+       covers members j, j+parity, j+2*parity, ... so any run of up to 
+       parity consecutive losses in a group can be rebuilt. yields 
+       (group number, j, payload).
+       '''
+    if group < 1 or group > 0xff or parity < 1 or parity > group:
+        raise ValueError("bad fec group {} / parity {}".format(group, parity))
+    for g, first in enumerate(range(0, len(frags), group)):
+        for j in range(parity):
+            members = frags[first+j:first+group:parity]
+            if len(members) > 0:
+                yield g, j, parity_payload(members, threshold)
+
+def _emit(frags, threshold, fec, header):
+    '''yields (header(frag_num), payload) for frags, followed group by 
+       group by their parity fragments when fec is (group, parity)'''
+    if fec == None:
+        for frag_num, f in enumerate(frags):
+            yield header(frag_num), f
+        return
+    
+    group, parity = fec
+    frags = list(frags)
+    # parity fragment numbers start after the last data fragment
+    parity_at = len(frags)
+    for g, j, p in make_parity(frags, group, parity, threshold):
+        if j == 0:
+            for frag_num in range(g*group, min(g*group + group, len(frags))):
+                yield header(frag_num), frags[frag_num]
+        yield header(parity_at + g*parity + j), p
+
+def _count(length, threshold, fec):
+    'number of data fragments and the largest fragment number'
+    n = max(1, math.ceil(length / float(threshold)))
+    if fec == None:
+        return n, n - 1
+    return n, n - 1 + math.ceil(n / float(fec[0])) * fec[1]
+
+def iter_frags(data, threshold=121, fec=None):
+    '''zero copy fragmentation, yields (header, payload) pairs where payload
+        is a memoryview slice of data. the pair can be handed to 
+        XBeeDevice.send as is, it is gathered into the frame there.
+        
+        fec is None or (group, parity), see make_parity. parity fragments
+        follow their group and carry payloads of threshold + 2 bytes.
+       '''
+    view = memoryview(data)
     # make total frags the 0-based frag number of the last fragment, 
     # so it is actually total_frags - 1...
-    total_frags = math.floor(len(data) / float(threshold))
-    crc = zlib.crc32(data) 
-    #print('crc is ', crc)
-    if total_frags > 0xffff:
+    total_frags = max(0, math.ceil(len(view) / float(threshold)) - 1)
+    if _count(len(view), threshold, fec)[1] > 0xffff:
         raise Exception("data too large for this format ({} is too many fragments)!".format(total_frags))
-    while at<len(data):
-        frag_data = data[at:at+threshold] 
-        at += len(frag_data)
+    crc = zlib.crc32(view)
+    
+    frags = (view[at:at+threshold] for at in range(0, len(view), threshold))
+    if fec == None:
+        def header(frag_num):
+            return HEADER.pack(MAGIC, total_frags, frag_num, crc)
+    else:
+        def header(frag_num):
+            return FEC_HEADER.pack(MAGIC_FEC, total_frags, frag_num, crc, fec[0], fec[1])
+    return _emit(frags, threshold, fec, header)
+
+def compact_threshold(mtu, length, fec = None):
+    '''the largest threshold that keeps every compact fragment (and parity
+       fragment) of a length byte message within mtu bytes'''
+    length += CRC.size
+    extra = 2
+    if fec != None:
+        extra += len(fec) + PARITY_LEN.size
+    # the header grows with the fragment count, which grows as the
+    # threshold shrinks, so settle on a header size
+    header = extra + 2
+    while True:
+        threshold = mtu - header
+        if threshold < 1:
+            raise Exception("mtu {} too small".format(mtu))
+        n, last = _count(length, threshold, fec)
+        need = extra + len(varint(n - 1)) + len(varint(last))
+        if need <= header:
+            return threshold
+        header = need
+
+def iter_frags_compact(data, threshold, msgid, fec=None):
+    '''like iter_frags with the compact header. msgid (0-255) tells 
+       messages from one source apart and should change for every message.
+       the crc32 of data follows it, so only the last fragment or two are
+       copied to append it.
+       '''
+    view = memoryview(data)
+    crc = CRC.pack(zlib.crc32(view))
+    length = len(view) + CRC.size
+    n = max(1, math.ceil(length / float(threshold)))
+    total_frags = n - 1
+    
+    def frags():
+        for at in range(0, length, threshold):
+            end = min(at + threshold, length)
+            if end <= len(view):
+                yield view[at:end]
+            else:
+                yield bytes(view[at:end]) + crc[max(0, at - len(view)):end - len(view)]
+    
+    def header(frag_num):
+        return encode_compact(msgid, frag_num, total_frags, fec)
+    return _emit(frags(), threshold, fec, header)
+        
+def make_frags(data, threshold=121, encode = True):
+    '''given some data (binary string) add the fragmentation header and 
+        fragment if necessary. Adds 9 bytes of overhead (HEADER), so the 
+        default threshold of 121 will generate a max packet length of 130 
+        bytes, 118 one of 127.
+        returns generated fragments with appropriate headers, or Fragment
+        objects holding memoryview slices of data if encode is False.
+       '''   
+    for frag_num, (h, frag_data) in enumerate(iter_frags(data, threshold)):
         if encode:
-            yield encode(frag_num, total_frags, crc, frag_data)
+            yield h + frag_data
         else:
+            if frag_num == 0:
+                m, total_frags, n, crc = HEADER.unpack(h)
             yield Fragment(frag_num, total_frags+1, crc, frag_data)
+
+class PartialMessage():
+    '''the fragments of one message received so far.
+    
+       every fragment but the last is threshold bytes long, so once the 
+       threshold is known each fragment is copied exactly once into a 
+       preallocated buffer at frag_num * threshold. the last fragment is 
+       held aside if it arrives before any other.
+       
+       with fec=(group, parity) fragment numbers past the last data 
+       fragment are parity (see make_parity), and a lost fragment is 
+       rebuilt as soon as the rest of its parity set is here.
+       
+       crc is None for compact messages, their crc trails the data.
+       
+       the crc32 is folded in as the contiguous prefix of the message 
+       grows, so when fragments arrive in order checking the completed 
+       message costs almost nothing.
+    '''
+    def __init__(self, total_frags, crc, fec = None):
+        # total_frags is the fragment count, not the index of the last one
+        self.total = total_frags
+        self.crc = crc
+        self.fec = fec
+        self.threshold = None
+        self.length = None
+        self.buf = None
+        self.have = bytearray(total_frags)
+        self.parity = {}
+        self.recovered = []
+        self.count = 0
+        self.size = 0
+        self._last = None
+        # running crc over buf[:_crc_pos], which ends in fragment _crc_next
+        self._crc = 0
+        self._crc_pos = 0
+        self._crc_next = 0
+        self.created = datetime.datetime.now()
+        
+    def _alloc(self, threshold):
+        self.threshold = threshold
+        self.buf = bytearray(self.total * self.threshold)
+        self.size += len(self.buf)
+        if self._last != None:
+            self.size -= len(self._last)
+            if len(self._last) > self.threshold:
+                # can't belong to this message
+                self.have[self.total - 1] = 0
+                self.count -= 1
+            else:
+                self._place(self.total - 1, self._last)
+            self._last = None
+        
+    def _place(self, frag_num, data):
+        at = frag_num * self.threshold
+        self.buf[at:at+len(data)] = data
+        if frag_num == self.total - 1:
+            self.length = at + len(data)
             
-        frag_num += 1
+    def _frag_len(self, frag_num):
+        if frag_num == self.total - 1:
+            return self.length - frag_num * self.threshold
+        return self.threshold
+        
+    def add(self, frag_num, data):
+        'store a fragment, returns True once every fragment is here'
+        if frag_num >= self.total:
+            if self.fec != None:
+                self._add_parity(frag_num - self.total, data)
+                self._advance_crc()
+            return self.complete()
+        if self.have[frag_num]:
+            return self.complete()
         
-frag_buf = {} 
-def receive_frag(frag):
-    global frag_buf
+        last = frag_num == self.total - 1
+        if self.buf == None:
+            if last and self.total > 1:
+                self._last = bytes(data)
+                self.size += len(self._last)
+            else:
+                self._alloc(len(data))
+        elif len(data) != self.threshold and (not last or len(data) > self.threshold):
+            # wrong size, writing it would shift the rest of the buffer
+            return False
+        
+        if self.buf != None:
+            self._place(frag_num, data)
+        self.have[frag_num] = 1
+        self.count += 1
+        
+        if self.fec != None and self.buf != None:
+            self._recover(frag_num // self.fec[0])
+        self._advance_crc()
+        return self.complete()
     
-    magic, total_frags, this_frag, crc, frag_data = decode(frag)
-    #print("rcv ", total_frags,this_frag, crc, frag_data)
-    if magic != MAGIC:
-        return None
-    frag_buf[this_frag] = (crc, frag_data)
-    
-    if this_frag == total_frags: 
-        # attempt to reassemble
-        r = b''
-        for i in range(total_frags+1):
-            r += frag_buf[i][1]
-        mycrc = zlib.crc32(r)
-        if mycrc == crc:
-            return r
-        else:            
-            #print('got crc {:x} != {:x}'.format(mycrc, crc))
+    def _add_parity(self, p, data):
+        if p in self.parity or len(data) <= PARITY_LEN.size:
+            return
+        if self.buf == None:
+            self._alloc(len(data) - PARITY_LEN.size)
+        elif len(data) != self.threshold + PARITY_LEN.size:
+            return
+        self.parity[p] = bytes(data)
+        self.size += len(data)
+        self._recover(p // self.fec[1])
+        
+    def _recover(self, g):
+        'rebuild any fragment of group g that is the only one missing from its parity set'
+        group, parity = self.fec
+        first = g * group
+        end = min(first + group, self.total)
+        for j in range(parity):
+            p = self.parity.get(g*parity + j)
+            if p == None:
+                continue
+            members = range(first + j, end, parity)
+            missing = [k for k in members if not self.have[k]]
+            if len(missing) != 1:
+                continue
+            
+            l = PARITY_LEN.unpack_from(p)[0]
+            x = int.from_bytes(p[PARITY_LEN.size:], 'big')
+            for k in members:
+                if k != missing[0]:
+                    at = k * self.threshold
+                    # the buffer past the end of the last fragment is zeros
+                    x ^= int.from_bytes(self.buf[at:at+self.threshold], 'big')
+                    l ^= self._frag_len(k)
+            if l == 0 or l > self.threshold:
+                continue
+            
+            self._place(missing[0], x.to_bytes(self.threshold, 'big')[:l])
+            self.have[missing[0]] = 1
+            self.count += 1
+            self.recovered.append(missing[0])
+    
+    def _advance_crc(self):
+        'fold fragments that extend the contiguous prefix into the running crc'
+        if self.buf == None:
+            return
+        while self._crc_next < self.total and self.have[self._crc_next]:
+            k = self._crc_next
+            if k == self.total - 1:
+                end = self.length
+            else:
+                end = (k + 1) * self.threshold
+            folded = True
+            if self.crc == None:
+                # the trailing crc may span several fragments when they are
+                # small, until the last one says where it starts only what
+                # is before it in the shortest message possible is folded
+                if self.length == None:
+                    limit = (self.total - 1) * self.threshold + 1 - CRC.size
+                else:
+                    limit = self.length - CRC.size
+                if end > limit:
+                    end = limit
+                    folded = self.length != None
+            if end > self._crc_pos:
+                self._crc = zlib.crc32(memoryview(self.buf)[self._crc_pos:end], self._crc)
+                self._crc_pos = end
+            if not folded:
+                break
+            self._crc_next += 1
+    
+    def complete(self):
+        return self.count == self.total and self.buf != None
+    
+    def getvalue(self):
+        'the reassembled data as a memoryview into the buffer'
+        return memoryview(self.buf)[:self.length]
+    
+    def crc32(self):
+        'crc32 of the data so far, only what is past the contiguous prefix is scanned here'
+        r = self.getvalue()
+        if self.crc == None:
+            r = r[:max(0, len(r) - CRC.size)]
+        return zlib.crc32(r[self._crc_pos:], self._crc)
+    
+    def assemble(self):
+        'the reassembled data, raises CrcError if it is corrupt'
+        r = self.getvalue()
+        crc = self.crc
+        if crc == None:
+            if len(r) < CRC.size:
+                raise CrcError()
+            crc = CRC.unpack_from(r, len(r) - CRC.size)[0]
+            r = r[:len(r) - CRC.size]
+        if self.crc32() != crc:
             raise CrcError()
-    return None
+        return r
+    
+class Reassembler():
+    '''holds partial messages keyed by (source, crc, total) so fragments 
+       from several sources, or several messages from one source, can 
+       arrive interleaved.
+       
+       partial messages are evicted oldest first once they are older than
+       max_age or the buffered fragments use more than max_bytes.
+       
+       plain, FEC and compact fragments are all accepted. compact ones are
+       keyed by their message id instead of the crc.
+    '''
+    magics = (MAGIC, MAGIC_FEC, MAGIC_COMPACT, MAGIC_COMPACT_FEC)
+    
+    def __init__(self, max_age = datetime.timedelta(seconds=30), max_bytes = 64*1024):
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        
+        self._partial = collections.OrderedDict()
+        self._bytes = 0
+        # recently completed messages, so their late parity is ignored 
+        self._done = collections.OrderedDict()
+        self.done_window = datetime.timedelta(seconds=5)
+        
+        self.completed = 0
+        self.evicted = 0
+        self.crc_errors = 0
+        self.recovered = 0
+        
+    def _decode(self, frag):
+        'returns magic, message id, last fragment, fragment, crc, fec group, fec parity, data'
+        if frag[0] in (MAGIC_COMPACT, MAGIC_COMPACT_FEC):
+            m, msgid, tf, cf, group, parity, data = decode_compact(frag)
+            return m, msgid, tf, cf, None, group, parity, data
+        if frag[0] == MAGIC_FEC:
+            m, tf, cf, crc, group, parity, data = decode_fec(frag)
+            return m, crc, tf, cf, crc, group, parity, data
+        m, tf, cf, crc, data = decode(frag)
+        return m, crc, tf, cf, crc, 0, 0, data
+    
+    def position(self, frag):
+        'the last fragment number of its message and the number of frag, parity is past last'
+        m, msgid, last, num, crc, group, parity, data = self._decode(frag)
+        return last, num
+    
+    def stats(self):
+        return {'partial': len(self._partial),
+                'bytes': self._bytes,
+                'completed': self.completed,
+                'evicted': self.evicted,
+                'crc_errors': self.crc_errors,
+                'recovered': self.recovered}
+        
+    def _drop(self, key):
+        msg = self._partial.pop(key)
+        self._bytes -= msg.size
+        
+    def _evict(self):
+        now = datetime.datetime.now()
+        while len(self._done) > 0:
+            key, when = next(iter(self._done.items()))
+            if now - when < self.done_window:
+                break
+            del self._done[key]
+        while len(self._partial) > 0:
+            key, msg = next(iter(self._partial.items()))
+            if now - msg.created < self.max_age and self._bytes <= self.max_bytes:
+                break
+            self._drop(key)
+            self.evicted += 1
+        
+    def _forget_old_ids(self, source, msgid):
+        '''compact message ids wrap around, so drop what is left of messages
+           from source that are 64 or more ids older than msgid'''
+        for key in [k for k in self._partial if k[0] == source and k[3] and (msgid - k[1]) & 0xff >= 64]:
+            self._drop(key)
+            self.evicted += 1
+        for key in [k for k in self._done if k[0] == source and k[3] and (msgid - k[1]) & 0xff >= 64]:
+            del self._done[key]
+        
+    def receive_frag(self, frag, source = None):
+        '''add a fragment from source, returns the reassembled message once
+           complete or None. raises CrcError if the message is corrupt.
+        '''
+        magic, msgid, total_frags, this_frag, crc, group, parity, frag_data = self._decode(frag)
+        if magic not in self.magics:
+            return None
+        
+        key = (source, msgid, total_frags, crc == None)
+        if key in self._done and (this_frag > total_frags or crc == None):
+            # late parity, or data that was already rebuilt from parity.
+            # a full header message may legitimately be sent twice, a 
+            # compact message id is not reused this soon.
+            return None
+        if key not in self._partial:
+            if crc == None:
+                self._forget_old_ids(source, msgid)
+            fec = None
+            if group > 0 and parity > 0:
+                fec = (group, parity)
+            self._partial[key] = PartialMessage(total_frags+1, crc, fec)
+        msg = self._partial[key]
+        
+        size = msg.size
+        done = msg.add(this_frag, frag_data)
+        self._bytes += msg.size - size
+        
+        if done:
+            self._drop(key)
+            self.recovered += len(msg.recovered)
+            if msg.fec != None:
+                self._done[key] = datetime.datetime.now()
+                self._done.move_to_end(key)
+            try:
+                r = msg.assemble()
+            except CrcError:
+                self.crc_errors += 1
+                raise
+            self.completed += 1
+            return r
+        
+        self._evict()
+        return None
+        
+_reassembler = Reassembler()
+def receive_frag(frag, source = None):
+    return _reassembler.receive_frag(frag, source)
 
 if __name__=="__main__":
     #test
@@ -205,4 +671,15 @@ Praesent blandit mi non velit dapibus dictum. Aenean ligula arcu, porta a nunc i
     for frag in make_frags(s):
         rslt = receive_frag(frag)
         
-    assert rslt == s, "got {}".format(rslt)
\ No newline at end of file
+    assert rslt == s, "got {}".format(rslt)
+    
+    # compact fragments smaller than the crc that trails them, in and out of order
+    s = b'0123456789abcdef'
+    for threshold in range(1, 8):
+        frags = [h + bytes(p) for h, p in iter_frags_compact(s, threshold, 7)]
+        for order in (frags, frags[::-1]):
+            r = Reassembler()
+            rslt = None
+            for frag in order:
+                rslt = r.receive_frag(frag, 1) or rslt
+            assert rslt == s, "threshold {} got {}".format(threshold, rslt)
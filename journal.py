@@ -0,0 +1,200 @@
+'''
+an append-only journal of messages that must survive a crash.
+
+every message appended gets a sequence number and is written to the file
+(and fsynced) before append returns. done(seq) appends a record saying
+it was delivered. a Journal opened on an existing file replays it and
+pending() is what was appended but never done, in order.
+
+records are
+
+    length, crc32, kind, seq, data
+
+with the crc over kind, seq and data. a record cut short by a crash, or
+one that doesn't match its crc, ends the journal: the file is truncated
+there. when the file grows to more than twice what is still pending it is
+rewritten with just that, through a temporary file and a rename.
+
+at most max_size bytes of messages are pending at once, append waits for
+room.
+'''
+
+import collections
+import logging
+import os
+import struct
+import threading
+import zlib
+
+RECORD = struct.Struct(">LLBQ")
+ADD = 1
+DONE = 2
+
+# smaller journals are not worth compacting
+MIN_COMPACT = 0x10000
+
+class Journal():
+    def __init__(self, filename, max_size = 0x100000):
+        self.LOG = logging.getLogger(__name__)
+        self.filename = filename
+        self.max_size = max_size
+
+        self._cv = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._size = 0
+        self._next_seq = 0
+        self._closed = False
+
+        self.appended = 0
+        self.done_count = 0
+        self.compactions = 0
+
+        self._replay()
+        self._f = open(filename, 'ab')
+
+    def _replay(self):
+        'load what is pending from the file, cutting off a torn tail'
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            raw = f.read()
+        at = 0
+        while at + RECORD.size <= len(raw):
+            length, crc, kind, seq = RECORD.unpack_from(raw, at)
+            end = at + RECORD.size + length
+            if end > len(raw) or zlib.crc32(raw[at+8:end]) != crc:
+                break
+            data = raw[at+RECORD.size:end]
+            if kind == ADD:
+                self._pending[seq] = data
+                self._size += len(data)
+            elif kind == DONE and seq in self._pending:
+                self._size -= len(self._pending.pop(seq))
+            self._next_seq = max(self._next_seq, seq + 1)
+            at = end
+        if at < len(raw):
+            self.LOG.warn("{}: dropped {} bytes after the last whole record".format(self.filename,
+                                                                                  len(raw) - at))
+            with open(self.filename, 'r+b') as f:
+                f.truncate(at)
+        if len(self._pending) > 0:
+            self.LOG.info("{}: {} messages, {} bytes pending".format(self.filename, len(self._pending),
+                                                                    self._size))
+
+    def _record(self, kind, seq, data = b''):
+        body = struct.pack(">BQ", kind, seq) + data
+        return struct.pack(">LL", len(data), zlib.crc32(body)) + body
+
+    def _sync(self, record):
+        self._f.write(record)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def append(self, data, timeout = None):
+        '''the sequence number of data once it is on disk, None if there was
+           no room for it within timeout seconds or the journal was closed'''
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._closed or self._size + len(data) <= self.max_size or
+                                             len(self._pending) == 0, timeout):
+                return None
+            if self._closed:
+                return None
+            seq = self._next_seq
+            self._next_seq += 1
+            self._sync(self._record(ADD, seq, data))
+            self._pending[seq] = data
+            self._size += len(data)
+            self.appended += 1
+            return seq
+
+    def done(self, seq):
+        'seq was delivered and need not be replayed'
+        with self._cv:
+            if self._closed or seq not in self._pending:
+                return
+            self._sync(self._record(DONE, seq))
+            self._size -= len(self._pending.pop(seq))
+            self.done_count += 1
+            if self._f.tell() > max(MIN_COMPACT, 2 * (self._size + len(self._pending) * RECORD.size)):
+                self._compact()
+            self._cv.notify_all()
+
+    def _compact(self):
+        'rewrite the file with only what is pending, with _cv held'
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            for seq, data in self._pending.items():
+                f.write(self._record(ADD, seq, data))
+            f.flush()
+            os.fsync(f.fileno())
+        self._f.close()
+        os.replace(tmp, self.filename)
+        self._f = open(self.filename, 'ab')
+        self.compactions += 1
+
+    def get(self, seq):
+        'the data of seq, None once it is done'
+        with self._cv:
+            return self._pending.get(seq)
+
+    def pending(self):
+        'sequence numbers not done yet, oldest first'
+        with self._cv:
+            return list(self._pending.keys())
+
+    def close(self):
+        'close the file, an append waiting for room returns None'
+        with self._cv:
+            self._closed = True
+            self._f.close()
+            self._cv.notify_all()
+
+    def stats(self):
+        return {'pending': len(self._pending),
+                'bytes': self._size,
+                'max_size': self.max_size,
+                'appended': self.appended,
+                'done': self.done_count,
+                'compactions': self.compactions}
+
+if __name__=="__main__":
+    #test
+    import tempfile
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'journal')
+    j = Journal(filename, max_size = 4096)
+    for i in range(3):
+        assert j.append(b'message %d' % i) == i
+    j.done(1)
+    assert j.pending() == [0, 2]
+    j.close()
+    
+    # a crash in the middle of a record
+    size = os.path.getsize(filename)
+    with open(filename, 'ab') as f:
+        f.write(j._record(ADD, 3, b'message 3')[:-2])
+    j = Journal(filename, max_size = 4096)
+    assert j.pending() == [0, 2] and j.get(2) == b'message 2', j.pending()
+    assert os.path.getsize(filename) == size
+    assert j.append(b'message 3') == 3
+    
+    # no room
+    assert j.append(bytes(4096), timeout = 0) == None
+    
+    # done records pile up until the file is rewritten
+    for i in range(100):
+        j.done(j.append(bytes(1000)))
+    assert j.compactions > 0 and os.path.getsize(filename) < MIN_COMPACT, j.stats()
+    assert j.pending() == [0, 2, 3]
+    j.close()
+    j = Journal(filename)
+    assert j.pending() == [0, 2, 3] and j.get(3) == b'message 3'
+    assert j.append(b'next') > 3
+    
+    # closing lets an append waiting for room go
+    t = threading.Timer(0.1, j.close)
+    t.start()
+    assert j.append(bytes(j.max_size)) == None
+    j.done(0)
+    os.remove(filename)
+    os.rmdir(os.path.dirname(filename))
@@ -0,0 +1,422 @@
+'''
+MQTT 3.1.1 aware encoding for the radio link.
+
+an Encoder takes the MQTT byte stream a broker or client sends, in
+whatever pieces it was read in, and turns the complete packets in it into
+records that are shorter on air:
+
+    PUBLISH         the topic is replaced with an alias once it has been
+                    sent, packet ids and lengths are varints
+    PUBACK, PUBREC, just the packet id
+    PUBREL, PUBCOMP,
+    UNSUBACK
+    PINGREQ, PINGRESP, a single byte
+    DISCONNECT
+    anything else   fixed header byte, varint length, body
+
+a Decoder rebuilds the exact bytes that went in. packets that would not
+come out byte for byte the same (a remaining length that isn't the
+shortest encoding, say) and streams that aren't MQTT at all are sent as
+RAW records, untouched.
+
+every message is
+
+    MAGIC, epoch, records...
+
+aliases are only ever defined once per epoch. a Decoder that sees an
+alias it doesn't know (the message defining it was lost) raises
+CodecError, and the receiver should ask the Encoder to reset(), which
+starts a new epoch with no aliases. a Decoder forgets its aliases when
+the epoch changes, so it can't use a stale one.
+'''
+
+import random
+
+from fragmentation16 import varint, read_varint
+
+MAGIC = 0x1c
+
+# record kinds, the high nibble of the tag
+RAW = 0x00
+PUBLISH_DEFINE = 0x10
+PUBLISH_ALIAS = 0x20
+PACKET_ID = 0x30
+EMPTY = 0x40
+OTHER = 0x50
+
+PUBLISH = 3
+# fixed header bytes of packets that are only a packet id
+ID_PACKETS = (0x40, 0x50, 0x62, 0x70, 0xb0)
+# fixed header bytes of packets with no body
+EMPTY_PACKETS = (0xc0, 0xd0, 0xe0)
+# packet types whose fixed header flags must be 0b0010
+FLAGS_2 = (6, 8, 10)
+# packet types that can overtake PUBLISH without changing what either end
+# sees: CONNACK to PINGRESP but PUBLISH
+CONTROL_TYPES = (2, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
+# CONNECT and DISCONNECT, which nothing overtakes: a new connection's
+# CONNECT would reach a shared upstream before the old one's DISCONNECT, 
+# its SUBSCRIBE before its CONNECT
+BARRIER_TYPES = (1, 14)
+
+# longer topics are sent as they are
+MAX_TOPIC = 256
+# a new epoch starts after this many aliases
+MAX_ALIASES = 1024
+# packets bigger than this pass through as they are read, not buffered
+MAX_PACKET = 0x10000
+
+class CodecError(Exception): pass
+
+def valid_header(b):
+    'True if b can be the first byte of an MQTT 3.1.1 packet'
+    t, flags = b >> 4, b & 0x0f
+    if t == 0 or t == 15:
+        return False
+    if t == PUBLISH:
+        return flags & 0x06 != 0x06
+    if t in FLAGS_2:
+        return flags == 2
+    return flags == 0
+
+def remaining_length(buf, at):
+    '''the remaining length of the packet at buf[at] and where its body
+       starts, None if buf ends first. raises ValueError if it is invalid.'''
+    n = 0
+    shift = 0
+    i = at + 1
+    while True:
+        if i >= len(buf):
+            return None
+        if shift > 21:
+            raise ValueError("remaining length longer than 4 bytes")
+        n |= (buf[i] & 0x7f) << shift
+        shift += 7
+        i += 1
+        if buf[i-1] & 0x80 == 0:
+            return n, i
+
+def split_packets(stream):
+    'complete MQTT packets at the start of stream, stops at anything else'
+    at = 0
+    while at < len(stream):
+        if not valid_header(stream[at]):
+            return
+        try:
+            r = remaining_length(stream, at)
+        except ValueError:
+            return
+        if r == None or r[1] + r[0] > len(stream):
+            return
+        yield stream[at:r[1]+r[0]]
+        at = r[1] + r[0]
+
+def is_encoded(data):
+    'True if data was made by an Encoder'
+    return len(data) >= 2 and data[0] == MAGIC
+
+def _bytes(b):
+    return varint(len(b)) + b
+
+def is_control(packet):
+    'True if the complete packet may be sent ahead of PUBLISHes and DISCONNECT'
+    return packet[0] >> 4 in CONTROL_TYPES
+
+def is_barrier(packet):
+    'True if nothing written after the complete packet may be sent ahead of it'
+    return packet[0] >> 4 in BARRIER_TYPES
+
+class Splitter():
+    '''cuts an MQTT byte stream, in whatever pieces it was read in, at 
+       packet boundaries. incomplete packets wait for the rest, except ones
+       bigger than MAX_PACKET, which pass through as they are read, like 
+       everything once the stream turns out not to be MQTT.'''
+    def __init__(self):
+        self._buf = b''
+        # bytes of a big packet still to pass through
+        self._raw_left = 0
+        self.passthrough = False
+
+    def between(self):
+        'True if what split returned so far ends with a whole packet'
+        return self._raw_left == 0 and not self.passthrough
+
+    def split(self, data):
+        '''a list of (whole, chunk) for data, whole is True if chunk is a
+           complete packet and False for bytes passed through'''
+        buf = self._buf + bytes(data)
+        chunks = []
+        at = 0
+        while at < len(buf):
+            if self._raw_left > 0:
+                n = min(self._raw_left, len(buf) - at)
+                chunks.append( (False, buf[at:at+n]) )
+                self._raw_left -= n
+                at += n
+                continue
+            if self.passthrough or not valid_header(buf[at]):
+                # not MQTT, or we lost track of it. everything from here on is raw
+                self.passthrough = True
+                chunks.append( (False, buf[at:]) )
+                at = len(buf)
+                break
+            try:
+                r = remaining_length(buf, at)
+            except ValueError:
+                self.passthrough = True
+                continue
+            if r == None:
+                break
+            n, body = r
+            if body - at + n > MAX_PACKET:
+                self._raw_left = body - at + n
+                continue
+            if body + n > len(buf):
+                break
+            chunks.append( (True, buf[at:body+n]) )
+            at = body + n
+        self._buf = buf[at:]
+        return chunks
+
+class Encoder():
+    'one direction of an MQTT stream, see the module doc'
+    def __init__(self):
+        # a restarted Encoder is unlikely to reuse the epoch its Decoder is in
+        self.epoch = random.randrange(0x100)
+        self._aliases = {}
+        self._splitter = Splitter()
+        self._full = False
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets = 0
+        self.raw = 0
+
+    @property
+    def passthrough(self):
+        return self._splitter.passthrough
+
+    def reset(self):
+        'forget the aliases, the next message starts a new epoch'
+        self.epoch = (self.epoch + 1) & 0xff
+        self._aliases = {}
+        self._full = False
+
+    def encode(self, data):
+        '''the message for the packets data completes, b'' if it completed
+           none. incomplete packets wait for the rest.'''
+        if self._full:
+            self.reset()
+        records = []
+        for whole, chunk in self._splitter.split(data):
+            if whole:
+                records.append(self._record(chunk, remaining_length(chunk, 0)[1]))
+                self.packets += 1
+            else:
+                records.append(bytes([RAW]) + _bytes(chunk))
+
+        self.bytes_in += len(data)
+        if len(records) == 0:
+            return b''
+        m = bytes([MAGIC, self.epoch]) + b''.join(records)
+        self.bytes_out += len(m)
+        return m
+
+    def _record(self, packet, body):
+        'the record for one complete packet whose body starts at packet[body]'
+        h = packet[0]
+        # MQTT's remaining length is the same LEB128 as varint
+        if varint(len(packet) - body) != packet[1:body]:
+            # the far side would rebuild a different length
+            self.raw += 1
+            return bytes([RAW]) + _bytes(packet)
+        if h >> 4 == PUBLISH:
+            return self._publish(packet, body)
+        if h in ID_PACKETS and len(packet) - body == 2:
+            pid = (packet[body] << 8) | packet[body+1]
+            return bytes([PACKET_ID | ID_PACKETS.index(h)]) + varint(pid)
+        if h in EMPTY_PACKETS and len(packet) == body:
+            return bytes([EMPTY | EMPTY_PACKETS.index(h)])
+        return bytes([OTHER, h]) + _bytes(packet[body:])
+
+    def _publish(self, packet, body):
+        h = packet[0]
+        flags = h & 0x0f
+        qos = (h >> 1) & 3
+        if len(packet) - body < 2:
+            return bytes([OTHER, h]) + _bytes(packet[body:])
+        tlen = (packet[body] << 8) | packet[body+1]
+        at = body + 2 + tlen
+        if at + (2 if qos else 0) > len(packet) or tlen > MAX_TOPIC:
+            return bytes([OTHER, h]) + _bytes(packet[body:])
+        topic = packet[body+2:at]
+
+        pid = b''
+        if qos:
+            pid = varint((packet[at] << 8) | packet[at+1])
+            at += 2
+        payload = _bytes(packet[at:])
+
+        if topic in self._aliases:
+            return bytes([PUBLISH_ALIAS | flags]) + varint(self._aliases[topic]) + pid + payload
+        if len(self._aliases) >= MAX_ALIASES:
+            # the rest of this message is still in this epoch, the next one starts anew
+            self._full = True
+            return bytes([OTHER, h]) + _bytes(packet[body:])
+        alias = len(self._aliases)
+        self._aliases[topic] = alias
+        return bytes([PUBLISH_DEFINE | flags]) + varint(alias) + _bytes(topic) + pid + payload
+
+    def ratio(self):
+        'encoded / MQTT bytes so far'
+        if self.bytes_in == 0:
+            return 1.0
+        return self.bytes_out / float(self.bytes_in)
+
+    def stats(self):
+        return {'packets': self.packets,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.ratio(),
+                'aliases': len(self._aliases),
+                'epoch': self.epoch,
+                'raw': self.raw,
+                'passthrough': self.passthrough}
+
+class Decoder():
+    'the receiving side of an Encoder'
+    def __init__(self):
+        self.epoch = None
+        self._topics = {}
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets = 0
+        self.unknown = 0
+
+    def decode(self, data):
+        '''the MQTT bytes of the message in data, raises CodecError if it
+           can't be rebuilt'''
+        if data[1] != self.epoch:
+            self.epoch = data[1]
+            self._topics = {}
+        out = []
+        at = 2
+        try:
+            while at < len(data):
+                tag = data[at]
+                kind = tag & 0xf0
+                at += 1
+                if kind == RAW:
+                    n, at = read_varint(data, at)
+                    out.append(data[at:at+n])
+                    at += n
+                    continue
+                elif kind in (PUBLISH_DEFINE, PUBLISH_ALIAS):
+                    h = (PUBLISH << 4) | (tag & 0x0f)
+                    alias, at = read_varint(data, at)
+                    if kind == PUBLISH_DEFINE:
+                        n, at = read_varint(data, at)
+                        self._topics[alias] = data[at:at+n]
+                        at += n
+                    elif alias not in self._topics:
+                        self.unknown += 1
+                        raise CodecError("unknown topic alias {} in epoch {}".format(alias, self.epoch))
+                    topic = self._topics[alias]
+                    pid = b''
+                    if (h >> 1) & 3:
+                        p, at = read_varint(data, at)
+                        pid = bytes([p >> 8, p & 0xff])
+                    n, at = read_varint(data, at)
+                    body = bytes([len(topic) >> 8, len(topic) & 0xff]) + topic + pid + data[at:at+n]
+                    at += n
+                elif kind == PACKET_ID:
+                    h = ID_PACKETS[tag & 0x0f]
+                    p, at = read_varint(data, at)
+                    body = bytes([p >> 8, p & 0xff])
+                elif kind == EMPTY:
+                    h = EMPTY_PACKETS[tag & 0x0f]
+                    body = b''
+                elif kind == OTHER:
+                    h = data[at]
+                    n, at = read_varint(data, at + 1)
+                    body = data[at:at+n]
+                    at += n
+                else:
+                    raise CodecError("unknown record {:02x}".format(tag))
+                out.append(bytes([h]) + varint(len(body)) + body)
+                self.packets += 1
+        except IndexError:
+            raise CodecError("truncated record")
+        r = b''.join(out)
+        self.bytes_in += len(data)
+        self.bytes_out += len(r)
+        return r
+
+    def stats(self):
+        return {'packets': self.packets,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'aliases': len(self._topics),
+                'epoch': self.epoch,
+                'unknown': self.unknown}
+
+if __name__=="__main__":
+    #test
+    
+    def publish(topic, payload, qos = 0, pid = 0):
+        vh = bytes([len(topic) >> 8, len(topic) & 0xff]) + topic
+        if qos:
+            vh += bytes([pid >> 8, pid & 0xff])
+        return bytes([0x30 | qos << 1]) + varint(len(vh) + len(payload)) + vh + payload
+    
+    random.seed(1)
+    connect = b'\x00\x04MQTT\x04\x02\x00\x3c\x00\x02id'
+    packets = [b'\x10' + varint(len(connect)) + connect,
+               b'\x82\x08\x00\x01\x00\x03a/b\x00',
+               b'\xc0\x00', b'\xd0\x00', b'\x40\x02\x01\x02']
+    for i in range(200):
+        packets.append(publish(b'sensors/%d/temp' % (i % 7), b'%d' % i, i % 3, i))
+    # not the shortest remaining length, sent as it is
+    packets.append(b'\x30\x85\x00\x00\x01a\x01\x02')
+    packets.append(publish(b'big', bytes(MAX_PACKET)))
+    packets.append(b'\xe0\x00')
+    stream = b''.join(packets)
+    
+    # whole packets, in whatever pieces they are read in
+    e = Encoder()
+    d = Decoder()
+    out = []
+    at = 0
+    while at < len(stream):
+        n = random.choice((1, 2, 7, 100, 5000))
+        m = e.encode(stream[at:at+n])
+        at += n
+        if len(m) > 0:
+            assert is_encoded(m)
+            out.append(d.decode(m))
+    assert b''.join(out) == stream
+    assert list(split_packets(stream)) == packets
+    # the big one passed through, the odd one went as a RAW record
+    assert e.packets == len(packets) - 1 and e.raw == 1 and not e.passthrough, e.stats()
+    assert d.packets == e.packets - e.raw, d.stats()
+    assert e.encode(packets[5]) != packets[5] and len(e.encode(packets[5])) < len(packets[5])
+    
+    # an alias whose definition was lost
+    e = Encoder()
+    d = Decoder()
+    e.encode(publish(b'a/b', b'1'))
+    try:
+        d.decode(e.encode(publish(b'a/b', b'2')))
+        assert False, "unknown alias decoded"
+    except CodecError:
+        pass
+    assert d.unknown == 1
+    # until the Encoder resets
+    e.reset()
+    assert d.decode(e.encode(publish(b'a/b', b'3'))) == publish(b'a/b', b'3')
+    
+    # anything that isn't MQTT goes as it is
+    e = Encoder()
+    d = Decoder()
+    assert d.decode(e.encode(b'\x00hello')) == b'\x00hello' and e.passthrough
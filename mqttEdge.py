@@ -0,0 +1,379 @@
+'''
+MQTT handling on the edge node, between the local clients and the radio.
+
+an Edge sits where the MQTT stream of the clients meets the xbee link.
+
+with pingresp it answers their PINGREQs itself while the link is healthy
+(the base station was heard from, or acked what we sent, within the
+client's keepalive). the keepalive in CONNECT is raised to keepalive
+seconds on its way to the broker, and the Edge sends a PINGREQ of its
+own when nothing else went up for that long, so idle clients cost the
+radio one ping every keepalive seconds instead of one each every few
+seconds. the broker's answers to those pings don't go on to the clients.
+when the link isn't healthy, PINGREQs go to the broker as usual, so
+clients still notice a dead link.
+
+with a journal (see journal.py) QoS 1 and 2 PUBLISHes from the clients
+are acked (PUBACK, or PUBREC and then PUBCOMP) as soon as they are on
+disk, and the Edge delivers them to the broker itself: up to inflight at
+a time, resent with DUP after retry seconds without an answer and again
+after every CONNACK. the broker's acks for them stop here. delivery is
+at least once: a message is only done in the journal once the broker
+acked it, so a crash in between sends it again.
+
+the Edge numbers what it sends with its own packet ids, so it also
+renumbers the clients' SUBSCRIBEs and UNSUBSCRIBEs and numbers the
+SUBACKs and UNSUBACKs back.
+'''
+
+import collections
+import logging
+import struct
+import threading
+import time
+
+import mqttCodec
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBACK = 0x40
+PUBREC = 0x50
+PUBREL = 0x62
+PUBCOMP = 0x70
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+UNSUBSCRIBE = 0xa2
+UNSUBACK = 0xb0
+PINGREQ = b'\xc0\x00'
+PINGRESP = b'\xd0\x00'
+DUP = 0x08
+
+def connect_keepalive(packet):
+    '''where the keepalive of the CONNECT packet is and its value, None
+       if it is malformed'''
+    try:
+        n, body = mqttCodec.remaining_length(packet, 0)
+        at = body + 2 + struct.unpack_from(">H", packet, body)[0] + 2
+        return at, struct.unpack_from(">H", packet, at)[0]
+    except (ValueError, TypeError, struct.error):
+        return None
+
+def packet_id_at(packet):
+    'where the packet id of the whole packet is, None if it has none'
+    n, body = mqttCodec.remaining_length(packet, 0)
+    if packet[0] >> 4 == mqttCodec.PUBLISH:
+        if packet[0] & 0x06 == 0 or n < 2:
+            return None
+        at = body + 2 + struct.unpack_from(">H", packet, body)[0]
+    else:
+        at = body
+    if at + 2 > len(packet):
+        return None
+    return at
+
+def packet_id(packet):
+    at = packet_id_at(packet)
+    if at == None:
+        return None
+    return struct.unpack_from(">H", packet, at)[0]
+
+def with_packet_id(packet, pid):
+    at = packet_id_at(packet)
+    return packet[:at] + struct.pack(">H", pid) + packet[at+2:]
+
+def ack(header, pid):
+    'the PUBACK, PUBREC, PUBREL or PUBCOMP for pid'
+    return bytes([header, 2]) + struct.pack(">H", pid)
+
+class Delivery():
+    'a journaled PUBLISH on its way to the broker'
+    def __init__(self, seq, packet):
+        self.seq = seq
+        self.packet = packet
+        self.qos = (packet[0] >> 1) & 3
+        # PUBREL is what goes once the broker sent PUBREC
+        self.released = False
+        # None to send it (again) as soon as we can
+        self.sent = None
+
+class Edge():
+    def __init__(self, up, down, healthy, keepalive = 300, pingresp = True, journal = None,
+                 inflight = 8, retry = 30):
+        '''up(data) sends data to the broker, down(data) to the clients and
+           healthy(seconds) is True if the link was working in the last
+           seconds. keepalive 0 leaves CONNECT alone and sends no pings.
+           pingresp answers PINGREQs here, journal is a journal.Journal
+           to keep QoS 1 and 2 PUBLISHes in until they are delivered.'''
+        self.LOG = logging.getLogger(__name__)
+        self._up = up
+        self._down = down
+        self._healthy = healthy
+        self.keepalive = keepalive
+        self.pingresp = pingresp
+        self.journal = journal
+        self.inflight = inflight
+        self.retry = retry
+
+        self._up_lock = threading.Lock()
+        self._down_lock = threading.Lock()
+        self._up_split = mqttCodec.Splitter()
+        self._down_split = mqttCodec.Splitter()
+        # what the clients asked for and what the broker was told, 0 until they CONNECT
+        self._client_keepalive = 0
+        self._broker_keepalive = 0
+        self._last_up = time.monotonic()
+        # PINGRESPs still to come for our own PINGREQs
+        self._own_pings = 0
+        # acks for the clients waiting for the end of a packet going down
+        self._later = []
+
+        # journaled messages not sent yet, and the ones sent by our packet id
+        self._todo = collections.deque()
+        self._deliveries = {}
+        # our packet ids of SUBSCRIBEs and UNSUBSCRIBEs to the clients' ones
+        self._renumbered = {}
+        self._next_id = 1
+        # QoS 2 packet ids of the clients that PUBREL is still to come for
+        self._received = set()
+        self._connected = False
+        if journal != None:
+            self._todo.extend(journal.pending())
+
+        self.answered = 0
+        self.forwarded = 0
+        self.keepalives = 0
+        self.acked = 0
+        self.delivered = 0
+        self.resent = 0
+
+        self._stop = threading.Event()
+        self._work = threading.Event()
+        self._thread = threading.Thread(name='Edge', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        self._work.set()
+        self._thread.join()
+        if self.journal != None:
+            self.journal.close()
+
+    def write(self, data):
+        'data from the clients'
+        self._up_lock.acquire()
+        try:
+            out = []
+            for whole, chunk in self._up_split.split(data):
+                if not whole:
+                    out.append(chunk)
+                elif chunk == PINGREQ and self.pingresp:
+                    if self._pong():
+                        self.answered += 1
+                        continue
+                    self.forwarded += 1
+                    out.append(chunk)
+                elif chunk[0] == CONNECT:
+                    out.append(self._connect(chunk))
+                elif self.journal == None:
+                    out.append(chunk)
+                elif chunk[0] >> 4 == mqttCodec.PUBLISH and chunk[0] & 0x06:
+                    # what came before goes first, we may have to wait for room
+                    self._send_up(out)
+                    out = []
+                    self._up_lock.release()
+                    try:
+                        self._store(chunk)
+                    finally:
+                        self._up_lock.acquire()
+                elif chunk[0] == PUBREL and len(chunk) == 4:
+                    pid = packet_id(chunk)
+                    self._received.discard(pid)
+                    self._send_down(ack(PUBCOMP, pid))
+                elif chunk[0] in (SUBSCRIBE, UNSUBSCRIBE) and packet_id_at(chunk) != None:
+                    pid = self._new_id()
+                    self._renumbered[pid] = packet_id(chunk)
+                    out.append(with_packet_id(chunk, pid))
+                else:
+                    out.append(chunk)
+            self._send_up(out)
+        finally:
+            self._up_lock.release()
+
+    def _send_up(self, out):
+        'send the chunks in out to the broker, with _up_lock held'
+        if len(out) > 0:
+            self._last_up = time.monotonic()
+            self._up(b''.join(out))
+
+    def _send_down(self, packet):
+        'send packet to the clients as soon as that is between two packets'
+        with self._down_lock:
+            if self._down_split.between():
+                self._down(packet)
+            else:
+                self._later.append(packet)
+
+    def _pong(self):
+        'answer a PINGREQ from the clients here if we can, with _up_lock held'
+        if self._client_keepalive == 0 or not self._healthy(self._client_keepalive):
+            return False
+        with self._down_lock:
+            # not in the middle of something big for the clients
+            if not self._down_split.between():
+                return False
+            self._down(PINGRESP)
+        return True
+
+    def _connect(self, packet):
+        'packet, with the keepalive the broker should expect from us'
+        self._own_pings = 0
+        self._connected = False
+        k = connect_keepalive(packet)
+        if k == None:
+            return packet
+        at, self._client_keepalive = k
+        self._broker_keepalive = self._client_keepalive
+        if (not self.pingresp or self.keepalive == 0 or self._client_keepalive == 0 or
+            self._client_keepalive >= self.keepalive):
+            return packet
+        self.LOG.info("client keepalive {}s, {}s to the broker".format(self._client_keepalive, self.keepalive))
+        self._broker_keepalive = self.keepalive
+        return packet[:at] + struct.pack(">H", self.keepalive) + packet[at+2:]
+
+    def _store(self, packet):
+        'journal a QoS 1 or 2 PUBLISH from the clients and ack it'
+        qos = (packet[0] >> 1) & 3
+        pid = packet_id(packet)
+        if qos == 2 and pid in self._received:
+            # a resend of one we have, it must not be delivered twice
+            self._send_down(ack(PUBREC, pid))
+            return
+        seq = self.journal.append(packet)
+        if seq == None:
+            # closed while it waited for room, the client will send it again
+            return
+        self._todo.append(seq)
+        self.acked += 1
+        if qos == 1:
+            self._send_down(ack(PUBACK, pid))
+        else:
+            self._received.add(pid)
+            self._send_down(ack(PUBREC, pid))
+        self._work.set()
+
+    def _new_id(self):
+        'a packet id none of ours in flight has'
+        while self._next_id in self._deliveries or self._next_id in self._renumbered:
+            self._next_id = self._next_id % 0xffff + 1
+        pid = self._next_id
+        self._next_id = self._next_id % 0xffff + 1
+        return pid
+
+    def proxy(self, data):
+        'data from the broker'
+        with self._down_lock:
+            out = []
+            for whole, chunk in self._down_split.split(data):
+                if not whole:
+                    out.append(chunk)
+                elif chunk == PINGRESP and self._own_pings > 0:
+                    self._own_pings -= 1
+                elif chunk[0] == CONNACK:
+                    if len(chunk) == 4 and chunk[3] == 0:
+                        self._connected = True
+                        # everything in flight goes again
+                        for d in self._deliveries.values():
+                            d.sent = None
+                        self._work.set()
+                    out.append(chunk)
+                elif self.journal != None and chunk[0] in (PUBACK, PUBREC, PUBCOMP) and len(chunk) == 4:
+                    self._acked(chunk[0], packet_id(chunk))
+                elif chunk[0] in (SUBACK, UNSUBACK) and packet_id(chunk) in self._renumbered:
+                    out.append(with_packet_id(chunk, self._renumbered.pop(packet_id(chunk))))
+                else:
+                    out.append(chunk)
+            if self._down_split.between():
+                out.extend(self._later)
+                self._later = []
+            if len(out) > 0:
+                self._down(b''.join(out))
+
+    def _acked(self, header, pid):
+        'the broker answered a delivery of ours, with _down_lock held'
+        d = self._deliveries.get(pid)
+        if d == None:
+            # from before a restart, or a duplicate
+            return
+        if header == PUBREC and d.qos == 2:
+            d.released = True
+            d.sent = None
+        elif (header == PUBACK and d.qos == 1) or (header == PUBCOMP and d.released):
+            del self._deliveries[pid]
+            self.journal.done(d.seq)
+            self.delivered += 1
+        self._work.set()
+
+    def _run(self):
+        'the Edge\'s thread, keepalives and deliveries'
+        while not self._stop.is_set():
+            self._work.wait(1.0)
+            self._work.clear()
+            with self._up_lock:
+                if not self._up_split.between():
+                    continue
+                self._keepalive()
+                if self.journal != None and self._connected:
+                    self._deliver()
+
+    def _keepalive(self):
+        'a PINGREQ when the broker would soon miss one, with _up_lock held'
+        # a little early, the broker allows one and a half times as long
+        if (not self.pingresp or self._broker_keepalive == 0 or
+            time.monotonic() - self._last_up < 0.9 * self._broker_keepalive):
+            return
+        with self._down_lock:
+            self._own_pings += 1
+        self.keepalives += 1
+        self._send_up([PINGREQ])
+
+    def _deliver(self):
+        'send journaled messages and resend what wasn\'t answered, with _up_lock held'
+        out = []
+        now = time.monotonic()
+        with self._down_lock:
+            for pid, d in self._deliveries.items():
+                if d.sent != None and now - d.sent < self.retry:
+                    continue
+                if d.released:
+                    out.append(ack(PUBREL, pid))
+                else:
+                    out.append(bytes([d.packet[0] | DUP]) + d.packet[1:])
+                if d.sent != None:
+                    self.resent += 1
+                d.sent = now
+            while len(self._todo) > 0 and len(self._deliveries) < self.inflight:
+                seq = self._todo.popleft()
+                packet = self.journal.get(seq)
+                if packet == None:
+                    continue
+                pid = self._new_id()
+                d = Delivery(seq, with_packet_id(packet, pid))
+                d.sent = now
+                self._deliveries[pid] = d
+                out.append(d.packet)
+        self._send_up(out)
+
+    def stats(self):
+        r = {'answered': self.answered,
+             'forwarded': self.forwarded,
+             'keepalives': self.keepalives,
+             'client_keepalive': self._client_keepalive}
+        if self.journal != None:
+            r.update({'acked': self.acked,
+                      'delivered': self.delivered,
+                      'resent': self.resent,
+                      'inflight': len(self._deliveries),
+                      'waiting': len(self._todo),
+                      'journal': self.journal.stats()})
+        return r
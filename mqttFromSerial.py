@@ -6,6 +6,8 @@ import os.path
 import sys
 
 logfile = os.path.splitext(sys.argv[0])[0] + ".log"
+# the radio's parameters, so the proxy restarts without asking for them all
+cachefile = os.path.splitext(sys.argv[0])[0] + ".radio"
 
 logging.basicConfig(level=logging.INFO,
                     handlers=(logging.StreamHandler(sys.stdout),
@@ -17,7 +19,7 @@ logging.basicConfig(level=logging.INFO,
 if __name__ == "__main__":
     pidfile.write()
     while True:
-        px = sProxy.SProxy('xbee:/dev/ttyUSB0:38400:8N1:True',
+        px = sProxy.SProxy('xbee:/dev/ttyUSB0:38400:8N1:True:cache=' + cachefile,
                            'tcpclient:amm042:1883')
         px.run(timeout=None)
     
@@ -0,0 +1,143 @@
+'''
+what to do with PUBLISHes on their way over the radio, by topic.
+
+topic filters are MQTT's, + matches one level and # any number of them
+at the end:
+
+    latest  a QoS 0 PUBLISH still waiting to be sent is replaced by a
+            newer one on the same topic, for topics where only the last
+            value matters. a topic only ever has one waiting.
+    drop    the PUBLISH isn't sent at all, for topics the far side
+            subscribes to (through a wildcard, say) but never uses. QoS 1
+            ones are acked here, QoS 2 ones still go.
+
+    xbee:/dev/ttyUSB0:38400:8N1:True:latest=sensors/+/temperature,status/#:drop=debug/#
+
+see sProxy.Link.
+'''
+
+import struct
+
+import mqttCodec
+from mqttEdge import ack, packet_id, PUBACK
+
+# topics whose decisions are remembered
+MAX_CACHE = 4096
+
+def matches(topic_filter, topic):
+    'True if topic (a str) matches topic_filter'
+    f = topic_filter.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(f):
+        if level == '#':
+            # not $SYS and the like, unless asked for
+            return i > 0 or not topic.startswith('$')
+        if i >= len(t):
+            return False
+        if level == '+':
+            if i == 0 and t[0].startswith('$'):
+                return False
+            continue
+        if level != t[i]:
+            return False
+    return len(f) == len(t)
+
+def publish_topic(packet):
+    'the topic of a whole PUBLISH packet as bytes, None if it isn\'t one'
+    if packet[0] >> 4 != mqttCodec.PUBLISH:
+        return None
+    try:
+        n, body = mqttCodec.remaining_length(packet, 0)
+        tlen = struct.unpack_from(">H", packet, body)[0]
+    except (ValueError, TypeError, struct.error):
+        return None
+    if body + 2 + tlen > len(packet):
+        return None
+    return packet[body+2:body+2+tlen]
+
+def qos(packet):
+    return (packet[0] >> 1) & 3
+
+class Policy():
+    def __init__(self, latest = (), drop = ()):
+        'latest and drop are lists of topic filters, see the module doc'
+        self.latest_filters = list(latest)
+        self.drop_filters = list(drop)
+        self._cache = {}
+
+        self.replaced = 0
+        self.dropped = 0
+
+    def _decide(self, topic):
+        '(latest, drop) for topic'
+        if topic not in self._cache:
+            if len(self._cache) >= MAX_CACHE:
+                self._cache = {}
+            t = topic.decode('utf-8', 'replace')
+            self._cache[topic] = (any(matches(f, t) for f in self.latest_filters),
+                                  any(matches(f, t) for f in self.drop_filters))
+        return self._cache[topic]
+
+    def latest(self, packet):
+        '''the topic to replace the waiting PUBLISH of with packet, None if
+           packet doesn't replace anything'''
+        topic = publish_topic(packet)
+        if topic == None or qos(packet) != 0 or not self._decide(topic)[0]:
+            return None
+        return topic
+
+    def drop(self, packet):
+        'True if packet is not to be sent'
+        topic = publish_topic(packet)
+        if topic == None or qos(packet) == 2:
+            return False
+        return self._decide(topic)[1]
+
+    def reply(self, packet):
+        'what to send back for a dropped packet, None if nothing'
+        if qos(packet) == 1 and packet_id(packet) != None:
+            return ack(PUBACK, packet_id(packet))
+        return None
+
+    def stats(self):
+        return {'replaced': self.replaced,
+                'dropped': self.dropped}
+
+if __name__=="__main__":
+    #test
+    assert matches('a/b', 'a/b') and not matches('a/b', 'a/c') and not matches('a/b', 'a/b/c')
+    assert matches('a/+/c', 'a/b/c') and matches('a/+/c', 'a//c') and not matches('a/+', 'a/b/c')
+    assert matches('a/#', 'a') and matches('a/#', 'a/b/c') and matches('#', 'a/b') and not matches('b/#', 'a/b')
+    assert not matches('#', '$SYS/x') and not matches('+/x', '$SYS/x') and matches('$SYS/#', '$SYS/x')
+    
+    def publish(topic, payload, q = 0, pid = 1):
+        body = struct.pack(">H", len(topic)) + topic + (struct.pack(">H", pid) if q else b'') + payload
+        return bytes([0x30 | q << 1, len(body)]) + body
+    
+    p = Policy(latest = ['sensors/+/temperature'], drop = ['debug/#'])
+    assert publish_topic(publish(b'a/b', b'x')) == b'a/b' and publish_topic(b'\xc0\x00') == None
+    assert p.latest(publish(b'sensors/1/temperature', b'20')) == b'sensors/1/temperature'
+    assert p.latest(publish(b'sensors/1/temperature', b'20', 1)) == None
+    assert p.latest(publish(b'sensors/1/humidity', b'20')) == None
+    assert p.drop(publish(b'debug/x', b'')) and p.drop(publish(b'debug/x', b'', 1))
+    assert not p.drop(publish(b'debug/x', b'', 2)) and not p.drop(publish(b'a', b''))
+    assert p.reply(publish(b'debug/x', b'', 1, 7)) == ack(PUBACK, 7)
+    assert p.reply(publish(b'debug/x', b'')) == None
+    
+    # a queue the way LinkedXbeeServer keeps one: the waiting PUBLISH of a
+    # latest topic is replaced in place, the rest is in order
+    pending = []
+    waiting = {}
+    for i in range(100):
+        packet = publish(b'sensors/%d/temperature' % (i % 3), b'%d' % i, (i // 50) % 2)
+        topic = p.latest(packet)
+        if topic != None and topic in waiting:
+            pending[waiting[topic]] = packet
+            p.replaced += 1
+            continue
+        if topic != None:
+            waiting[topic] = len(pending)
+        pending.append(packet)
+    assert p.replaced == 47
+    assert [x[-2:] for x in pending[:3]] == [b'48', b'49', b'47']
+    assert len(pending) == 53 and pending[3:] == [publish(b'sensors/%d/temperature' % (i % 3), b'%d' % i, 1) for i in range(50, 100)]
@@ -7,6 +7,8 @@ import os.path
 import sys
 
 logfile = os.path.splitext(sys.argv[0])[0] + ".log"
+# the radio's parameters, so the proxy restarts without asking for them all
+cachefile = os.path.splitext(sys.argv[0])[0] + ".radio"
 
 logging.basicConfig(level=logging.INFO,
                     handlers=(logging.StreamHandler(sys.stdout),
@@ -19,6 +21,6 @@ if __name__ == "__main__":
     pidfile.write()
     while True:
         px = sProxy.SProxy('tcpserver:localhost:9999',
-                           'xbee:/dev/ttyUSB0:38400:8N1:False')
+                           'xbee:/dev/ttyUSB0:38400:8N1:False:cache=' + cachefile)
         px.run(timeout=None)
         
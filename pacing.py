@@ -0,0 +1,172 @@
+'''
+tx pacing for an XBee.
+
+a Pacer is a token bucket that every frame sent over the air takes its
+size (plus the radio's per frame overhead) from before it goes out. the
+rate it refills at is adjusted from the tx_status of what was sent, AIMD
+style:
+
+    success                     the rate grows by increase bytes/s for
+                                about every second of traffic at that
+                                rate, unless the round trip shows frames
+                                queueing in the radio (rtt over
+                                queue_factor times the smallest seen)
+    retries > 0                 the rate grows no further for that frame
+    MAC/network ACK failure,    the rate is cut to decrease times itself
+    CCA failure or a timeout    (at most once per round trip)
+
+any other status (route not found, payload too large...) says nothing
+about the load on the channel and leaves the rate alone.
+
+XBeeDevice keeps one Pacer that all its senders share, so the proxy,
+xTP and pings together stay near what the link can carry.
+'''
+
+import threading
+import time
+
+SUCCESS = b'\x00'
+# statuses that mean the channel is busy or frames are being lost
+CONGESTED = (b'\x01', b'\x02', b'\x21')
+
+# api frame, address and option bytes the radio sends besides the data
+FRAME_OVERHEAD = 18
+
+class Pacer():
+    def __init__(self, rate = 2000.0, min_rate = 200.0, max_rate = 50000.0, burst = 512,
+                 increase = 250.0, decrease = 0.5, queue_factor = 2.0):
+        'rates are in bytes per second, burst is the bucket size in bytes'
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.queue_factor = queue_factor
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._last_decrease = 0
+
+        self.srtt = None
+        self.min_rtt = None
+
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, size):
+        '''take size bytes from the bucket without waiting. returns the cost
+           and how many seconds to wait before sending, for callers that 
+           can't block (see xbeeAsync.py).'''
+        cost = size + FRAME_OVERHEAD
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # a frame bigger than the bucket only has to wait for a full one
+            self._tokens -= cost
+            wait = 0
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+                self.waited += wait
+        return cost, wait
+
+    def acquire(self, size):
+        '''block until size bytes may be sent. returns the cost, which goes
+           back to on_status with the result.'''
+        cost, wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+        return cost
+
+    def _cut(self, now):
+        'multiplicative decrease, once per round trip'
+        rtt = self.srtt or 0
+        if now - self._last_decrease < rtt:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def on_status(self, status, cost, rtt = None, retries = 0):
+        'account for the tx_status of a frame acquire returned cost for'
+        with self._lock:
+            now = time.monotonic()
+            if rtt != None:
+                if self.min_rtt == None or rtt < self.min_rtt:
+                    self.min_rtt = rtt
+                if self.srtt == None:
+                    self.srtt = rtt
+                else:
+                    self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+            if status == SUCCESS:
+                self.successes += 1
+                self.retries += retries
+                queued = rtt != None and rtt > self.queue_factor * self.min_rtt
+                if retries == 0 and not queued:
+                    self.rate = min(self.max_rate, self.rate + self.increase * cost / self.rate)
+            elif status in CONGESTED:
+                self.failures += 1
+                self._cut(now)
+
+    def on_timeout(self):
+        'no tx_status came back at all'
+        with self._lock:
+            self.timeouts += 1
+            self._cut(time.monotonic())
+
+    def stats(self):
+        return {'rate': self.rate,
+                'srtt': self.srtt,
+                'min_rtt': self.min_rtt,
+                'successes': self.successes,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'retries': self.retries,
+                'waited': self.waited}
+
+if __name__=="__main__":
+    #test
+    p = Pacer(rate = 1000, increase = 100, burst = 2000)
+    
+    # about a second of traffic grows the rate by about increase
+    sent = 0
+    while sent < 1000:
+        cost = p.acquire(82)
+        p.on_status(SUCCESS, cost, rtt = 0.1)
+        sent += cost
+    assert 1090 < p.rate < 1110, p.rate
+    
+    # retries, frames queueing in the radio or other failures don't grow it
+    rate = p.rate
+    p.on_status(SUCCESS, p.acquire(82), rtt = 0.1, retries = 1)
+    p.on_status(SUCCESS, p.acquire(82), rtt = 0.5)
+    p.on_status(b'\x24', p.acquire(82), rtt = 0.1)
+    assert p.rate == rate
+    
+    # a burst of failures is cut once a round trip
+    p.srtt = 10.0
+    p.on_status(CONGESTED[0], p.acquire(82))
+    p.on_status(CONGESTED[1], p.acquire(82))
+    p.on_timeout()
+    assert p.rate == rate * 0.5
+    assert p.failures == 2 and p.timeouts == 1
+    
+    # but again when the round trip is over, down to min_rate
+    p.srtt = 0.0
+    for i in range(10):
+        p.on_timeout()
+    assert p.rate == p.min_rate
+    
+    # a full bucket goes without waiting, then it takes the rate
+    p = Pacer(rate = 1000, burst = 500)
+    assert p.reserve(500 - FRAME_OVERHEAD)[1] == 0
+    cost, wait = p.reserve(100 - FRAME_OVERHEAD)
+    assert cost == 100 and 0.09 < wait <= 0.1
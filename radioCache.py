@@ -0,0 +1,106 @@
+'''
+what an XBeeDevice learned about its radio, kept between runs.
+
+a JSON file with an entry per serial port and radio serial number (SL),
+the AT parameters the radio was seen to have, read or set, in hex:
+
+    {"/dev/ttyUSB0:38400:8N1": {"40a1b2c3": {"SH": "0013a200", "SL": "40a1b2c3",
+                                             "RO": "21", "CM": "ffffffffffffffff", ...}}}
+
+an XBeeDevice opened with a cache asks the radio for SL and its reset
+check (xbeeDevice.RESET_CHECK, RO) only. the check is set on every open
+without WR, so a radio that was reset since has its saved value instead.
+when there is an entry for that SL with that check it takes the rest from
+the entry, and set_param doesn't send what the radio already has.
+
+that can't tell a reset radio whose settings were saved (with WR, from
+XCTU say) while it had the check value: the settings made without WR are
+taken from the cache although the radio lost them, and set_param skips
+them. delete the file after saving a radio's settings.
+
+the file is rewritten whole, through a temporary file and a rename, each
+time an entry changes.
+'''
+
+import json
+import logging
+import os
+import threading
+
+class RadioCache():
+    def __init__(self, filename):
+        self.LOG = logging.getLogger(__name__)
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f)
+        except (ValueError, OSError) as x:
+            self.LOG.warn("{}: ignored, {}".format(self.filename, x))
+            return {}
+
+    def get(self, port, serial, check = None):
+        '''the parameters of the radio with serial number serial (SL, bytes)
+           on port, as bytes by command, None if it isn't known or, given
+           check (command, value), the radio had another value for command'''
+        with self._lock:
+            entry = self._load().get(port, {}).get(serial.hex())
+        if entry == None:
+            return None
+        params = {k.encode(): bytes.fromhex(v) for k, v in entry.items()}
+        if check != None and params.get(check[0]) != check[1]:
+            return None
+        return params
+
+    def put(self, port, serial, params):
+        'remember params (bytes by command) for the radio serial on port'
+        with self._lock:
+            cache = self._load()
+            cache.setdefault(port, {})[serial.hex()] = {k.decode(): v.hex() for k, v in params.items()}
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filename)
+
+if __name__=="__main__":
+    #test
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as d:
+        c = RadioCache(os.path.join(d, 'radios.json'))
+        port = '/dev/ttyUSB0:38400:8N1'
+        sl = bytes.fromhex('40a1b2c3')
+        params = {b'SL': sl, b'SH': bytes.fromhex('0013a200'), b'RO': b'\x21', b'TO': b'\x40',
+                  b'CM': b'\xff' * 8}
+        assert c.get(port, sl) == None
+        c.put(port, sl, params)
+        
+        # another instance reads the same file
+        c = RadioCache(c.filename)
+        assert c.get(port, sl) == params and c.get(port, sl, (b'RO', b'\x21')) == params
+        # a radio reset since, one that didn't answer, another radio or port
+        assert c.get(port, sl, (b'RO', b'\x03')) == None
+        assert c.get(port, sl, (b'RO', b'')) == None
+        assert c.get(port, bytes.fromhex('40a1b2c4')) == None
+        assert c.get('/dev/ttyUSB1:38400:8N1', sl) == None
+        
+        # an 802.15.4 radio rejects TO, it still has the check
+        s1 = {b'SL': sl, b'MY': b'\x12\x34', b'RO': b'\x21', b'CM': b'\xff\xfe'}
+        c.put('/dev/ttyUSB1:38400:8N1', sl, s1)
+        assert c.get('/dev/ttyUSB1:38400:8N1', sl, (b'RO', b'\x21')) == s1
+        # and the new entry leaves the others
+        assert c.get(port, sl) == params
+        assert os.listdir(d) == ['radios.json']
+        
+        # a file that isn't JSON is ignored, and replaced on put
+        with open(c.filename, 'w') as f:
+            f.write('{"')
+        assert c.get(port, sl) == None
+        c.put(port, sl, params)
+        assert c.get(port, sl, (b'RO', b'\x21')) == params
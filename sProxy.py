@@ -10,6 +10,10 @@ import socket
 import traceback
 from socketserver import ThreadingTCPServer
 from xbeeServer import LinkedXbeeServer
+import compression
+import mqttEdge
+import journal
+import mqttPolicy
 
 class TCPServerHandler(socketserver.BaseRequestHandler):
     def handle(self):
@@ -107,8 +111,13 @@ class ProxyTCPClient():
                         self._handle_request_noblock()
             
         finally:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
+            if self.socket != None:
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.socket.close()
+                self.socket = None
             
             self.__shutdown_request = False
             self.__is_shut_down.set()
@@ -230,14 +239,125 @@ class LinkedProxySerialServer():
                                                             data))
         self.serial.write(data)
         
+def start_tcpclient(server_address, link, name):
+    'a running ProxyTCPClient that passes what it reads to link.proxy'
+    c = ProxyTCPClient(server_address, link)
+    t = threading.Thread(name='ProxyTCPClient-{}'.format(name), target=c.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return c
+
+def xbee_server(args, link, server_class = LinkedXbeeServer):
+    '''the LinkedXbeeServer (or server_class) for the split url of an xbee
+       link (see Link), whether it keeps a session per remote and the 
+       mqttEdge.Edge in front of it, None if there is none. what it 
+       receives goes to link.proxy, or link._proxy through the edge.'''
+    port = args[1]
+    baudrate = int(args[2])
+    bytesize = int(args[3][0])
+    parity = args[3][1]
+    stopbits = int(args[3][2])                   
+    basestation = args[4].lower() == 'true'
+    # anything after that is key=value options
+    opts = dict(a.split("=", 1) for a in args[5:])
+    fec = None
+    if 'fec' in opts:
+        fec = tuple(int(i) for i in opts['fec'].split("/"))
+    zdict = None
+    if 'zdict' in opts:
+        zdict = compression.load_zdict(opts['zdict'])
+    batch = None
+    if 'batch' in opts:
+        batch = int(opts['batch'])
+    window = None
+    if 'window' in opts:
+        window = int(opts['window'])
+    policy = None
+    if 'latest' in opts or 'drop' in opts:
+        policy = mqttPolicy.Policy([f for f in opts.get('latest', '').split(",") if f != ''],
+                                   [f for f in opts.get('drop', '').split(",") if f != ''])
+    
+    server = server_class( (port, baudrate, bytesize, parity, stopbits, basestation ), link,
+                               fec = fec, zdict = zdict, 
+                               delay = float(opts.get('delay', 0)) / 1000.0, batch = batch,
+                               window = window, rxq_size = int(opts.get('rxq', 256)),
+                               rxq_policy = opts.get('rxq_policy', 'drop_priority'),
+                               mqtt = opts.get('mqtt', 'false').lower() == 'true',
+                               priority = opts.get('priority', 'true').lower() == 'true',
+                               slo = float(opts.get('slo', 500)) / 1000.0,
+                               policy = policy, cache = opts.get('cache'))
+    sessions = basestation and opts.get('sessions', 'true').lower() == 'true'
+    edge = None
+    pingresp = opts.get('pingresp', 'false').lower() == 'true'
+    if not basestation and (pingresp or 'journal' in opts):
+        j = None
+        if 'journal' in opts:
+            j = journal.Journal(opts['journal'], int(opts.get('journal_size', 0x100000)))
+        edge = mqttEdge.Edge(server.write, link._proxy, server.healthy,
+                             keepalive = int(opts.get('keepalive', 300)), 
+                             pingresp = pingresp, journal = j,
+                             inflight = int(opts.get('inflight', 8)),
+                             retry = float(opts.get('retry', 30)))
+    return server, sessions, edge
+                
 class Link():    
     '''
     loosely based on pylink.link by Salem Harrache and contributors.
     '''
     def __init__(self, url):
-        "url in the form tcpserver:0.0.0.0:port or /dev/ttyUSB:9600:8N1"
+        '''url in the form tcpserver:0.0.0.0:port or /dev/ttyUSB:9600:8N1 or
+           xbee:/dev/ttyUSB0:38400:8N1:basestation[:key=value...]
+           
+           xbee options:
+               fec=group/parity    send FEC parity, eg fec=8/2
+               zdict=filename      preset compression dictionary, both ends 
+                                   need the same file (see zdictTrain.py)
+               delay=ms            hold writes back up to ms to send them 
+                                   together (default 0, no coalescing)
+               batch=bytes         send held writes once about this many 
+                                   compressed bytes wait (default one frame)
+               window=n            fragments in flight at once (default the 
+                                   xbee's limit)
+               rxq=n               frames received that may wait to be handled
+               rxq_policy=policy   block, drop_oldest or drop_priority (the
+                                   default) when more than that arrive
+               mqtt=true           shorten MQTT headers and topics on air, 
+                                   used when both ends have it
+               priority=false      send MQTT acks and pings in the order 
+                                   they were written, not ahead of the rest
+               slo=ms              average latency of acks and pings above 
+                                   which other messages are slowed down 
+                                   for them (default 500)
+               latest=f1,f2...     a QoS 0 PUBLISH waiting to be sent on a 
+                                   topic matching one of these filters is 
+                                   replaced by a newer one, see mqttPolicy.py
+               drop=f1,f2...       PUBLISHes on matching topics aren't sent
+               pingresp=true       on a remote node, answer the clients' 
+                                   PINGREQs here while the link works, see
+                                   mqttEdge.py
+               keepalive=s         with pingresp, the keepalive the broker 
+                                   is asked for and pinged at (default 300)
+               journal=file        on a remote node, ack the clients' QoS 1 
+                                   and 2 PUBLISHes once they are in file 
+                                   and deliver them from there
+               journal_size=bytes  most PUBLISH bytes the journal holds 
+                                   (default 1MB), the clients wait for room
+               inflight=n          journaled PUBLISHes sent to the broker at 
+                                   once (default 8)
+               retry=s             resend them after this long without an 
+                                   answer (default 30)
+               cache=file          keep the radio's address and parameters
+                                   in file, so reopening it takes a query
+                                   instead of a dozen, see radioCache.py
+               sessions=false      a base station bound to a tcpclient link 
+                                   opens a connection per remote node, this 
+                                   shares the one connection between them
+        '''
         args = url.split(":")
         self.remote = None
+        self.sessions = False
+        # MQTT handling on a remote node, see mqttEdge.py
+        self.edge = None
         self.name = "Link"
         self.LOG = logging.getLogger(__name__) 
         if args[0] == 'tcpserver':
@@ -269,15 +389,8 @@ class Link():
             self.name = "LinkSerial server on {}".format(self.link.serial.portstr)
             self.LOG.info("Started {}".format(self.name))
         elif args[0] == 'xbee':
-            port = args[1]
-            baudrate = int(args[2])
-            bytesize = int(args[3][0])
-            parity = args[3][1]
-            stopbits = int(args[3][2])                   
-            basestation = args[4].lower() == 'true'
-            
-            self.link = LinkedXbeeServer( (port, baudrate, bytesize, parity, stopbits, basestation ), self)
-            self.name = "XBee server on rf address {:x} [base={}]".format(self.link.address, basestation)
+            self.link, self.sessions, self.edge = xbee_server(args, self)
+            self.name = "XBee server on rf address {:x} [base={}]".format(self.link.address, self.link._basestation)
             self.LOG.info("Started {}".format(self.name))
         else:
             raise NotImplementedError("url format not supported")
@@ -294,8 +407,18 @@ class Link():
             data received on this link will be written to the other        
         '''
         self.remote = other
+        if self.sessions and isinstance(other.link, ProxyTCPClient):
+            # every remote node gets its own connection to the server
+            self.link.upstream = lambda addr, session: start_tcpclient(other.link.server_address, session,
+                                                                       "upstream for {:x}".format(addr))
         
     def proxy(self, data):
+        if self.edge != None:
+            self.edge.proxy(data)
+        else:
+            self._proxy(data)
+    
+    def _proxy(self, data):
         if self.remote:
             try:           
                 self.remote.write(data)
@@ -310,9 +433,14 @@ class Link():
     
     def write(self, data):
         'write data to our link'        
-        self.link.write(data)
+        if self.edge != None:
+            self.edge.write(data)
+        else:
+            self.link.write(data)
     def shutdown(self):
         self.LOG.warn("Shutdown for {}".format(self.name))
+        if self.edge != None:
+            self.edge.shutdown()
         self.link.shutdown()
                 
 class SProxy:    
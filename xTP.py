@@ -1,4 +1,5 @@
 import hashlib
+import struct
 class xTP:
     # message ids
     HELLO = b'\x08'
@@ -11,6 +12,19 @@ class xTP:
     
     MD5_CHECK = b'\x11'
     
+    SEND32_REQ_FEC = b'\x12' # SEND32_REQ plus fec group and parity
+    SEND32_PARITY = b'\x13'  # parity fragment, numbered like SEND32_DATA
+    SEND32_CDATA = b'\x14'   # SEND32_DATA with a varint fragment index
+    SEND32_CPARITY = b'\x15' # SEND32_PARITY with a varint fragment index
+    
+    # capabilities, sent as one byte after HELLO. a bare HELLO has none.
+    CAP_FEC = 0x01
+    CAP_COMPACT = 0x02
+    CAPS = CAP_FEC | CAP_COMPACT
+    
+# SEND32_DATA/SEND32_PARITY message id and 32 bit fragment index
+DATA_HEADER = struct.Struct(">cL")
+
 def md5file(filename):
     hash = hashlib.md5()         
     with open(filename, 'rb') as f:               
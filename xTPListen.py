@@ -18,7 +18,7 @@ from bitarray import bitarray
 import argparse
 import tempfile
 
-from xTP import xTP, md5file
+from xTP import xTP, md5file, DATA_HEADER
 from xbee.ieee import XBee as XBeeS1
 from xb900hp import XBee900HP
 
@@ -33,16 +33,22 @@ class XTPServer():
                                                  fragdata,
                                                  hexdump.dump(fragdata)))
 
-        if fragdata[0:1] == xTP.SEND32_REQ:
+        if fragdata[0:1] in (xTP.SEND32_REQ, xTP.SEND32_REQ_FEC):
             offset, total_size, tot, crc = struct.unpack(">LLLL", fragdata[1:17])
-            fname = fragdata[17:].decode('utf-8') + '.part'
+            fec = None
+            name_at = 17
+            if fragdata[0:1] == xTP.SEND32_REQ_FEC:
+                fec = struct.unpack(">BB", fragdata[17:19])
+                name_at = 19
+            fname = fragdata[name_at:].decode('utf-8') + '.part'
             self.transfers[srcaddr] = {'filename': fname,
                                        'crc': crc,
                                        'offset': offset,
                                        'total_frags': tot,
                                        'total_size': total_size,
                                        'frag_mask': bitarray(tot),
-                                       'frags': {},
+                                       'message': frag.PartialMessage(tot, crc, fec),
+                                       'fec': fec,
                                        'status': fragdata[0]}
             t = self.transfers[srcaddr]
             t['frag_mask'].setall(0)
@@ -52,8 +58,8 @@ class XTPServer():
             os.makedirs(outpath, exist_ok=True)
 
             t['oid'] = StatsBeginXfr(t)
-            logging.info("Begin transfer {} of {}: {}".format(t['offset'], t['total_size'],
-                                                              t['filename']))
+            logging.info("Begin transfer {} of {}: {} [fec={}]".format(t['offset'], t['total_size'],
+                                                              t['filename'], fec))
             self.txq.put((srcaddr, xTP.SEND32_BEGIN))
         elif fragdata[0:1] == xTP.MD5_CHECK and srcaddr in self.transfers:
             remotehash = fragdata[1:17]
@@ -108,16 +114,31 @@ class XTPServer():
                             trslt['success'],
                             trslt['total']),
                         trslt)
-        elif fragdata[0:1] == xTP.SEND32_DATA and srcaddr in self.transfers:
-            i = struct.unpack(">L", fragdata[1:5])[0]
-            logging.debug("  got frag {}/{}".format(i, self.transfers[srcaddr]['total_frags']))
-            self.transfers[srcaddr]['frags'][i] = fragdata[5:]
-            self.transfers[srcaddr]['frag_mask'][i] = True
+        elif fragdata[0:1] in (xTP.SEND32_DATA, xTP.SEND32_PARITY, 
+                               xTP.SEND32_CDATA, xTP.SEND32_CPARITY) and srcaddr in self.transfers:
+            if fragdata[0:1] in (xTP.SEND32_CDATA, xTP.SEND32_CPARITY):
+                i, at = frag.read_varint(fragdata, 1)
+            else:
+                i = DATA_HEADER.unpack_from(fragdata)[1]
+                at = DATA_HEADER.size
+            t = self.transfers[srcaddr]
+            recovered = len(t['message'].recovered)
+            # copied once, straight into the preallocated chunk buffer
+            if fragdata[0:1] in (xTP.SEND32_PARITY, xTP.SEND32_CPARITY):
+                logging.debug("  got parity {} for {} frags".format(i, t['total_frags']))
+                t['message'].add(t['total_frags'] + i, memoryview(fragdata)[at:])
+            else:
+                logging.debug("  got frag {}/{}".format(i, t['total_frags']))
+                t['message'].add(i, memoryview(fragdata)[at:])
+                t['frag_mask'][i] = t['message'].have[i] == 1
+            # fragments rebuilt from parity are acked like received ones
+            for k in t['message'].recovered[recovered:]:
+                logging.debug("  recovered frag {}/{}".format(k, t['total_frags']))
+                t['frag_mask'][k] = True
             if self.transfers[srcaddr]['frag_mask'].all() and not self.transfers[srcaddr]['status'] == xTP.SEND32_DONE:
-                r = b''
-                for i in range(self.transfers[srcaddr]['total_frags']):
-                    r += self.transfers[srcaddr]['frags'][i]
-                mycrc = zlib.crc32(r)
+                r = self.transfers[srcaddr]['message'].getvalue()
+                # mostly folded in as the fragments arrived
+                mycrc = self.transfers[srcaddr]['message'].crc32()
                 self.transfers[srcaddr]['status'] = xTP.SEND32_DONE
 
                 if mycrc == self.transfers[srcaddr]['crc']:
@@ -166,7 +187,7 @@ class XTPServer():
         #self.xbee.send_cmd("at", command=b'MY', parameter=b'\x15\x15')
 
         # mode 1 = 802.15.4 NO ACKs
-        self.xbee.send_cmd("at", command=b'MM', parameter=b'\x01')
+        self.xbee.set_param(b'MM', b'\x01')
 
         #self.xbee.send_cmd("at", command=b'MM', parameter=b'\x02')
         #self.xbee.send_cmd("at", command=b'CH')
@@ -201,7 +222,7 @@ class XTPServer():
 
         while True:
             if datetime.datetime.now() - self.last_activity > self.beacon_time:
-                self.txq.put((0xffff, xTP.HELLO))
+                self.txq.put((0xffff, xTP.HELLO + bytes([xTP.CAPS])))
             try:
                 dest, msg = self.txq.get(True, self.beacon_time.total_seconds())
                 self.send(dest=dest, data=msg)
@@ -220,6 +241,7 @@ if __name__ == "__main__":
     p.add_argument("-x", "--xbee", help="XBee variant",
                     choices=['S1', '900HP'], default='S1')
     p.add_argument("-m", "--cm", help="XBee Channel Mask [Hex] (900hp)", default =None)
+    p.add_argument("-c", "--cache", help="radio parameter cache file, see radioCache.py", default=None)
     xcls = {'S1': XBeeS1, '900HP': XBee900HP}
 
     args = p.parse_args()
@@ -233,10 +255,11 @@ if __name__ == "__main__":
 
     xtpsvr = None
     try:
-        xtpsvr = XTPServer(args.portstr, args.store, xcls[args.xbee], xbeeCM= int(args.cm,16))
+        xtpsvr = XTPServer(args.portstr, args.store, xcls[args.xbee], xbeeCM= int(args.cm,16),
+                           cache = args.cache)
 
-        xtpsvr.xbee.send_cmd("at", command=b'HP', parameter=b'\x03')
-        xtpsvr.xbee.send_cmd("at", command=b'PL', parameter=b'\x04')
+        xtpsvr.xbee.set_param(b'HP', b'\x03')
+        xtpsvr.xbee.set_param(b'PL', b'\x04')
         xtpsvr.run_forever()
     finally:
         if xtpsvr != None:
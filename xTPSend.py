@@ -12,9 +12,10 @@ import threading
 from bitarray import bitarray
 import struct
 import argparse
+import math
 
 
-from xTP import xTP, md5file
+from xTP import xTP, md5file, DATA_HEADER
 from xbee.ieee import XBee as XBeeS1
 from xb900hp import XBee900HP
      
@@ -33,6 +34,8 @@ class XTPClient():
             self.have_response[data[0:1]]['e'].set()                   
         elif data[0:1] == xTP.HELLO:
             self.remote = srcaddr
+            # older servers send a bare HELLO
+            self.remote_caps = data[1] if len(data) > 1 else 0
             self.have_remote.set()    
         elif data[0:1] == xTP.SEND32_BEGIN:
             self.begin_transfer.set()
@@ -51,14 +54,15 @@ class XTPClient():
             logging.warn("RX -- unknown message format ({:x})".format(data[0]))        
         
             
-    def __init__(self, portstr, xbeeclass):
-        self.xbee = XBeeDevice(portstr, self.rx, xbeeclass)        
+    def __init__(self, portstr, xbeeclass, **kwargs):
+        self.xbee = XBeeDevice(portstr, self.rx, xbeeclass, **kwargs)        
         #self.xbee.send_cmd("at", command=b'MY', parameter=b'\x16\x16')
         
         logging.info("my address: {:x}".format(self.xbee.address))
         logging.info("MTU: {}".format(self.xbee.mtu))
                 
         self.remote = None
+        self.remote_caps = 0
         self.have_remote = threading.Event()
         self.begin_transfer = threading.Event()
         self.have_acks = threading.Event()
@@ -70,7 +74,7 @@ class XTPClient():
         #self.have_remote.set()
         
         # mode 1 = 802.15.4 NO ACKs
-        self.xbee.send_cmd("at", command=b'MM', parameter=b'\x01')
+        self.xbee.set_param(b'MM', b'\x01')
               
         #self.xbee.send_cmd("at", command=b'CH')
         #self.xbee.send_cmd("at", command=b'ID')
@@ -80,22 +84,50 @@ class XTPClient():
         
         self.remote_timeout = datetime.timedelta(seconds=30)
 
-    def send(self, data, remote_filename, filesize, offset = 0, dest=0xffff):
-        "send with fragmentation, returns true on success"
+    def send(self, data, remote_filename, filesize, offset = 0, dest=0xffff, fec = None):
+        '''send with fragmentation, returns true on success.
+           fec is None or (group, parity) to add parity fragments, see 
+           fragmentation16.make_parity. it is ignored if the remote can't 
+           decode them.'''
         
         start = datetime.datetime.now()
         self.last_activity = datetime.datetime.now()
+        
+        if fec != None and not self.remote_caps & xTP.CAP_FEC:
+            logging.info("Remote does not support fec, sending without.")
+            fec = None
+                
+        compact = self.remote_caps & xTP.CAP_COMPACT
                 
         # mtu seems imprecise. (does not include headers)        
-        frags = list(frag.make_frags(data, threshold=self.xbee.mtu - 8, encode = False))
+        threshold = self.xbee.mtu - 8
+        if compact:
+            # same frame size, with the message id and a varint index 
+            # instead of the 5 byte DATA_HEADER
+            n = math.ceil(len(data) / float(threshold))
+            if fec != None:
+                n += math.ceil(n / float(fec[0])) * fec[1]
+            threshold += DATA_HEADER.size - 1 - len(frag.varint(n))
+        if fec != None:
+            # parity payloads carry the xor of the fragment lengths too
+            threshold -= frag.PARITY_LEN.size
+        frags = list(frag.make_frags(data, threshold=threshold, encode = False))
+        parity = []
+        if fec != None:
+            parity = list(frag.make_parity([f.data for f in frags], fec[0], fec[1], threshold))
         
         self.begin_transfer.clear()
         self.have_acks.clear()
         ok_begin = False                
         for i in range(self.retries):            
-            msg = xTP.SEND32_REQ + struct.pack(">LLLL", 
-                              offset, filesize, frags[0].total, frags[0].crc) + \
-                              remote_filename.encode("utf-8")
+            if fec == None:
+                msg = xTP.SEND32_REQ + struct.pack(">LLLL", 
+                                  offset, filesize, frags[0].total, frags[0].crc) + \
+                                  remote_filename.encode("utf-8")
+            else:
+                msg = xTP.SEND32_REQ_FEC + struct.pack(">LLLLBB", 
+                                  offset, filesize, frags[0].total, frags[0].crc, fec[0], fec[1]) + \
+                                  remote_filename.encode("utf-8")
             
             logging.debug("TX SEND32_REQ {}/{} [{:x}->{:x}]: {}".format(i, self.retries,
                                     self.xbee.address,
@@ -126,14 +158,30 @@ class XTPClient():
             for i,f in enumerate(frags):
                 if self.acks[i] == False:
                     txcnt += 1 
-                    d = xTP.SEND32_DATA + struct.pack(">L", i) + f.data
+                    # header and memoryview payload are gathered by the xbee
+                    if compact:
+                        d = (xTP.SEND32_CDATA + frag.varint(i), f.data)
+                    else:
+                        d = (DATA_HEADER.pack(xTP.SEND32_DATA, i), f.data)
                     e = self.xbee.send(data=d,
                                        dest=dest)
                     
-                    logging.debug("TX SEND32_DATA {}/{} [{:x}->{:x}][{}]: {}".format(i, len(frags),
-                                            self.xbee.address,
-                                            dest,
-                                            e.fid, hexdump.dump(d)))
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        logging.debug("TX SEND32_DATA {}/{} [{:x}->{:x}][{}]: {}".format(i, len(frags),
+                                                self.xbee.address,
+                                                dest,
+                                                e.fid, hexdump.dump(b''.join(d))))
+            
+            if j == 0:
+                # parity only goes with the first pass, later passes resend
+                # exactly what is missing
+                for g, k, p in parity:
+                    txcnt += 1
+                    if compact:
+                        d = (xTP.SEND32_CPARITY + frag.varint(g*fec[1] + k), p)
+                    else:
+                        d = (DATA_HEADER.pack(xTP.SEND32_PARITY, g*fec[1] + k), p)
+                    e = self.xbee.send(data=d, dest=dest)
             if txcnt == 0:
                 logging.warn("TX complete due to no packets to send")
                 return True # must have worked.
@@ -173,7 +221,7 @@ class XTPClient():
         
         return False                         
 
-    def send_file(self, filename, remote_filename = None):
+    def send_file(self, filename, remote_filename = None, fec = None):
         if remote_filename == None:
             remote_filename = filename
         
@@ -196,7 +244,8 @@ class XTPClient():
                                   remote_filename=remote_filename,                                  
                                   offset = pos,
                                   filesize= os.path.getsize(filename), 
-                                  dest=self.remote)):
+                                  dest=self.remote,
+                                  fec=fec)):
                                 pos += len(data)
                                 success = True
                                 break
@@ -259,9 +308,15 @@ if __name__ == "__main__":
                     choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'], default = 'INFO')
     p.add_argument("-x", "--xbee", help="XBee variant", 
                     choices=['S1', '900HP'], default='S1')
+    p.add_argument("-f", "--fec", help="forward error correction as group/parity eg: 16/2",
+                    default=None)
+    p.add_argument("-c", "--cache", help="radio parameter cache file, see radioCache.py", default=None)
     xcls = {'S1': XBeeS1, '900HP': XBee900HP}    
     
     args = p.parse_args()
+    fec = None
+    if args.fec != None:
+        fec = tuple(int(i) for i in args.fec.split("/"))
     logfile = os.path.splitext(os.path.basename(sys.argv[0]))[0] + ".log"
     logging.basicConfig(level=logging.getLevelName(args.debug),
                     handlers=(logging.StreamHandler(sys.stdout),
@@ -272,7 +327,7 @@ if __name__ == "__main__":
         
     xtp = None
     try:        
-        xtp = XTPClient(args.portstr, xcls[args.xbee])
+        xtp = XTPClient(args.portstr, xcls[args.xbee], cache = args.cache)
         
         time.sleep(0.5)
         for filename in args.file:
@@ -280,7 +335,7 @@ if __name__ == "__main__":
             
             start = datetime.datetime.now()
             
-            if xtp.send_file(filename):
+            if xtp.send_file(filename, fec=fec):
                 result = xtp.verify(filename)
                 t = (datetime.datetime.now() - start).total_seconds()
                 sz = os.path.getsize(filename)
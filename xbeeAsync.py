@@ -0,0 +1,455 @@
+'''
+an XBeeDevice for asyncio.
+
+AsyncXBeeDevice reads the serial port from the event loop (add_reader)
+instead of python-xbee's thread, and the frames that wait for a response
+wait on futures:
+
+    dev = AsyncXBeeDevice('/dev/ttyUSB0:38400:8N1', rx, XBee900HP)
+    await dev.open()
+    f = await dev.send(b'hello', dest=0x1234)   # once it is written
+    pkt = await dev.wait(f)                      # its tx_status
+    pkt = await dev.sendwait(b'hello', dest=0x1234)
+
+send waits for room in the window and for the pacer without blocking the
+loop, so several coroutines can send at once and any of them can be
+cancelled or put under asyncio.wait_for. rxcallback(dev, source, data) is
+called on the loop.
+
+the window, frame ids and pacing are XBeeDevice's.
+
+AsyncXbeeServer is xbeeServer's LinkedXbeeServer on one: what it receives
+is handled on the loop as it arrives, and its tx scheduler is a task
+instead of a thread. asyncProxy serves xbee links with it.
+'''
+
+import asyncio
+import struct
+import time
+
+import serial
+
+import xbeeDevice
+import xbeeFrames
+from xbeeDevice import XBeeDevice, XBeeDied
+from xbeeServer import LinkedXbeeServer, BULK
+
+class AsyncXBeeDevice(XBeeDevice):
+    def __init__(self, portstr, rxcallback, xbeeclass, loop = None, **kwargs):
+        '''like XBeeDevice, but nothing is sent until open(). loop is the
+           event loop, the running one by default.'''
+        self._in_init = True
+        self._setup(portstr, rxcallback, xbeeclass, kwargs)
+        self._loop = loop
+        self._xbee = None
+        self._closed = False
+
+    async def open(self, xbeeCM = None):
+        'open the serial port and read the radio\'s address, xbeeCM is a channel mask to set'
+        if self._loop == None:
+            self._loop = asyncio.get_event_loop()
+        try:
+            await self._mkxbee()
+            if xbeeCM != None:
+                if await self.set_param(b'CM', struct.pack(">Q", xbeeCM)) != None:
+                    await self.send_cmd("at", command=b'CM')
+                    await self.flush()
+        except Exception as x:
+            self.close()
+            raise x
+        self._in_init = False
+        return self
+
+    async def _mkxbee(self):
+        self._slots = [xbeeDevice.Slot(i) for i in range(0x100)]
+        self._busy = 0
+        # set whenever a frame stops waiting for its response
+        self._room = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self._timeout_err_cnt = 0
+        self._channel_mask = 0
+        self._channel_cache= {}
+
+        self.log.debug("Opening serial: " + self._portstr)
+        dev, baud, opts = self._portstr.split(":")
+        # reads never block, they only happen when the loop says there is data
+        self._serial = serial.Serial(dev, baudrate=int(baud),
+                                     bytesize=int(opts[0]),
+                                     parity=opts[1],
+                                     stopbits=int(opts[2]),
+                                     timeout=0)
+        # without a callback python-xbee starts no thread, it only builds
+        # and splits frames
+        self._xbee = self._xbeeclass(self._serial, escaped=True)
+        self._parser = xbeeFrames.Parser(self._xbee.api_responses, self._xbee)
+        self._builder = xbeeFrames.Builder(self._xbee.api_commands)
+        # frames waiting to be written together, like xbeeFrames.Writer
+        self._out = []
+        self._out_size = 0
+        self._out_handle = None
+        self._last_write = 0
+        self._loop.add_reader(self._serial.fileno(), self._readable)
+
+        self._addrlen=2
+        for part in self._xbee.api_commands['tx']:
+            if part['name'] == 'dest_addr':
+                self._addrlen = part['len']
+
+        if self._cache != None:
+            sl = await self.send_cmd("at", command=b'SL')
+            check = await self.send_cmd("at", command=xbeeDevice.RESET_CHECK[0])
+            if self._from_cache(await self.wait(sl), await self.wait(check)):
+                return
+
+        await self.send_cmd("at", command=xbeeDevice.RESET_CHECK[0], parameter=xbeeDevice.RESET_CHECK[1])
+        # point to multipoint
+        await self.send_cmd("at", command=b'TO', parameter=b'\x40')
+        await self.send_cmd("at", command=b'CM')
+        if self._addrlen == 2:
+            await self.send_cmd("at", command=b"MY")
+        elif self._addrlen == 8:
+            await self.send_cmd("at", command=b'SL')
+            await self.send_cmd("at", command=b'SH')
+        await self.flush()
+        self._save_cache()
+
+    async def set_param(self, command, parameter):
+        '''set the AT parameter command to parameter unless the radio has it
+           already, returns the answer, None if nothing was sent'''
+        if self._has(command, parameter):
+            return None
+        f = await self.send_cmd("at", command=command, parameter=parameter)
+        pkt = await self.wait(f)
+        self._save_cache()
+        return pkt
+
+    async def flush(self):
+        'wait for every frame sent to be answered'
+        try:
+            await asyncio.wait_for(self._idle.wait(), self._timeout.total_seconds())
+        except asyncio.TimeoutError:
+            self._timeout_err_cnt += 1
+            for slot in self._slots:
+                if slot.busy:
+                    self._free(slot)
+            self.pacer.on_timeout()
+            if self._timeout_err_cnt > XBeeDevice.MAX_TIMEOUTS:
+                raise XBeeDied("flush with too many timeouts")
+            raise TimeoutError("Flush timeout.")
+        self._timeout_err_cnt = 0
+
+    async def sendwait(self, data=None, atcmd = 'tx', timeout = None, **kwargs):
+        'send the message and wait for the result'
+        await self.flush()
+        f = await self.send(data=data, atcmd=atcmd, **kwargs)
+        return await self.wait(f, timeout)
+
+    async def wait(self, f, timeout = None):
+        '''the response to a frame sent with send or send_cmd, several can be
+           outstanding at once'''
+        if timeout == None:
+            timeout = self._timeout.total_seconds()
+        try:
+            # a timeout here leaves f to whoever else waits for it
+            pkt = await asyncio.wait_for(asyncio.shield(f), timeout)
+        except asyncio.TimeoutError:
+            self._timeout_err_cnt += 1
+            if self._timeout_err_cnt > XBeeDevice.MAX_TIMEOUTS:
+                raise XBeeDied("sendwait too many timeouts")
+            slot = self._slots[f.fid[0]]
+            if slot.busy and slot.event is f:
+                if slot.cost != None:
+                    self.pacer.on_timeout()
+                self._free(slot)
+            raise TimeoutError("Timeout sending message")
+        self._timeout_err_cnt = 0
+        return pkt
+
+    async def send(self, data=None, dest= 0xffff, atcmd='tx', **kwargs):
+        '''format and send a data packet, default to broadcast. returns,
+           once it is written, a future for its response'''
+        if isinstance(data, tuple):
+            data = list(data)
+
+        if self._addrlen == 2:
+            return await self.send_cmd(cmd=atcmd,
+                                       dest_addr=struct.pack(">H", dest),
+                                       data=data, **kwargs)
+        elif self._addrlen == 8:
+            return await self.send_cmd(cmd=atcmd,
+                                       dest_addr=struct.pack(">Q", dest),
+                                       data=data, **kwargs)
+        else:
+            raise Exception("Unsupported address length")
+
+    async def send_cmd(self, cmd, **kwargs):
+        cost = None
+        if 'data' in kwargs:
+            cost, wait = self.pacer.reserve(xbeeDevice.data_length(kwargs['data']))
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        f = self._loop.create_future()
+        if 'ack' not in kwargs or kwargs['ack'] == True:
+            slot = await self._take_slot()
+            slot.event = f
+            slot.cost = cost
+            slot.length = xbeeDevice.data_length(kwargs.get('data', b''))
+            slot.retries = 0
+            slot.sent = time.monotonic()
+            fid = slot.fid
+        else:
+            # frame id 0 is non acked, nothing will come back for it
+            fid = b'\x00'
+        f.fid = fid
+        self._note_setting(cmd, kwargs)
+
+        self.log.debug("xbee tx [{:x}, pid={}, fid={}]: {}".format(self.address, cmd, fid, kwargs))
+        self._write(self._builder.build(cmd, frame_id = fid, **kwargs))
+
+        if fid == b'\x00':
+            f.set_result(None)
+        return f
+
+    async def _take_slot(self):
+        'a free slot, once the window has room for it'
+        timeout = self._timeout.total_seconds()
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if self._busy >= int(self._window):
+                oldest = self._expire(now)
+            if self._busy < int(self._window):
+                break
+            if now >= deadline:
+                raise TimeoutError("Tx overrun -- are packets going out?")
+            self._room.clear()
+            try:
+                await asyncio.wait_for(self._room.wait(), min(deadline, oldest + timeout) - now)
+            except asyncio.TimeoutError:
+                pass
+        return self._claim_slot()
+
+    def _free(self, slot):
+        slot.busy = False
+        slot.event = None
+        self._busy -= 1
+        if self._busy == 0:
+            self._idle.set()
+        self._room.set()
+
+    def _complete(self, pkt):
+        cost = rtt = retries = None
+        slot = None
+        if 'frame_id' in pkt and len(pkt['frame_id']) == 1:
+            slot = self._slots[pkt['frame_id'][0]]
+        if slot != None and slot.busy:
+            rtt = time.monotonic() - slot.sent
+            cost = slot.cost
+            if 'retries' in pkt:
+                slot.retries = pkt['retries'][0]
+            retries = slot.retries
+            if not slot.event.done():
+                slot.event.set_result(pkt)
+            if pkt['id'] == 'tx_status' and cost != None:
+                self._adapt(pkt['status'], rtt)
+            self._free(slot)
+        return cost, rtt, retries
+
+    def _poll_rssi(self):
+        self._loop.create_task(self.send_cmd("at", command=b'DB'))
+
+    def _write(self, frame):
+        self._out.append(frame)
+        self._out_size += len(frame)
+        if self._out_size >= self._write_size:
+            self._flush_out()
+        elif self._out_handle == None:
+            self._out_handle = self._loop.call_later(max(0, self._last_write + self._write_delay - time.monotonic()),
+                                                     self._flush_out)
+
+    def _flush_out(self):
+        'write the frames that wait in one go'
+        if self._out_handle != None:
+            self._out_handle.cancel()
+            self._out_handle = None
+        if len(self._out) == 0 or self._serial == None:
+            return
+        data = b''.join(self._out)
+        self._out = []
+        self._out_size = 0
+        try:
+            self._serial.write(data)
+        except (serial.SerialException, OSError) as x:
+            self._on_error(x)
+            return
+        self._last_write = time.monotonic()
+
+    def _readable(self):
+        'the serial port has data, called by the loop'
+        try:
+            data = self._serial.read(max(1, self._serial.in_waiting))
+        except (serial.SerialException, OSError) as x:
+            self._on_error(x)
+            return
+        for pkt in self._parser.feed(data):
+            self._on_rx(pkt)
+
+    def _on_error(self, error):
+        self.log.warn('Failed with: {}'.format(str(error)))
+        self._out = []
+        self._out_size = 0
+        self._close_serial()
+        for slot in self._slots:
+            if slot.busy:
+                self._free(slot)
+        # reload xbee
+        if self._in_init == False and not self._closed:
+            self._loop.create_task(self._mkxbee())
+
+    def _close_serial(self):
+        ser = self._serial
+        self._serial = None
+        self._xbee = None
+        if ser != None:
+            self._loop.remove_reader(ser.fileno())
+            ser.close()
+
+    def close(self):
+        self._closed = True
+        if self._loop != None:
+            # what was sent still goes out
+            self._flush_out()
+            self._close_serial()
+
+class AsyncXbeeServer(LinkedXbeeServer):
+    '''a LinkedXbeeServer on an AsyncXBeeDevice, nothing is opened until
+       start(). write may be called from any thread, the rest from the
+       loop.'''
+    def _open(self, portstr, cache, xbeeclass):
+        self._portstr = portstr
+        self._cache = cache
+        self._xbeeclass = xbeeclass
+        self.xbee = None
+        self._loop = None
+        self._wake = None
+        self._tx_task = None
+    
+    async def start(self, loop = None):
+        'open the xbee, find the base station and start the tx task'
+        if loop == None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._wake = asyncio.Event()
+        self.xbee = AsyncXBeeDevice(self._portstr, self._rx, self._xbeeclass, loop, cache = self._cache)
+        await self.xbee.open()
+        
+        if self._basestation == False:
+            # discover the base station
+            for i in range(3):
+                await self.xbee.sendwait(b"HELLOBASESTATION", dest=0xffff)
+            
+            if self._remote_addr == None:
+                self.xbee.close()
+                raise Exception("No remote basestation could be found.")
+        
+        self._opened()
+        self._tx_task = self._loop.create_task(self._schedule())
+        return self
+    
+    def is_alive(self):
+        return self._tx_task != None and not self._tx_task.done()
+    
+    def shutdown(self):
+        'stop once what is waiting is sent, see wait_closed'
+        if self._loop != None:
+            self._loop.call_soon_threadsafe(self._stop)
+    
+    def _stop(self):
+        with self._pending_cv:
+            self._tx_stop = True
+        self._wake.set()
+    
+    async def wait_closed(self):
+        if self._tx_task != None:
+            await asyncio.gather(self._tx_task, return_exceptions=True)
+        for s in list(self._sessions.values()):
+            self._close_upstream(s)
+        if self.xbee != None:
+            self.xbee.close()
+    
+    def _close_upstream(self, session):
+        u = session.upstream
+        session.upstream = None
+        if u != None:
+            u.shutdown()
+    
+    def _received(self, xbee, source, data):
+        # nothing waits on the loop, so nothing has to queue
+        self._handle_request_noblock(xbee, source, data)
+    
+    def _post(self, data, dest):
+        self._loop.create_task(self.xbee.send(data, dest, ack=False))
+    
+    def write(self, data, dest = None):
+        '''queue data for the remote at dest, the base station or the last
+           remote to say hello by default'''
+        self._loop.call_soon_threadsafe(self._put, data, dest)
+    
+    def _notify(self):
+        self._wake.set()
+    
+    async def _schedule(self):
+        'the tx task, like LinkedXbeeServer._schedule'
+        while True:
+            with self._pending_cv:
+                turn, timeout = self._turn()
+                if turn == None and timeout == None and self._tx_stop:
+                    return
+            if turn == None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._write(*turn[:5])
+            self._turn_sent(turn)
+    
+    async def _send_control(self):
+        turn = self._control_turn()
+        while turn != None:
+            await self._write(*turn[:5])
+            turn = self._control_turn()
+    
+    async def _write(self, session, cls, messages, since, size):
+        if len(messages) == 0:
+            return
+        try:
+            data = self._encode(session, cls, messages, size)
+            ok = await self._send_frags(list(self._make_frags(session, data)), session.addr, cls == BULK)
+            self._sent(session, cls, data, since, ok)
+        except Exception as x:
+            self.LOG.error("tx of {} writes to {:x} failed: {}".format(len(messages), session.addr, x))
+    
+    async def _send_frags(self, frags, dest, preemptible = False):
+        'drives LinkedXbeeServer._frag_steps like _send_frags, on the loop'
+        steps = self._frag_steps(len(frags), preemptible)
+        r = None
+        try:
+            while True:
+                step, arg = steps.send(r)
+                r = None
+                if step == LinkedXbeeServer.SEND_CONTROL:
+                    await self._send_control()
+                elif step == LinkedXbeeServer.SEND:
+                    r = await self.xbee.send(frags[arg], dest=dest)
+                else:
+                    try:
+                        r = await self.xbee.wait(arg)
+                    except TimeoutError as x:
+                        r = x
+        except StopIteration as x:
+            return x.value
@@ -9,14 +9,73 @@ import datetime
 
 import traceback
 
+import pacing
+import radioCache
+import xbeeFrames
+
 class XBeeDied(Exception): pass
 
+def data_length(data):
+    'the length of data, a buffer or a list of them'
+    if isinstance(data, list):
+        return sum(len(d) for d in data)
+    return len(data)
+
+# AT commands whose answers are measurements, not parameters to remember
+MEASUREMENTS = (b'DB', b'ED', b'FN', b'ND')
+# answers a cached radio's address, channel mask and mtu are set from, in order
+CACHED = (b'SL', b'SH', b'MY', b'CM', b'NP')
+# set on every open and never saved (no WR), a radio reset since it was 
+# cached has another value. RO only matters in transparent mode, and 
+# unlike TO every radio has it.
+RESET_CHECK = (b'RO', b'\x21')
+
+class Slot():
+    '''a frame id and the frame sent with it that waits for a response.
+       the event is the frame's own, so a late waiter can't be woken by
+       a later frame with the same id.'''
+    def __init__(self, fid):
+        self.fid = struct.pack("B", fid)
+        self.busy = False
+        self.event = None
+        self.sent = 0.0
+        self.length = 0
+        # what the pacer charged for it, None for frames that aren't sent on air
+        self.cost = None
+        # retransmissions the radio reported in tx_status
+        self.retries = 0
+
 class XBeeDevice:
     MAX_TIMEOUTS = 6
+    # tx_status latency over this many times the smallest seen means 
+    # frames are queueing in the radio
+    QUEUE_FACTOR = 2.0
     
     def __init__(self, portstr, rxcallback, xbeeclass, **kwargs):
+        '''rxcallback(device, source, data) is called from the rx thread,
+           what it sends doesn't wait there (see send_cmd).
+           kwargs may have xbeeCM, a channel mask to set, pacer, the 
+           pacing.Pacer every data frame is sent through, and write_delay 
+           and write_size, see xbeeFrames.Writer, and cache, the file of a
+           radioCache.RadioCache.'''
         
         self._in_init = True
+        self._setup(portstr, rxcallback, xbeeclass, kwargs)
+        
+        try:
+            self._mkxbee()
+        except Exception as x:
+            self.close()
+            raise x
+        
+        if 'xbeeCM' in kwargs:
+            if self.set_param(b'CM', struct.pack(">Q", kwargs['xbeeCM'])) != None:
+                self.send_cmd("at", command=b'CM')
+
+        self._in_init = False
+        
+    def _setup(self, portstr, rxcallback, xbeeclass, kwargs):
+        'what stays the same when the xbee is reopened'
         self._portstr = portstr
         self._xbeeclass = xbeeclass
         
@@ -26,35 +85,56 @@ class XBeeDevice:
         self._rxcallback = rxcallback
         self._next_frame_id = 1    
         self._max_packets = 3
+        # frames that may wait for a response at once, adapted between 1
+        # and max_window from how long tx_status takes
+        self.max_window = self._max_packets + 1
+        self._window = float(self.max_window)
+        self._min_rtt = None
         self._timeout = datetime.timedelta(seconds=5)        
-        self._lastrssi = datetime.datetime.now()
+        self._lastrssi = time.monotonic()
 
         self.address = 0     
 
         self.mtu = 100 #series 1 doesn't support NP, and is always 100
         self.on_energy = None        
         
-        try:
-            self._mkxbee()
-        except Exception as x:
-            self.close()
-            raise x
-        
-        if 'xbeeCM' in kwargs:
-            self.send_cmd("at", command=b'CM', parameter= struct.pack(">Q", kwargs['xbeeCM']))
-            self.send_cmd("at", command=b'CM')
-
-        self._in_init = False
-        
+        self._serial = None
+        self._reader = None
+        self._write_delay = kwargs.get('write_delay', 0.002)
+        self._write_size = kwargs.get('write_size', 1024)
+        
+        # AT parameters the radio has, read or set, by command
+        self._params = {}
+        # what AT commands being answered were sent to set
+        self._setting = {}
+        self._cache = None
+        if kwargs.get('cache') != None:
+            self._cache = radioCache.RadioCache(kwargs['cache'])
+        
+        # what is done with a received frame, by its name (tx_status is _on_rx's own)
+        self._rx_handlers = {'rx': self._on_data,
+                             'at_response': self._on_at_response}
+        # and with an at_response, by its command
+        self._at_handlers = {b'SL': self._at_SL, b'SH': self._at_SH, b'MY': self._at_MY,
+                             b'DB': self._at_DB, b'NP': self._at_NP, b'FN': self._at_FN,
+                             b'ND': self._at_ND, b'CM': self._at_CM, b'ED': self._at_ED}
+        
+        # shared by everything sent over the air
+        if 'pacer' in kwargs:
+            self.pacer = kwargs['pacer']
+        else:
+            self.pacer = pacing.Pacer()
         
     def _mkxbee(self):
         
-        self._pending = {}  
+        # indexed by frame id, 0 is never acked so its slot is never used
+        self._slots = [Slot(i) for i in range(0x100)]
+        self._busy = 0
         
         self._lock = threading.Lock()
+        # notified whenever a frame stops waiting for its response
+        self._slot_cv = threading.Condition(self._lock)
         
-        # initialize to something reasonable
-        self._last_sendwait_length = datetime.timedelta(seconds=1)
         self._timeout_err_cnt = 0
         self._idle = threading.Event()
                 
@@ -63,19 +143,37 @@ class XBeeDevice:
         
         self.log.debug("Opening serial: " + self._portstr)
         dev, baud, opts = self._portstr.split(":")
+        # the timeout is how long closing waits for the rx thread
         self._serial = serial.Serial(dev, baudrate=int(baud), 
                                      bytesize=int(opts[0]),
                                      parity=opts[1],
-                                     stopbits=int(opts[2]))
-        self._xbee = self._xbeeclass(self._serial, escaped=True,
-                          callback=self._on_rx,
-                          error_callback = self._on_error)
+                                     stopbits=int(opts[2]),
+                                     timeout=0.1)
+        # without a callback python-xbee starts no thread, it only holds
+        # the frame specs. what the radio sends is read by _read, frames 
+        # sent close together go in one write.
+        self._xbee = self._xbeeclass(self._serial, escaped=True)
+        self._parser = xbeeFrames.Parser(self._xbee.api_responses, self._xbee)
+        self._builder = xbeeFrames.Builder(self._xbee.api_commands)
+        ser = self._serial
+        self._writer = xbeeFrames.Writer(ser, lambda x: self._failed(ser, x), 
+                                         self._write_size, self._write_delay)
+        self._reader = threading.Thread(name='XBeeDevice-rx', target=self._read, args=(self._serial,))
+        self._reader.daemon = True
+        self._reader.start()
 
         self._addrlen=2
         for part in self._xbee.api_commands['tx']:
             if part['name'] == 'dest_addr':
                 self._addrlen = part['len']
 
+        if self._cache != None:
+            sl = self.send_cmd("at", command=b'SL')
+            check = self.send_cmd("at", command=RESET_CHECK[0])
+            if self._from_cache(self.wait(sl), self.wait(check)):
+                return
+        
+        self.send_cmd("at", command=RESET_CHECK[0], parameter=RESET_CHECK[1])
         # point to multipoint
         self.send_cmd("at", command=b'TO', parameter=b'\x40')
         self.send_cmd("at", command=b'CM')
@@ -87,6 +185,44 @@ class XBeeDevice:
         
         #self.send_cmd("at", command=b'NP')
         self.flush()
+        self._save_cache()
+    
+    def _from_cache(self, sl, check):
+        '''True if the cache has the radio that answered SL and RESET_CHECK
+           with sl and check, as it was then. what it knows is ours then.'''
+        if 'parameter' not in sl:
+            return False
+        params = self._cache.get(self._portstr, sl['parameter'], (RESET_CHECK[0], check.get('parameter', b'')))
+        if params == None:
+            self.log.info("radio {} on {} isn't cached as it is".format(sl['parameter'].hex(), self._portstr))
+            return False
+        self._params.update(params)
+        for command in CACHED:
+            if command in params:
+                self._at_handlers[command]({'command': command, 'parameter': params[command]})
+        self.log.info("radio {:x} on {} from the cache".format(self.address, self._portstr))
+        return True
+    
+    def _save_cache(self):
+        if self._cache != None and b'SL' in self._params:
+            self._cache.put(self._portstr, self._params[b'SL'], self._params)
+    
+    def set_param(self, command, parameter):
+        '''set the AT parameter command (eg b'PL') to parameter, unless the 
+           radio has it already, and wait for the answer. returns it, None if
+           nothing was sent.'''
+        if self._has(command, parameter):
+            self.log.debug("{} is {} already".format(command, parameter.hex()))
+            return None
+        pkt = self.wait(self.send_cmd("at", command=command, parameter=parameter))
+        self._save_cache()
+        return pkt
+    
+    def _has(self, command, parameter):
+        'True if the radio is known to have parameter for command'
+        # the radio answers with as few bytes as the value takes
+        return command in self._params and \
+            int.from_bytes(self._params[command], 'big') == int.from_bytes(parameter, 'big')
         
     def flush(self):
         if not self._idle.wait(self._timeout.total_seconds()):
@@ -96,8 +232,10 @@ class XBeeDevice:
                 self._timeout_err_cnt += 1
                 
                 # drop anything we migth be waiting for
-                self._pending = {}
-                self._idle.set()
+                for slot in self._slots:
+                    if slot.busy:
+                        self._free(slot)
+                self.pacer.on_timeout()
                 
                 if self._timeout_err_cnt > XBeeDevice.MAX_TIMEOUTS:
                     raise XBeeDied("flush with too many timeouts")
@@ -109,12 +247,15 @@ class XBeeDevice:
     def sendwait(self, data=None, atcmd = 'tx', timeout = None, **kwargs):
         'send the message and wait for the result'
         
-        begin = datetime.datetime.now()
-        
         # may raise timeouterror     
         self.flush()
                               
         e = self.send(data=data, atcmd=atcmd, **kwargs)
+        return self.wait(e, timeout)
+    
+    def wait(self, e, timeout = None):
+        '''wait for the response to a frame sent with send or send_cmd, 
+           several can be outstanding at once. returns the response.'''
         if timeout == None:
             timeout = self._timeout.total_seconds()
         if not e.wait(timeout):
@@ -124,21 +265,26 @@ class XBeeDevice:
                 if self._timeout_err_cnt > XBeeDevice.MAX_TIMEOUTS:
                     raise XBeeDied("sendwait too many timeouts")
                 
-                if e.fid in self._pending:
-                    del self._pending[e.fid]
-                else:
-                    self.log.error("sendwait timeout, but no matching frame id {}".format(e.fid))
-                    
+                slot = self._slots[e.fid[0]]
+                if slot.busy and slot.event is e:
+                    if slot.cost != None:
+                        self.pacer.on_timeout()
+                    self._free(slot)
+                # otherwise a sweep already gave up on it
+                
                 raise TimeoutError("Timeout sending message")
             finally:
                 self._lock.release()                
         self._timeout_err_cnt = 0
-        end = datetime.datetime.now()
-        self._last_sendwait_length = end-begin
         return e.pkt
         
     def send(self, data=None, dest= 0xffff, atcmd='tx', **kwargs):
-        'format and send a data packet, default to broadcast'
+        '''format and send a data packet, default to broadcast.
+           data may be a list of buffers (eg header and payload), they are 
+           gathered into the frame with a single copy, see xbeeFrames.frame.'''
+        
+        if isinstance(data, tuple):
+            data = list(data)
                 
         if self._addrlen == 2:
             return self.send_cmd(cmd=atcmd, 
@@ -153,27 +299,44 @@ class XBeeDevice:
                
         
     def send_cmd(self, cmd, **kwargs):
-        begin = datetime.datetime.now()
-        while len(self._pending) > self._max_packets:            
-            if datetime.datetime.now() - begin > self._timeout:
-                raise TimeoutError("Tx overrun -- are packets going out?")            
-            time.sleep(0.05) 
+        '''send an api frame. called from the rx thread (by rxcallback) it
+           never waits: the tx_status that frees a slot is that thread's to 
+           read, so the frame only gets a slot if the window has room for 
+           it now, and is sent unacked otherwise.'''
+        on_rx = threading.current_thread() is self._reader
+        
+        # frames that go over the air wait for the pacer
+        cost = None
+        if 'data' in kwargs:
+            if on_rx:
+                # charged to the frames that follow
+                cost = self.pacer.reserve(data_length(kwargs['data']))[0]
+            else:
+                cost = self.pacer.acquire(data_length(kwargs['data']))
         
         e = threading.Event()
+        slot = None
         if 'ack' not in kwargs or kwargs['ack'] == True: 
-            self._idle.clear()                                   
-            fid = struct.pack("B", self._next_frame_id)
+            with self._slot_cv:
+                if on_rx:
+                    slot = self._try_slot()
+                else:
+                    slot = self._take_slot()
+                if slot != None:
+                    slot.event = e
+                    slot.cost = cost
+                    slot.length = data_length(kwargs.get('data', b''))
+                    slot.retries = 0
+                    slot.sent = time.monotonic()
+        if slot != None:
+            fid = slot.fid
         else:
-            # frame id 0 is non acked
+            # frame id 0 is non acked, nothing will come back for it
             fid = b'\x00'
-        
-        try:
-            self._lock.acquire()
-            self._pending[fid] = e
-        finally:
-            self._lock.release()
+            e.pkt = None
             
         e.fid = fid
+        self._note_setting(cmd, kwargs)
         
         pkt=dict(kwargs)
         pkt['id'] = cmd
@@ -181,23 +344,125 @@ class XBeeDevice:
         self.log.debug("xbee tx [{:x}, pid={}, fid={}]: {}".format(self.address, 
                                                                    pkt['id'], fid, pkt))
         
-        self._xbee.send(cmd, frame_id = fid, **kwargs)        
+        self._writer.write(self._builder.build(cmd, frame_id = fid, **kwargs))
         
-        if 'ack' not in kwargs or kwargs['ack'] == True: 
-            self._next_frame_id += 1
-            if self._next_frame_id > 0xff:
-                self._next_frame_id = 1
-        else:
+        if fid == b'\x00':
             e.set()
             
         return e
+    
+    def _note_setting(self, cmd, kwargs):
+        'remember what an AT command is sent to set, until it is answered'
+        if cmd == 'at' and kwargs.get('parameter') != None:
+            self._setting[kwargs['command']] = kwargs['parameter']
+    
+    def _take_slot(self):
+        '''a free slot, once the window has room for it. with _lock held.
+           waits are woken by the response that frees a slot.'''
+        timeout = self._timeout.total_seconds()
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if self._busy >= int(self._window):
+                oldest = self._expire(now)
+            if self._busy < int(self._window):
+                break
+            if now >= deadline:
+                raise TimeoutError("Tx overrun -- are packets going out?")            
+            self._slot_cv.wait(min(deadline, oldest + timeout) - now)
+        return self._claim_slot()
+    
+    def _try_slot(self):
+        'a free slot if the window has room for it now, None if not. with _lock held.'
+        if self._busy < int(self._window):
+            return self._claim_slot()
+        return None
+    
+    def _claim_slot(self):
+        'the free slot with the least recently used id, busy now'
+        # the least recently used free id
+        while self._slots[self._next_frame_id].busy:
+            self._next_frame_id = self._next_frame_id % 0xff + 1
+        slot = self._slots[self._next_frame_id]
+        self._next_frame_id = self._next_frame_id % 0xff + 1
+        slot.busy = True
+        self._busy += 1
+        self._idle.clear()
+        return slot
+    
+    def _free(self, slot):
+        'with _lock held'
+        slot.busy = False
+        slot.event = None
+        self._busy -= 1
+        if self._busy == 0:
+            self._idle.set()
+        self._slot_cv.notify_all()
+    
+    def _expire(self, now):
+        '''free every slot that waited longer than the timeout in one pass,
+           their waiters time out on their own. returns when the oldest 
+           slot left was sent. with _lock held.'''
+        timeout = self._timeout.total_seconds()
+        expired = 0
+        oldest = now
+        for slot in self._slots:
+            if not slot.busy:
+                continue
+            if now - slot.sent > timeout:
+                if slot.cost != None:
+                    expired += 1
+                self._free(slot)
+            else:
+                oldest = min(oldest, slot.sent)
+        if expired > 0:
+            self.log.warn("gave up on {} frames without tx_status".format(expired))
+            self.pacer.on_timeout()
+        return oldest
+    
+    def _adapt(self, status, rtt):
+        '''grow the window by about a frame per window of quick successes,
+           shrink it the same while tx_status shows frames queueing in the
+           radio and halve it when the channel is congested. with _lock 
+           held.'''
+        if self._min_rtt == None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+        if status in pacing.CONGESTED:
+            self._window = max(1.0, self._window / 2)
+        elif rtt > XBeeDevice.QUEUE_FACTOR * self._min_rtt:
+            self._window = max(1.0, self._window - 1.0 / self._window)
+        elif status == pacing.SUCCESS:
+            self._window = min(float(self.max_window), self._window + 1.0 / self._window)
+    
+    @property
+    def window(self):
+        'frames that may wait for a response at once right now'
+        return int(self._window)
+        
+    def _read(self, ser):
+        'the rx thread for the serial port ser, reads whatever it has at once'
+        try:
+            while ser is self._serial:
+                data = ser.read(max(1, ser.in_waiting))
+                for pkt in self._parser.feed(data):
+                    self._on_rx(pkt)
+        except Exception as x:
+            self._failed(ser, x)
+    
+    def _failed(self, ser, error):
+        'the rx or tx thread of ser failed with error'
+        if ser is self._serial:
+            self._on_error(error)
         
     def _on_error(self, error):
         self.log.warn('Failed with: {}'.format(str(error)))
         self.log.warn(traceback.format_exc())
-        self._serial.close()
-        self._xbee = None
+        ser = self._serial
+        # the rx and tx threads stop, their errors are this one's
         self._serial = None
+        self._writer.close()
+        ser.close()
+        self._xbee = None
         
         # reload xbee
         if self._in_init == False:
@@ -247,95 +512,188 @@ class XBeeDevice:
         
         return freq
         
+    def _complete(self, pkt):
+        '''wake whoever waits for the response pkt. returns the cost, 
+           round trip and retries of the frame it answers, cost is None if
+           it wasn't sent on air.'''
+        cost = rtt = retries = None
+        with self._slot_cv:
+            slot = None
+            if 'frame_id' in pkt and len(pkt['frame_id']) == 1:
+                slot = self._slots[pkt['frame_id'][0]]
+            if slot != None and slot.busy:
+                rtt = time.monotonic() - slot.sent
+                cost = slot.cost
+                if 'retries' in pkt:
+                    slot.retries = pkt['retries'][0]
+                retries = slot.retries
+                e = slot.event
+                e.pkt = pkt
+                e.set()
+                if pkt['id'] == 'tx_status' and cost != None:
+                    self._adapt(pkt['status'], rtt)
+                self._free(slot)
+        return cost, rtt, retries
+    
+    def _poll_rssi(self):
+        # from the rx thread. with the window full it goes unacked and isn't
+        # answered, the next poll asks again
+        self.send_cmd("at", command=b'DB')
+        
     def _on_rx(self, pkt):
-        self.log.debug("xbee rx [{:x}, {}]: {}".format(self.address, pkt['id'], pkt))            
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("xbee rx [{:x}, {}]: {}".format(self.address, pkt['id'], pkt))            
+        
+        cost, rtt, retries = self._complete(pkt)
         
-        try:
-            self._lock.acquire()
-            
-            if 'frame_id' in pkt and pkt['frame_id'] in self._pending:
-                self._pending[pkt['frame_id']].pkt = pkt
-                self._pending[pkt['frame_id']].set()
-                del self._pending[pkt['frame_id']]
-            
-            if len(self._pending) == 0:
-                self._idle.set()                
-        finally:
-            self._lock.release()
-                        
         if pkt['id'] == 'tx_status':
+            if cost != None:
+                self.pacer.on_status(pkt['status'], cost, rtt, retries)
             if pkt['status'] != b'\x00':
                 s = pkt['status']
                 #if s in XBee900HP.tx_status_strings:
                 #    self.log.warn("unsuccessful tx: {}".format(XBee900HP.tx_status_strings[s]))
                 #else:
                 self.log.warn("unsuccessful tx: {}".format(s))
-                    
-        if pkt['id'] == 'at_response':   
-            if 'status' in pkt and pkt['status'] > b'\x00':
-                self.log.warn("At command failed: {}".format(pkt))
-                                                            
-            if pkt['command'] == b'SL':
-                if 'parameter' in pkt:
-                    self.address = (0xffffffff00000000 & self.address) | (struct.unpack('>L', pkt['parameter'])[0]) 
-            elif pkt['command'] == b'SH':
-                if 'parameter' in pkt:
-                    self.address = (0x00000000ffffffff & self.address) | (struct.unpack('>L', pkt['parameter'])[0] << 32)
-            elif pkt['command'] == b'MY':
-                if 'parameter' in pkt:
-                    self.address = struct.unpack (">H", pkt['parameter'])[0]
-            elif pkt['command'] == b'DB':
-                self.log.info("RSSI -{}dBm".format(pkt['parameter'][0] ))
-                
-                self.rssi_history.pop()
-                self.rssi_history.append(-pkt['parameter'][0])
-            elif pkt['command'] == b'NP':
-                self.log.info("NP Resp: {}".format(pkt))
-                if 'parameter' in pkt:
-                    self.mtu = pkt['parameter'][0]
-                
-            elif pkt['command'] == b'FN':
-                self.log.info("Neighbor info: {}".format(pkt['rf_data'].decode('utf-8')))
-            elif pkt['command'] == b'ND':
-                self.log.info("Network info: {}".format(pkt['rf_data'].decode('utf-8')))
-            elif pkt['command'] == b'CM':
-                # mask is sent as a hex string of varying length....
-                if 'parameter' in pkt:
-                    self._channel_cache ={}
-                    self._channel_mask = int("".join(["{:02x}".format(i) for i in pkt['parameter']]),16)
-                    self.log.info("Channel mask is {:x}".format(self._channel_mask))
-            elif pkt['command'] == b'ED':                
-                for i,d in enumerate(pkt['parameter']):
-                    self.log.info("Energy info [{:02d} = {:3.2f} MHz]: -{}dBm".format(i, self.channel_to_freq(i), d))
-                    
-                if self.on_energy != None:
-                    self.on_energy (self, [(self.channel_to_freq(i), d) for i,d in enumerate(pkt['parameter'])])
-            else:
-                self.log.warn("Unsupported command response: {}:{}".format(pkt['command'], pkt))
-        if pkt['id'] == 'rx':
-            
-            
-            if datetime.datetime.now() - self._lastrssi > datetime.timedelta(seconds=5):
-                # poll rssi
-                self.send_cmd("at", command=b'DB')
-                self._lastrssi = datetime.datetime.now()
-
-
-            srcaddr = None   
-            if self._addrlen == 2:
-                srcaddr = struct.unpack(">H", pkt['source_addr'])[0]
-            elif self._addrlen == 8:
-                srcaddr = struct.unpack(">Q", pkt['source_addr'])[0]
-            else: 
-                raise Exception("Unsupported address length")
+            return
+        handler = self._rx_handlers.get(pkt['id'])
+        if handler != None:
+            handler(pkt)
+    
+    def _on_data(self, pkt):
+        'an rx frame'
+        now = time.monotonic()
+        if now - self._lastrssi > 5:
+            # poll rssi
+            self._poll_rssi()
+            self._lastrssi = now
+        
+        # 2 or 8 bytes, whatever _addrlen is
+        srcaddr = int.from_bytes(pkt['source_addr'], 'big')
+        self._rxcallback(self, 
+                         srcaddr, 
+                         pkt['rf_data'])
+    
+    def _on_at_response(self, pkt):
+        ok = 'status' not in pkt or pkt['status'] == b'\x00'
+        if not ok:
+            self.log.warn("At command failed: {}".format(pkt))
+        
+        command = pkt['command']
+        if 'parameter' not in pkt and command in self._setting:
+            # the answer to setting it, the radio has what was sent now
+            value = self._setting.pop(command)
+            if ok:
+                pkt = dict(pkt, parameter = value)
+        if ok and 'parameter' in pkt and command not in MEASUREMENTS:
+            self._params[command] = pkt['parameter']
+        
+        handler = self._at_handlers.get(command)
+        if handler == None:
+            if command not in self._params:
+                self.log.warn("Unsupported command response: {}:{}".format(command, pkt))
+        elif 'parameter' in pkt or pkt['command'] in (b'FN', b'ND'):
+            handler(pkt)
+    
+    def _at_SL(self, pkt):
+        self.address = (0xffffffff00000000 & self.address) | (struct.unpack('>L', pkt['parameter'])[0]) 
+        
+    def _at_SH(self, pkt):
+        self.address = (0x00000000ffffffff & self.address) | (struct.unpack('>L', pkt['parameter'])[0] << 32)
+        
+    def _at_MY(self, pkt):
+        self.address = struct.unpack (">H", pkt['parameter'])[0]
+        
+    def _at_DB(self, pkt):
+        self.log.info("RSSI -{}dBm".format(pkt['parameter'][0] ))
+        
+        self.rssi_history.pop()
+        self.rssi_history.append(-pkt['parameter'][0])
+        
+    def _at_NP(self, pkt):
+        self.log.info("NP Resp: {}".format(pkt))
+        self.mtu = pkt['parameter'][0]
+        
+    def _at_FN(self, pkt):
+        self.log.info("Neighbor info: {}".format(pkt['rf_data'].decode('utf-8')))
+        
+    def _at_ND(self, pkt):
+        self.log.info("Network info: {}".format(pkt['rf_data'].decode('utf-8')))
+        
+    def _at_CM(self, pkt):
+        # mask is sent as a hex string of varying length....
+        self._channel_cache ={}
+        self._channel_mask = int("".join(["{:02x}".format(i) for i in pkt['parameter']]),16)
+        self.log.info("Channel mask is {:x}".format(self._channel_mask))
+        
+    def _at_ED(self, pkt):
+        for i,d in enumerate(pkt['parameter']):
+            self.log.info("Energy info [{:02d} = {:3.2f} MHz]: -{}dBm".format(i, self.channel_to_freq(i), d))
             
-            self._rxcallback(self, 
-                             srcaddr, 
-                             pkt['rf_data'])
-
+        if self.on_energy != None:
+            self.on_energy (self, [(self.channel_to_freq(i), d) for i,d in enumerate(pkt['parameter'])])
         
     def close(self):
-        self._xbee.halt()
-        self._serial.close()
+        ser = self._serial
+        # tells the rx thread to stop
+        self._serial = None
+        if ser != None:
+            # what was sent still goes out
+            self._writer.close()
+            if self._reader != None and self._reader != threading.current_thread():
+                self._reader.join()
+            ser.close()
         
         
+
+if __name__=="__main__":
+    #test
+    import os
+    import tempfile
+    
+    def device(cache):
+        'an XBeeDevice that isn\'t opened, its AT answers come from answer'
+        d = XBeeDevice.__new__(XBeeDevice)
+        d._setup('/dev/ttyUSB0:38400:8N1', None, None, {'cache': cache})
+        return d
+    
+    def answer(d, command, parameter = None, status = b'\x00', setting = None):
+        'the at_response to command, sent to set it to setting if that isn\'t None'
+        if setting != None:
+            d._note_setting('at', {'command': command, 'parameter': setting})
+        pkt = {'id': 'at_response', 'frame_id': b'\x01', 'command': command, 'status': status}
+        if parameter != None:
+            pkt['parameter'] = parameter
+        d._on_at_response(pkt)
+        return pkt
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = os.path.join(tmp, 'radios.json')
+        sl = b'\x40\xa1\xb2\xc3'
+        
+        # an 802.15.4 radio rejects TO. the first open misses the cache
+        # (the check has its default) and does what _mkxbee does
+        d = device(cache)
+        assert not d._from_cache(answer(d, b'SL', sl), answer(d, RESET_CHECK[0], b'\x03'))
+        answer(d, RESET_CHECK[0], setting = RESET_CHECK[1])
+        answer(d, b'TO', status = b'\x02', setting = b'\x40')
+        answer(d, b'CM', b'\xff\xfe')
+        answer(d, b'MY', b'\x12\x34')
+        d._save_cache()
+        answer(d, b'PL', setting = b'\x02')
+        d._save_cache()
+        assert b'TO' not in d._params and d.address == 0x1234
+        
+        # the next open finds it, with what was set since
+        d = device(cache)
+        assert d._from_cache(answer(d, b'SL', sl), answer(d, RESET_CHECK[0], RESET_CHECK[1]))
+        assert d.address == 0x1234 and d._channel_mask == 0xfffe
+        assert d._has(b'PL', b'\x02') and not d._has(b'PL', b'\x03')
+        
+        # but not once the radio was reset
+        d = device(cache)
+        assert not d._from_cache(answer(d, b'SL', sl), answer(d, RESET_CHECK[0], b'\x03'))
+        assert not d._has(b'PL', b'\x02')
+        # nor when the check is rejected too
+        d = device(cache)
+        assert not d._from_cache(answer(d, b'SL', sl), answer(d, RESET_CHECK[0], status = b'\x02'))
@@ -0,0 +1,331 @@
+'''
+escaped API frames (AP=2) to and from an XBee.
+
+    0x7e, length (2 bytes), data, checksum
+
+with 0x7e, 0x7d, 0x11 and 0x13 escaped as 0x7d, byte ^ 0x20. since 0x7e
+never appears escaped, whatever the serial port returns is split into
+frames at 0x7e, unescaped a frame at a time (bytes.split and translate,
+not a byte at a time) and checksummed with sum().
+
+packets are the same dicts python-xbee's _split_response makes, from the
+same api_responses (xb900hp.XBee900HP's, or xbee.ieee.XBee's with 0x81 rx
+and 0x89 tx_status). each frame type's fields are turned into slices once,
+a frame is decoded by the entry its type indexes in a table.
+
+a Builder makes the frames of api_commands the same way, escaping them
+with a bytes.replace per special byte, and a Writer gathers the frames
+sent close together into one serial write.
+'''
+
+import logging
+import threading
+import time
+
+START = 0x7e
+ESCAPE = b'\x7d'
+# the byte an escaped byte stands for, at its own index
+UNESCAPE = bytes(i ^ 0x20 for i in range(0x100))
+
+def unescape(frame):
+    'frame with its escapes undone'
+    if ESCAPE not in frame:
+        return frame
+    parts = frame.split(ESCAPE)
+    return parts[0] + b''.join([p[:1].translate(UNESCAPE) + p[1:] for p in parts[1:]])
+
+# replaced in this order, the escape byte first
+ESCAPES = [(bytes([b]), bytes([0x7d, b ^ 0x20])) for b in (0x7d, 0x7e, 0x11, 0x13)]
+
+def escape(data):
+    for b, escaped in ESCAPES:
+        if b in data:
+            data = data.replace(b, escaped)
+    return data
+
+def frame(parts):
+    '''the escaped API frame of the data in parts, a list of buffers (bytes
+       or memoryview slices of a file, say). they are copied once, into the
+       frame, and again only by the escapes it needs.'''
+    length = 0
+    checksum = 0
+    for p in parts:
+        length += len(p)
+        checksum += sum(p)
+    # a placeholder for the start byte, which isn't escaped
+    data = bytearray().join([b'\x00', length.to_bytes(2, 'big')] + parts + [bytes([0xff - (checksum & 0xff)])])
+    data = escape(data)
+    data[0] = START
+    return data
+
+def complete(frame):
+    'True if the unescaped frame has all the bytes its length says'
+    return len(frame) >= 3 and len(frame) >= ((frame[0] << 8) | frame[1]) + 3
+
+class Parser():
+    def __init__(self, api_responses, xbee = None):
+        '''api_responses is the spec of an xbee class, xbee the instance its
+           'parsing' rules are applied with, they are skipped without one'''
+        self.LOG = logging.getLogger(__name__)
+        self._xbee = xbee
+        # indexed by frame type
+        self._table = 0x100 * [None]
+        for key, spec in api_responses.items():
+            self._table[key[0]] = self._compile(spec)
+        # the start of a frame that hasn't been read to the end
+        self._buf = b''
+
+        self.frames = 0
+        self.bad = 0
+        self.unknown = 0
+
+    def _compile(self, spec):
+        '''(name, [(field, start, end)...], the field that takes the rest or
+           None, its start, parsing rules) for one api response spec'''
+        fields = []
+        rest = None
+        at = 1
+        for field in spec['structure']:
+            if field['len'] == None:
+                rest = field['name']
+                break
+            if not isinstance(field['len'], int):
+                raise ValueError("{}: unsupported field length {}".format(spec['name'], field['len']))
+            fields.append( (field['name'], at, at + field['len']) )
+            at += field['len']
+        return (spec['name'], fields, rest, at, spec.get('parsing', ()))
+
+    def feed(self, data):
+        'the packets in the frames data completes'
+        buf = self._buf + data
+        start = buf.find(START)
+        if start < 0:
+            # nothing that can be part of a frame
+            self._buf = b''
+            return []
+        frames = buf[start+1:].split(bytes([START]))
+        packets = []
+        for frame in frames[:-1]:
+            if len(frame) == 0:
+                continue
+            frame = unescape(frame)
+            if not complete(frame):
+                self.bad += 1
+                self.LOG.warn("dropped a frame cut short: {}".format(frame))
+                continue
+            self._packet(frame, packets)
+        # the last one may still be arriving
+        last = frames[-1]
+        self._buf = bytes([START]) + last
+        if last[-1:] != ESCAPE:
+            frame = unescape(last)
+            if complete(frame):
+                self._buf = b''
+                self._packet(frame, packets)
+        return packets
+
+    def _packet(self, frame, packets):
+        'append the packet in an unescaped frame (length, data, checksum) unless it is bad'
+        n = (frame[0] << 8) | frame[1]
+        data = frame[2:2+n]
+        if (sum(data) + frame[2+n]) & 0xff != 0xff:
+            self.bad += 1
+            self.LOG.warn("dropped a frame with a bad checksum: {}".format(frame))
+            return
+        if n == 0:
+            return
+        entry = self._table[data[0]]
+        if entry == None:
+            self.unknown += 1
+            self.LOG.warn("dropped a frame of unknown type {:02x}: {}".format(data[0], data))
+            return
+        name, fields, rest, end, parsing = entry
+        if len(data) < end or (rest == None and len(data) > end):
+            self.bad += 1
+            self.LOG.warn("dropped a {} frame of the wrong length: {}".format(name, data))
+            return
+        pkt = {'id': name}
+        for field, s, e in fields:
+            pkt[field] = data[s:e]
+        if rest != None and len(data) > end:
+            pkt[rest] = data[end:]
+        if self._xbee != None:
+            for field, rule in parsing:
+                if field in pkt:
+                    pkt[field] = rule(self._xbee, pkt)
+        self.frames += 1
+        packets.append(pkt)
+
+    def stats(self):
+        return {'frames': self.frames,
+                'bad': self.bad,
+                'unknown': self.unknown}
+
+class Builder():
+    'frames of the api_commands of an xbee class, like python-xbee\'s send makes'
+    def __init__(self, api_commands):
+        self._commands = {}
+        for cmd, spec in api_commands.items():
+            self._commands[cmd] = [(f['name'], f['len'], f['default']) for f in spec]
+
+    def build(self, cmd, **kwargs):
+        '''the escaped frame of cmd, fields are kwargs as bytes, the data 
+           may be a list of buffers. anything not a field of cmd is 
+           ignored.'''
+        parts = []
+        for name, length, default in self._commands[cmd]:
+            data = kwargs.get(name)
+            if name not in kwargs:
+                if length == None:
+                    continue
+                if not default:
+                    raise KeyError("The expected field {} of length {} was not provided".format(name, length))
+                data = default
+            if length and len(data) != length:
+                raise ValueError("The data provided for '{}' was not {} bytes long".format(name, length))
+            if isinstance(data, (list, tuple)):
+                parts.extend(data)
+            elif data:
+                parts.append(data)
+        return frame(parts)
+
+class Writer():
+    '''writes frames to a serial port from a thread of its own. a frame 
+       written more than delay seconds after the last write goes at once,
+       ones that follow it closer wait for the rest of delay, or until 
+       size bytes wait, and go in one write.'''
+    def __init__(self, ser, on_error, size = 1024, delay = 0.002):
+        '''on_error(exception) is called, from the thread, if a write 
+           fails. the thread stops then.'''
+        self.LOG = logging.getLogger(__name__)
+        self._serial = ser
+        self._on_error = on_error
+        self.size = size
+        self.delay = delay
+
+        self._cv = threading.Condition()
+        self._frames = []
+        self._size = 0
+        self._last = 0
+        self._stop = False
+
+        self.frames = 0
+        self.writes = 0
+
+        self._thread = threading.Thread(name='xbeeFrames-Writer', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, frame):
+        with self._cv:
+            self._frames.append(frame)
+            self._size += len(frame)
+            if len(self._frames) == 1 or self._size >= self.size:
+                self._cv.notify()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while len(self._frames) == 0 and not self._stop:
+                    self._cv.wait()
+                if len(self._frames) == 0:
+                    return
+                # more may follow
+                while self._size < self.size and not self._stop:
+                    left = self._last + self.delay - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cv.wait(left)
+                frames = self._frames
+                self._frames = []
+                self._size = 0
+            if len(frames) > 1:
+                frames = [b''.join(frames)]
+            try:
+                self._serial.write(frames[0])
+            except Exception as x:
+                self._on_error(x)
+                return
+            self._last = time.monotonic()
+            self.frames += len(frames)
+            self.writes += 1
+
+    def close(self):
+        'write what is left and stop'
+        with self._cv:
+            self._stop = True
+            self._cv.notify()
+        if self._thread != threading.current_thread():
+            self._thread.join()
+
+    def stats(self):
+        return {'frames': self.frames,
+                'writes': self.writes}
+
+if __name__=="__main__":
+    #test
+    import random
+    
+    # rx, tx_status and at_response of an XBee900HP
+    responses = {b'\x90': {'name': 'rx',
+                           'structure': [{'name': 'source_addr', 'len': 8},
+                                         {'name': 'reserved', 'len': 2},
+                                         {'name': 'options', 'len': 1},
+                                         {'name': 'rf_data', 'len': None}]},
+                 b'\x8b': {'name': 'tx_status',
+                           'structure': [{'name': 'frame_id', 'len': 1},
+                                         {'name': 'reserved', 'len': 2},
+                                         {'name': 'retries', 'len': 1},
+                                         {'name': 'status', 'len': 1},
+                                         {'name': 'discover', 'len': 1}]},
+                 b'\x88': {'name': 'at_response',
+                           'structure': [{'name': 'frame_id', 'len': 1},
+                                         {'name': 'command', 'len': 2},
+                                         {'name': 'status', 'len': 1},
+                                         {'name': 'parameter', 'len': None}]}}
+    # the same frames as commands, so the Builder makes what the Parser reads
+    commands = {spec['name']: [{'name': 'id', 'len': 1, 'default': key}] + 
+                              [dict(f, default = None) for f in spec['structure']]
+                for key, spec in responses.items()}
+    b = Builder(commands)
+    
+    random.seed(1)
+    # mostly the bytes that are escaped
+    def rand(n):
+        return bytes(random.choice((0x7e, 0x7d, 0x11, 0x13, random.randrange(0x100))) for i in range(n))
+    
+    unknown = bytes(b.build('rx', id = b'\x91', source_addr = rand(8), reserved = rand(2), options = b'\x01', rf_data = b'x'))
+    packets = []
+    stream = []
+    for i in range(1000):
+        name = random.choice(list(commands))
+        pkt = {'id': name}
+        for f in commands[name][1:]:
+            pkt[f['name']] = rand(f['len'] or random.randrange(1, 100))
+        packets.append(pkt)
+        fields = dict(pkt)
+        del fields['id']
+        if name == 'rx' and i % 2:
+            # a buffer list, like a fragment's header and payload
+            data = fields['rf_data']
+            fields['rf_data'] = [data[:3], memoryview(data)[3:]]
+        f = bytes(b.build(name, **fields))
+        stream.append(f)
+        if i % 100 == 0:
+            # a bad checksum and an unknown frame type are dropped
+            stream.append(f[:-1] + (b'\x01' if f[-1] == 0 else b'\x00'))
+            stream.append(unknown)
+    stream = b''.join(stream)
+    
+    # whatever the serial port returns
+    p = Parser(responses)
+    got = []
+    at = 0
+    while at < len(stream):
+        n = random.choice((1, 2, 3, 50, 500))
+        got.extend(p.feed(stream[at:at+n]))
+        at += n
+    assert got == packets
+    assert p.frames == len(packets) and p.unknown == 10 and p.bad == 10, p.stats()
+    
+    assert unescape(escape(stream)) == stream
@@ -29,13 +29,13 @@ def rx(dev, src, data):
 xb = xbeeDevice.XBeeDevice('/dev/ttyUSB0:38400:8N1', rx, XBee900HP)
 
 try:
-    xb.send_cmd("at", command=b'PL', parameter = b'\x04')
-    xb.send_cmd("at", command=b'HP', parameter = b'\x03')
-    xb.send_cmd("at", command=b'ID', parameter = b'\x33\x33')
+    xb.set_param(b'PL', b'\x04')
+    xb.set_param(b'HP', b'\x03')
+    xb.set_param(b'ID', b'\x33\x33')
     
     # channel mask for dana roof from scanning
 #    xb.send_cmd("at", command=b'CM', parameter=struct.pack(">Q", 0xfceb29f032404210))
-    xb.send_cmd("at", command=b'CM', parameter= struct.pack(">Q", 0xffe7f4f430000000))
+    xb.set_param(b'CM', struct.pack(">Q", 0xffe7f4f430000000))
     xb.send_cmd("at", command=b'CM')
     time.sleep(0.5)
 #    xb.send_cmd("at", command=b'ED')
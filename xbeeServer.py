@@ -1,22 +1,289 @@
 from xbeeDevice import XBeeDevice 
+from xb900hp import XBee900HP
 import logging
 import threading
 import queue
 import zlib
+import time
+import collections
 import fragmentation as frag
+import fragmentation16 as frag16
+import compression
+import mqttCodec
+import mqttPolicy
 import datetime
 
+# capabilities sent with HELLOCAPS. peers that never send HELLOCAPS only 
+# understand the original fragmentation framing.
+CAP_FRAG16 = 0x01
+CAP_FEC = 0x02
+CAP_COMPACT = 0x04
+CAP_STREAMZ = 0x08
+# only announced when the server is made with mqtt=True
+CAP_MQTT = 0x10
+# only announced when the server is made with priority=True
+CAP_PRIORITY = 0x20
+CAPS = CAP_FRAG16 | CAP_FEC | CAP_COMPACT | CAP_STREAMZ
+
+# asks the sender to restart its compression stream, see compression.py.
+# followed by the stream's class unless it is BULK.
+RESYNC = b'ZRESYNC'
+# asks the sender to forget its MQTT topic aliases, see mqttCodec.py
+MRESYNC = b'MRESYNC'
+
+# traffic classes. each has its own compression and MQTT streams, so
+# CONTROL messages can be sent in the middle of a BULK one.
+BULK = 0
+CONTROL = 1
+
+class Stream():
+    'one class of traffic to and from a remote'
+    def __init__(self):
+        # streaming compression, one context per direction
+        self.deflate = None
+        self.inflate = None
+        # MQTT encoding, when both ends do it
+        self.mqtt_tx = None
+        self.mqtt_rx = None
+        
+        # writes waiting to be sent to the remote, MQTT encoded as they go
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        # how many writes were taken off the front of pending so far, and 
+        # where (counting those) the waiting PUBLISH of a latest topic is
+        self.taken = 0
+        self.latest = {}
+        # how many of those were sent, and how many have to be before
+        # CONTROL may overtake (up to the last CONNECT or DISCONNECT)
+        self.sent = 0
+        self.barrier = 0
+        # compressed / uncompressed size of the last message sent
+        self.ratio = 1.0
+    
+    def stats(self):
+        r = {'pending': len(self.pending)}
+        if self.deflate != None:
+            r['tx'] = self.deflate.stats()
+        if self.inflate != None:
+            r['rx'] = self.inflate.stats()
+        if self.mqtt_tx != None:
+            r['mqtt_tx'] = self.mqtt_tx.stats()
+        if self.mqtt_rx != None:
+            r['mqtt_rx'] = self.mqtt_rx.stats()
+        return r
+
+class Session():
+    '''what a LinkedXbeeServer keeps for each remote it talks to. it is 
+       also the link the remote's upstream connection proxies back to.'''
+    def __init__(self, server, addr):
+        self.server = server
+        self.addr = addr
+        self.caps = 0
+        self.dict_id = 0
+        # indexed by traffic class
+        self.streams = (Stream(), Stream())
+        # cuts writes into packets of either class
+        self.splitter = None
+        # where data from the remote goes, None for the server's link
+        self.upstream = None
+        
+        self.last_seen = datetime.datetime.now()
+        # when the remote last acked a message, None if it never did
+        self.last_acked = None
+    
+    def reset(self):
+        '''forget the compression and MQTT state of every stream, both ways,
+           for a remote that (re)started. with the server's _pending_cv held.'''
+        for st in self.streams:
+            st.deflate = None
+            st.inflate = None
+            st.mqtt_tx = None
+            st.mqtt_rx = None
+    
+    def proxy(self, data):
+        'data from the upstream goes to the remote'
+        self.server.write(data, dest=self.addr)
+    
+    def stats(self):
+        r = {'caps': self.caps, 
+             'last_seen': self.last_seen.isoformat()}
+        r.update(self.streams[BULK].stats())
+        if self.caps & CAP_PRIORITY:
+            r['control'] = self.streams[CONTROL].stats()
+        return r
+
+class RxQueue():
+    '''a bounded queue between the xbee reader thread and serve_forever.
+       when it is full, put does what policy says:
+       
+           block           wait for room, which stalls the xbee reader
+           drop_oldest     drop the item that has waited longest
+           drop_priority   drop the item priority(item) ranks lowest, the
+                           oldest of those if there are several
+       
+       get raises queue.Empty like queue.Queue.'''
+    POLICIES = ('block', 'drop_oldest', 'drop_priority')
+    
+    def __init__(self, maxsize = 256, policy = 'drop_priority', priority = None):
+        if policy not in RxQueue.POLICIES:
+            raise ValueError("rx queue policy must be one of {}".format(RxQueue.POLICIES))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priority = priority
+        self._q = collections.deque()
+        self._cv = threading.Condition()
+        
+        self.high_water = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+    
+    def __len__(self):
+        return len(self._q)
+    
+    def put(self, item):
+        p = 0
+        if self.policy == 'drop_priority':
+            p = self.priority(item)
+        with self._cv:
+            if len(self._q) >= self.maxsize:
+                if self.policy == 'block':
+                    self.blocked += 1
+                    while len(self._q) >= self.maxsize:
+                        self._cv.wait()
+                elif self.policy == 'drop_oldest':
+                    self._q.popleft()
+                    self.dropped += 1
+                else:
+                    # deque entries are (enqueued, priority, item)
+                    victim = min(range(len(self._q)), key=lambda i: self._q[i][1])
+                    self.dropped += 1
+                    if p < self._q[victim][1]:
+                        return
+                    del self._q[victim]
+            self._q.append( (time.monotonic(), p, item) )
+            self.high_water = max(self.high_water, len(self._q))
+            self._cv.notify_all()
+    
+    def get(self, block = True, timeout = None):
+        with self._cv:
+            if block:
+                self._cv.wait_for(lambda: len(self._q) > 0, timeout)
+            if len(self._q) == 0:
+                raise queue.Empty()
+            enqueued, p, item = self._q.popleft()
+            self._cv.notify_all()
+        latency = time.monotonic() - enqueued
+        self.latency_avg = 0.875 * self.latency_avg + 0.125 * latency
+        self.latency_max = max(self.latency_max, latency)
+        return item
+    
+    def stats(self):
+        return {'length': len(self._q),
+                'maxsize': self.maxsize,
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'latency_avg': self.latency_avg,
+                'latency_max': self.latency_max}
+
 class LinkedXbeeServer():
-    'like socketserver.BaseServer but for XBee API links'
-    def __init__(self, server_address, link):
+    '''like socketserver.BaseServer but for XBee API links.
+    
+       a base station serves any number of remotes, each with its own 
+       Session. writes to them are sent in turn, one message each, 
+       CONTROL messages before BULK ones.'''
+    def __init__(self, server_address, link, fec = None, zdict = None, delay = 0, batch = None,
+                 window = None, retries = 3, upstream = None, rxq_size = 256, rxq_policy = 'drop_priority',
+                 mqtt = False, priority = True, slo = 0.5, policy = None, cache = None, xbeeclass = XBee900HP):
+        '''fec is None or (group, parity) to send parity fragments to 
+           remotes that support it, see fragmentation16.make_parity.
+           zdict is a preset compression dictionary, used with remotes 
+           that announce the same one, see zdictTrain.py.
+           delay is how many seconds writes are held back to be sent 
+           together with the ones that follow, until about batch bytes 
+           (after compression, one radio frame by default) are waiting. 
+           0 sends every write by itself.
+           window is how many fragments may wait for their tx_status at 
+           once (the xbee's limit by default), each is sent up to retries 
+           times.
+           upstream(addr, session) makes the connection data from a remote
+           goes to, data it gets goes to session.proxy. without it 
+           everything goes to link.
+           rxq_size frames received wait at most to be handled, see RxQueue
+           for what rxq_policy does when there are more.
+           mqtt encodes the MQTT packets written to remotes that do it too,
+           see mqttCodec.py.
+           priority sends the MQTT control packets written to remotes that 
+           do it too (acks, pings, see mqttCodec.CONTROL_TYPES) ahead of 
+           the rest, between the fragments of a message already going out,
+           but not ahead of a CONNECT or DISCONNECT.
+           while they take longer than slo seconds on average to be sent,
+           other messages only get one fragment in flight at a time.
+           policy is an mqttPolicy.Policy for the PUBLISHes written.
+           cache is a radioCache.py file the xbee's parameters are kept in
+           between runs, xbeeclass the python-xbee class of the radio.'''
         
         port, baudrate, bytesize, parity, stopbits, basestation = server_address            
-        self.xbee = XBeeDevice("{}:{}:{}{}{}".format(port, baudrate, bytesize, parity, stopbits),
-                               self._rx)
-            
+        self.LOG = logging.getLogger(__name__)
+        
+        # _rx uses these as soon as the xbee is open
         self._basestation = basestation          
+        # the base station, or on a base station the last remote to say hello
         self._remote_addr = None
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self.upstream = upstream
+        self._fec = fec
+        self._msgid = 0
+        self._zdict = zdict
+        self._mqtt = mqtt
+        self._caps = CAPS
+        if mqtt:
+            self._caps |= CAP_MQTT
+        self._priority = priority
+        self._policy = policy
+        if priority:
+            self._caps |= CAP_PRIORITY
+        self._pending_cv = threading.Condition()
+        self._rxq = RxQueue(rxq_size, rxq_policy, self._rx_priority)
+        # partial messages per remote, so several can reassemble at once
+        self._reassembly = frag.Reassembler()
+        self._reassembly16 = frag16.Reassembler()
+        
+        self.link = link        
+        
+        self.__is_shut_down = threading.Event()
+        self.__shutdown_request = False
+        
+        # the xbee's own limits when None, see _opened
+        self._window = window
+        self._retries = retries
+        
+        # write coalescing and scheduling
+        self._delay = delay
+        self._batch = batch
+        # remotes in the order they get to send, the next one first, per class
+        self._turns = (collections.deque(), collections.deque())
+        # CONTROL message latency, from the first write to the last tx_status
+        self._slo = slo
+        self._control_messages = 0
+        self._control_avg = 0.0
+        self._control_max = 0.0
+        self._slo_violations = 0
+        self._preemptions = 0
+        self._tx_stop = False
         
+        self._open("{}:{}:{}{}{}".format(port, baudrate, bytesize, parity, stopbits), cache, xbeeclass)
+                
+        self.LOG.debug("created.")    
+    
+    def _open(self, portstr, cache, xbeeclass):
+        'open the xbee, find the base station and start the tx thread'
+        self.xbee = XBeeDevice(portstr, self._rx, xbeeclass, cache = cache)
+            
         if self._basestation == False:
             # discover the base station
             for i in range(3):
@@ -26,36 +293,146 @@ class LinkedXbeeServer():
                 self.xbee.close()
                 raise Exception("No remote basestation could be found.")
         
-        self.link = link        
-        
-        self._rxq = queue.Queue()
-        self.__is_shut_down = threading.Event()
-        self.__shutdown_request = False
-        
-        self._last_write = datetime.datetime.now()
-                
-        self.LOG = logging.getLogger(__name__)
-        self.LOG.debug("created.")    
+        self._opened()
+        self._tx_thread = threading.Thread(name='LinkedXbeeServer-tx', target=self._schedule)
+        self._tx_thread.daemon = True
+        self._tx_thread.start()
+    
+    def _opened(self):
+        'what defaults to the xbee\'s limits, once it is open'
+        if self._window == None:
+            self._window = self.xbee._max_packets
+        if self._batch == None:
+            self._batch = self.xbee.mtu - frag16.HEADER.size
     
     def shutdown(self):
         self.__shutdown_request = True
         self.__is_shut_down.wait()    
+        # send what is left first
+        with self._pending_cv:
+            self._tx_stop = True
+            self._pending_cv.notify()
+        self._tx_thread.join()
+        for s in list(self._sessions.values()):
+            self._close_upstream(s)
         self.xbee.close()
         
     @property
     def address(self):
         return self.xbee.address
+    
+    def _session(self, addr):
+        'the Session for addr, a new one if we haven\'t heard from it'
+        with self._sessions_lock:
+            if addr not in self._sessions:
+                self._sessions[addr] = Session(self, addr)
+                self.LOG.info("new session for remote {:x}, {} remotes".format(addr, len(self._sessions)))
+            return self._sessions[addr]
+    
+    def _close_upstream(self, session):
+        u = session.upstream
+        session.upstream = None
+        if u != None:
+            # shutdown blocks until its thread notices, don't hold up the caller
+            t = threading.Thread(name='close-upstream-{:x}'.format(session.addr), target=u.shutdown)
+            t.daemon = True
+            t.start()
+    
     def _rx(self, xbee, source, data):
         # handle magic packets to discover the base station       
         
          
         if data == b'HELLOREMOTE':
             self._remote_addr = source
+            self._session(source)
+            self._post(self._hellocaps(), source)
         elif self._basestation and data == b'HELLOBASESTATION':
             self._remote_addr = source
-            self.xbee.send(b'HELLOREMOTE', source)
+            # the remote (re)started, so does its session
+            s = self._session(source)
+            with self._pending_cv:
+                s.caps = 0
+                s.dict_id = 0
+                s.reset()
+                s.splitter = None
+            self._close_upstream(s)
+            self._post(b'HELLOREMOTE', source)
+        elif data[:9] == b'HELLOCAPS' and len(data) > 9:
+            s = self._session(source)
+            dict_id = 0
+            if len(data) >= 10 + compression.DICT_ID.size:
+                dict_id = compression.DICT_ID.unpack_from(data, 10)[0]
+            if dict_id != compression.dict_id(self._zdict):
+                self.LOG.warn("remote {:x} has compression dictionary {:08x}, not ours ({:08x})".format(
+                    source, dict_id, compression.dict_id(self._zdict)))
+            # the remote may have restarted, start new streams
+            with self._pending_cv:
+                s.caps = data[9]
+                s.dict_id = dict_id
+                s.reset()
+            if self._basestation:
+                self._post(self._hellocaps(), source)
+        elif data[:len(RESYNC)] == RESYNC:
+            st = self._stream(source, data[len(RESYNC):])
+            with self._pending_cv:
+                if st != None and st.deflate != None:
+                    st.deflate.reset()
+        elif data[:len(MRESYNC)] == MRESYNC:
+            st = self._stream(source, data[len(MRESYNC):])
+            with self._pending_cv:
+                if st != None and st.mqtt_tx != None:
+                    st.mqtt_tx.reset()
         else:
-            self._rxq.put( (xbee, source, data) )
+            self._received(xbee, source, data)
+    
+    def _received(self, xbee, source, data):
+        'a frame from a remote that isn\'t a HELLO, for serve_forever'
+        self._rxq.put( (xbee, source, data) )
+    
+    def _post(self, data, dest):
+        '''send data to dest without waiting for anything, from the xbee's
+           rx thread or serve_forever. nothing waits for its tx_status, so
+           it isn't asked for (the radio still retries it).'''
+        self.xbee.send(data, dest, ack=False)
+    
+    def _stream(self, source, cls):
+        'the Stream of source a RESYNC or MRESYNC followed by cls is for'
+        if len(cls) == 0:
+            return self._session(source).streams[BULK]
+        if cls[0] < len(self._session(source).streams):
+            return self._session(source).streams[cls[0]]
+        return None
+    
+    def _resync(self, tag, cls):
+        'tag (RESYNC or MRESYNC) for the traffic class cls'
+        if cls == BULK:
+            return tag
+        return tag + bytes([cls])
+    
+    def _rx_priority(self, item):
+        '''how much a received frame is worth keeping: parity least (FEC can
+           do without it), then fragments of long messages, and frames 
+           that are a whole message (acks, pings) most'''
+        xbee, source, data = item
+        try:
+            if data[0] in frag16.Reassembler.magics:
+                last, num = self._reassembly16.position(data)
+            else:
+                last, num = self._reassembly.position(data)
+        except Exception:
+            return 0
+        if num > last:
+            return 0
+        if last > 0:
+            return 1
+        return 2
+    
+    def rxq_stats(self):
+        return self._rxq.stats()
+    
+    def _hellocaps(self):
+        'HELLOCAPS, our capabilities and the id of our compression dictionary'
+        return b'HELLOCAPS' + bytes([self._caps]) + compression.DICT_ID.pack(compression.dict_id(self._zdict))
     def serve_forever(self, poll_interval=0.5):
         """Handle one request at a time until shutdown.
 
@@ -83,47 +460,437 @@ class LinkedXbeeServer():
         self.LOG.debug("rx [{}] bytes from {:x}: {}".format(len(data),
                                                             source,                                                    
                                                             data))
+        session = self._session(source)
+        session.last_seen = datetime.datetime.now()
+        reassembly = self._reassembly
+        if data[0] in frag16.Reassembler.magics:
+            reassembly = self._reassembly16
+        stream = session.streams[BULK]
+        cls = BULK
+        inflate = None
         try:
-            r = frag.receive_frag(data)        
-            if r != None:            
-                self.link.proxy(zlib.decompress(r))
+            r = reassembly.receive_frag(data, source)
+            if r != None:
+                if compression.is_stream(r):
+                    cls = compression.channel(r)
+                    stream = session.streams[cls]
+                    # a HELLO may reset the stream from the xbee's thread
+                    with self._pending_cv:
+                        if stream.inflate == None:
+                            stream.inflate = compression.Decompressor(self._zdict)
+                        inflate = stream.inflate
+                    # coalesced writes are passed on one at a time
+                    for m in inflate.decompress_batch(r):
+                        self._upstream_write(session, stream, m)
+                else:
+                    self._upstream_write(session, stream, zlib.decompress(r))
         except frag.CrcError:
-            self.LOG.warn ("  couldn't decode packet, CRC error")
-    def write(self, data):
-        ilen = len(data)
-        data = zlib.compress(data)
-        ratio = len(data)/float(ilen)
+            self.LOG.warn ("  couldn't decode packet from {:x}, CRC error: {}".format(source,
+                                                                               reassembly.stats()))
+            # we can't tell which stream it was, the next message of either would refer to it
+            for cls, stream in enumerate(session.streams):
+                inflate = stream.inflate
+                if inflate != None:
+                    inflate.lost()
+                    self._post(self._resync(RESYNC, cls), source)
+        except compression.DictionaryError as x:
+            # resyncing won't help, the remote has to be configured like us
+            self.LOG.error("  dropped packet from {:x}: {}".format(source, x))
+        except compression.ResyncError as x:
+            self.LOG.warn ("  dropped packet from {:x}, lost compression stream ({}): {}".format(source, x,
+                                                                               inflate.stats()))
+            self._post(self._resync(RESYNC, cls), source)
+        except mqttCodec.CodecError as x:
+            self.LOG.warn ("  dropped packet from {:x}, lost MQTT topic aliases: {}".format(source, x))
+            self._post(self._resync(MRESYNC, cls), source)
+    
+    def _upstream_write(self, session, stream, data):
+        'pass data from a remote on, to its own upstream if there is one'
+        if self._mqtt and session.caps & CAP_MQTT and mqttCodec.is_encoded(data):
+            with self._pending_cv:
+                if stream.mqtt_rx == None:
+                    stream.mqtt_rx = mqttCodec.Decoder()
+                decoder = stream.mqtt_rx
+            data = decoder.decode(data)
+        if self.upstream == None:
+            self.link.proxy(data)
+            return
+        if session.upstream == None:
+            session.upstream = self.upstream(session.addr, session)
+        session.upstream.write(data)
+    
+    def compression_stats(self):
+        'compression counters per remote address for each direction'
+        sessions = list(self._sessions.values())
+        r = {}
+        with self._pending_cv:
+            for name, cls in (('', BULK), ('control_', CONTROL)):
+                r[name + 'tx'] = {s.addr: s.streams[cls].deflate.stats() 
+                                  for s in sessions if s.streams[cls].deflate != None}
+                r[name + 'rx'] = {s.addr: s.streams[cls].inflate.stats() 
+                                  for s in sessions if s.streams[cls].inflate != None}
+        return r
+    
+    def stats(self):
+        'per remote session state and counters'
+        return {s.addr: s.stats() for s in list(self._sessions.values())}
+    
+    def healthy(self, seconds, dest = None):
+        '''True if the remote at dest (the base station or the last remote to
+           say hello by default) was heard from or acked a message in the 
+           last seconds'''
+        if dest == None:
+            dest = self._remote_addr
+        if dest == None or dest not in self._sessions:
+            return False
+        s = self._sessions[dest]
+        since = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        return s.last_seen > since or (s.last_acked != None and s.last_acked > since)
+    
+    def tx_stats(self):
+        'CONTROL message latency and how often it preempted other messages'
+        return {'control_messages': self._control_messages,
+                'latency_avg': self._control_avg,
+                'latency_max': self._control_max,
+                'slo': self._slo,
+                'slo_violations': self._slo_violations,
+                'preemptions': self._preemptions,
+                'policy': self._policy.stats() if self._policy != None else None}
+    
+    def _make_frags(self, session, data):
+        'fragment data in the best format the remote understands'
+        if session.caps & CAP_COMPACT:
+            fec = None
+            if session.caps & CAP_FEC:
+                fec = self._fec
+            self._msgid = (self._msgid + 1) & 0xff
+            return frag16.iter_frags_compact(data, 
+                                             frag16.compact_threshold(self.xbee.mtu, len(data), fec), 
+                                             self._msgid, fec)
+        elif session.caps & CAP_FEC and self._fec != None:
+            # parity payloads carry the xor of the fragment lengths too
+            return frag16.iter_frags(data, 
+                                     self.xbee.mtu - frag16.FEC_HEADER.size - frag16.PARITY_LEN.size, 
+                                     self._fec)
+        elif session.caps & CAP_FRAG16:
+            return frag16.iter_frags(data, self.xbee.mtu - frag16.HEADER.size)
+        return frag.make_frags(data)
+
+    def _compress(self, session, cls, messages):
+        '''compress messages for the remote, as one message of its stream if
+           it has one. the stream keeps them apart, zlib gets them joined.
+           the stream is used with _pending_cv held, a HELLO may reset it.'''
+        stream = session.streams[cls]
+        with self._pending_cv:
+            if session.caps & CAP_STREAMZ:
+                if stream.deflate == None:
+                    zdict = None
+                    if session.dict_id == compression.dict_id(self._zdict):
+                        zdict = self._zdict
+                    stream.deflate = compression.Compressor(zdict=zdict, channel=cls)
+                return stream.deflate.compress_batch(messages)
+        return zlib.compress(b''.join(messages))
+    
+    def _prioritized(self, session):
+        'True if writes to session are split into CONTROL and BULK'
+        # without its own compression stream CONTROL can't overtake BULK
+        return self._priority and session.caps & CAP_PRIORITY and session.caps & CAP_STREAMZ
+    
+    def write(self, data, dest = None):
+        '''queue data for the remote at dest, the base station or the last
+           remote to say hello by default'''
         tries = 0
-                
-        # throttle tx so we don't break the link, wait about how long it takes to tx one packet
-        now = datetime.datetime.now()            
-        if now - self._last_write < self.xbee._last_sendwait_length:
-            time.sleep((self.xbee._last_sendwait_length - (now - self._last_write)).total_seconds())
-        self._last_write = now
-                
         while self._basestation == False and self._remote_addr == None and tries < 5:
             self.xbee.sendwait(b"HELLOBASESTATION", dest=0xffff)
-                    
-        if self._remote_addr == None:
-            self.LOG.warn("tx FAILED, NO REMOTE [{}, cr={}] bytes to {:x}: {}".format(len(data),ratio,
-                                                            self._remote_addr,                                                    
-                                                            data))
-        else:            
-            self.LOG.debug("tx [{}, cr={}] bytes to {:x}: {}".format(len(data),ratio,
-                                                                self._remote_addr,                                                    
-                                                                data))                                            
+            tries += 1
+        self._put(data, dest)
+    
+    def _put(self, data, dest):
+        'queue data for dest, once the base station is known'
+        if dest == None:
+            dest = self._remote_addr
+        if dest == None:
+            self.LOG.warn("tx FAILED, NO REMOTE [{}] bytes: {}".format(len(data), data))
+            return
+        
+        session = self._session(dest)
+        replies = []
+        with self._pending_cv:
+            prioritized = self._prioritized(session)
+            if not prioritized and self._policy == None:
+                self._queue(session, BULK, data)
+                return
+            if session.splitter == None:
+                session.splitter = mqttCodec.Splitter()
+            bulk = session.streams[BULK]
+            # nothing overtakes a CONNECT or DISCONNECT still to be sent
+            held = bulk.sent < bulk.barrier
+            # runs of packets of the same class stay together, latest PUBLISHes alone
+            runs = []
+            for whole, chunk in session.splitter.split(data):
+                cls = BULK
+                topic = None
+                if whole and self._policy != None:
+                    if self._policy.drop(chunk):
+                        self._policy.dropped += 1
+                        r = self._policy.reply(chunk)
+                        if r != None:
+                            replies.append(r)
+                        continue
+                    topic = self._policy.latest(chunk)
+                barrier = whole and prioritized and mqttCodec.is_barrier(chunk)
+                if whole and prioritized and mqttCodec.is_control(chunk) and not held:
+                    cls = CONTROL
+                held = held or barrier
+                if topic == None and len(runs) > 0 and runs[-1][0] == cls and runs[-1][2] == None:
+                    runs[-1][1].append(chunk)
+                    runs[-1][3] = runs[-1][3] or barrier
+                else:
+                    runs.append( [cls, [chunk], topic, barrier] )
+            for cls, chunks, topic, barrier in runs:
+                self._queue(session, cls, b''.join(chunks), topic)
+                if barrier:
+                    bulk.barrier = bulk.taken + len(bulk.pending)
+        # acks for what was dropped go back where it came from
+        for r in replies:
+            self._upstream_write(session, session.streams[BULK], r)
+    
+    def _queue(self, session, cls, data, topic = None):
+        '''queue data to session as cls traffic, with _pending_cv held. data
+           replaces the waiting PUBLISH to topic if there is one.'''
+        stream = session.streams[cls]
+        if topic != None:
+            at = stream.latest.get(topic)
+            if at != None and at >= stream.taken:
+                at -= stream.taken
+                stream.pending_bytes += len(data) - len(stream.pending[at])
+                stream.pending[at] = data
+                self._policy.replaced += 1
+                return
+            stream.latest[topic] = stream.taken + len(stream.pending)
+        if len(stream.pending) == 0:
+            stream.pending_since = time.monotonic()
+            self._turns[cls].append(session)
+        stream.pending.append(data)
+        stream.pending_bytes += len(data)
+        self._notify()
+    
+    def _notify(self):
+        'wake the tx thread, with _pending_cv held'
+        self._pending_cv.notify()
+    
+    def _ready(self, session, cls, now):
+        'True once the writes of class cls waiting for session should go'
+        stream = session.streams[cls]
+        return (cls == CONTROL or self._tx_stop or now - stream.pending_since >= self._delay or
+                stream.pending_bytes * stream.ratio >= self._batch)
+    
+    def _next(self):
+        '''the session and class to send for next, (None, None) if nothing 
+           is ready. with _pending_cv held.'''
+        now = time.monotonic()
+        for cls in (CONTROL, BULK):
+            for s in self._turns[cls]:
+                if self._ready(s, cls, now):
+                    return s, cls
+        return None, None
+    
+    def _take(self, session, cls):
+        '''the writes of class cls for session's next message, when the 
+           oldest was queued and their size before encoding. with 
+           _pending_cv held.'''
+        stream = session.streams[cls]
+        # at least one write, the rest as long as they fit
+        n = 1
+        size = len(stream.pending[0])
+        while (n < len(stream.pending) and 
+               (size + len(stream.pending[n])) * stream.ratio <= self._batch):
+            size += len(stream.pending[n])
+            n += 1
+        messages = stream.pending[:n]
+        del stream.pending[:n]
+        stream.pending_bytes -= size
+        stream.taken += n
+        # the oldest write the message has, or one before it
+        since = stream.pending_since
+        
+        # to the back of the line, if it still has more to send
+        self._turns[cls].remove(session)
+        if len(stream.pending) > 0:
+            self._turns[cls].append(session)
+        
+        # encoded in the order they are sent, the Encoder remembers what it sent
+        if self._mqtt and session.caps & CAP_MQTT:
+            if stream.mqtt_tx == None:
+                stream.mqtt_tx = mqttCodec.Encoder()
+            messages = [stream.mqtt_tx.encode(m) for m in messages]
+            # b'' while the rest of a packet is still to come
+            messages = [m for m in messages if len(m) > 0]
+        return messages, since, size
+    
+    def _turn(self):
+        '''with _pending_cv held, (turn, None) for the next message to send,
+           turn being (session, cls, messages, since, size, taken) see 
+           _take, or (None, seconds) until one is ready, seconds None if 
+           nothing is waiting'''
+        if len(self._turns[CONTROL]) == 0 and len(self._turns[BULK]) == 0:
+            return None, None
+        session, cls = self._next()
+        if session == None:
+            # only BULK is waiting, CONTROL is always ready
+            first = min(s.streams[BULK].pending_since for s in self._turns[BULK])
+            return None, max(0, first + self._delay - time.monotonic())
+        messages, since, size = self._take(session, cls)
+        return (session, cls, messages, since, size, session.streams[cls].taken), None
+    
+    def _control_turn(self):
+        'the turn of the next CONTROL message, None if none is waiting'
+        with self._pending_cv:
+            if len(self._turns[CONTROL]) == 0:
+                return None
+            session = self._turns[CONTROL][0]
+            messages, since, size = self._take(session, CONTROL)
+            return session, CONTROL, messages, since, size, session.streams[CONTROL].taken
+    
+    def _turn_sent(self, turn):
+        'account for the message of turn, once it was sent'
+        session, cls, messages, since, size, taken = turn
+        with self._pending_cv:
+            session.streams[cls].sent = taken
+    
+    def _schedule(self):
+        '''the tx thread. remotes with writes waiting take turns sending one 
+           message each, made of the writes that came within delay or fit 
+           in one batch. CONTROL messages go first.'''
+        while True:
+            with self._pending_cv:
+                turn, timeout = self._turn()
+                while turn == None:
+                    if timeout == None and self._tx_stop:
+                        return
+                    self._pending_cv.wait(timeout)
+                    turn, timeout = self._turn()
+            self._write(*turn[:5])
+            self._turn_sent(turn)
+    
+    def _send_control(self):
+        'send the CONTROL messages waiting, from the middle of a BULK one'
+        turn = self._control_turn()
+        while turn != None:
+            self._write(*turn[:5])
+            turn = self._control_turn()
+    
+    def _write(self, session, cls, messages, since, size):
+        '''send messages to session as one message of class cls, queued 
+           since then and size bytes before encoding'''
+        if len(messages) == 0:
+            return
+        try:
+            data = self._encode(session, cls, messages, size)
+            ok = self._send_frags(list(self._make_frags(session, data)), session.addr, cls == BULK)
+            self._sent(session, cls, data, since, ok)
+        except Exception as x:
+            self.LOG.error("tx of {} writes to {:x} failed: {}".format(len(messages), session.addr, x))
+    
+    def _encode(self, session, cls, messages, size):
+        'messages compressed into the one message to send, size bytes before'
+        data = self._compress(session, cls, messages)
+        ratio = len(data)/float(size)
+        session.streams[cls].ratio = ratio
+        
+        # the xbee's pacer keeps tx from breaking the link
+        self.LOG.debug("tx [{}, cr={}, writes={}, class={}] bytes to {:x}: {}".format(len(data),ratio,
+                                                            len(messages), cls,
+                                                            session.addr,                                                    
+                                                            data))                                            
+        return data
+    
+    def _sent(self, session, cls, data, since, ok):
+        'account for data sent to session, queued since then, ok if it all was acked'
+        if cls == CONTROL:
+            self._control_sent(time.monotonic() - since)
+        if ok:
+            session.last_acked = datetime.datetime.now()
+        else:
+            self.LOG.warn("tx FAILED [{}] bytes to {:x}".format(len(data), session.addr))
+            with self._pending_cv:
+                stream = session.streams[cls]
+                if stream.deflate != None:
+                    # the remote won't be able to decode what follows
+                    stream.deflate.reset()
+    
+    def _control_sent(self, latency):
+        'account for a CONTROL message that took latency seconds'
+        self._control_messages += 1
+        self._control_avg = 0.875 * self._control_avg + 0.125 * latency
+        self._control_max = max(self._control_max, latency)
+        if latency > self._slo:
+            self._slo_violations += 1
+            self.LOG.warn("control message took {:.3f}s, over the {:.3f}s SLO".format(latency, self._slo))
+    
+    # what _frag_steps asks its driver to do
+    SEND_CONTROL = 0
+    SEND = 1
+    WAIT = 2
+    
+    def _frag_steps(self, n, preemptible):
+        '''the policy of _send_frags for n fragments, driven by it. yields
+           (SEND_CONTROL, None) to send the CONTROL messages waiting, 
+           (SEND, i) to send fragment i and take back what xbee.send 
+           returned and (WAIT, f) to take back xbee.wait(f) or the 
+           TimeoutError it raised. returns what _send_frags does.'''
+        tries = [0] * n
+        todo = collections.deque(range(n))
+        outstanding = collections.deque()
+        while len(todo) > 0 or len(outstanding) > 0:
+            window = self._window
+            if preemptible and self._control_avg > self._slo:
+                # fewer of ours queued in the xbee ahead of CONTROL
+                window = 1
+            while len(todo) > 0 and len(outstanding) < window:
+                if preemptible and len(self._turns[CONTROL]) > 0:
+                    self._preemptions += 1
+                    yield LinkedXbeeServer.SEND_CONTROL, None
+                i = todo.popleft()
+                tries[i] += 1
+                outstanding.append( (i, (yield LinkedXbeeServer.SEND, i)) )
             
-            for f in frag.make_frags(data):                
-                tries = 0
-                success= False
-                while tries < 3 and success == False:
-                    try:                            
-                        p = self.xbee.sendwait(f, dest=self._remote_addr)
-                        success = 'status' in p and p['status'] == b'\x00'
+            # the rest stay in flight while we wait for the oldest
+            i, e = outstanding.popleft()
+            p = yield LinkedXbeeServer.WAIT, e
+            if isinstance(p, TimeoutError):
+                self.LOG.warn("timeout sending fragment {}, try {} ({})".format(i, tries[i], p))
+            elif 'status' in p and p['status'] == b'\x00':
+                continue
+            else:
+                self.LOG.warn("fragment {} failed with status {}, try {}".format(i, p.get('status'), tries[i]))
+            if tries[i] >= self._retries:
+                # don't leave the others unaccounted for in the xbee
+                for i, e in outstanding:
+                    yield LinkedXbeeServer.WAIT, e
+                return False
+            todo.appendleft(i)
+        return True
+    
+    def _send_frags(self, frags, dest, preemptible = False):
+        '''send frags keeping up to window of them waiting for tx_status,
+           resending only the ones that fail. returns False if one failed 
+           retries times. if preemptible, waiting CONTROL messages are sent
+           before each fragment.'''
+        steps = self._frag_steps(len(frags), preemptible)
+        r = None
+        try:
+            while True:
+                step, arg = steps.send(r)
+                r = None
+                if step == LinkedXbeeServer.SEND_CONTROL:
+                    self._send_control()
+                elif step == LinkedXbeeServer.SEND:
+                    r = self.xbee.send(frags[arg], dest=dest)
+                else:
+                    try:
+                        r = self.xbee.wait(arg)
                     except TimeoutError as x:
-                        self.LOG.warn("timeout sending message, retry ({})".format(x))
-                    tries += 1
-                if success == False:
-                    break
-                    
-                        
\ No newline at end of file
+                        r = x
+        except StopIteration as x:
+            return x.value
@@ -0,0 +1,123 @@
+'''
+build a preset compression dictionary (zdict) from recorded MQTT traffic.
+
+reads sProxy debug logs (the "got/rx/tx [n] bytes ...: b'...'" lines of
+the tcp links) or raw captures of an MQTT byte stream, splits them into
+MQTT packets and keeps the pieces that repeat most: PUBLISH topics with
+their length prefix, the text between the numbers of payloads, and small
+control packets. the most valuable pieces go last in the dictionary,
+where deflate reaches them with the shortest distances.
+
+    python3 zdictTrain.py -o mqtt.zdict sproxy.log capture.bin
+
+then start both ends of the xbee link with zdict=mqtt.zdict, see sProxy.Link.
+'''
+import argparse
+import ast
+import collections
+import logging
+import re
+import struct
+
+import compression
+from mqttCodec import split_packets, PUBLISH
+
+MIN_SEGMENT = 3
+
+LOG_LINE = re.compile(r"(?:got|rx|tx) \[\d+\] bytes (?:from|to) .*?: (b(['\"]).*\2)\s*$")
+NUMBERS = re.compile(rb'[0-9]+')
+
+def read_capture(filename):
+    '''the chunks of MQTT stream in filename, one per logged read or write
+       for sProxy logs, the whole file otherwise'''
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    chunks = []
+    for line in raw.decode('utf-8', 'replace').splitlines():
+        m = LOG_LINE.search(line)
+        if m != None:
+            try:
+                chunks.append(ast.literal_eval(m.group(1)))
+            except (ValueError, SyntaxError):
+                pass
+    if len(chunks) == 0:
+        chunks.append(raw)
+    return chunks
+
+def segments(packet):
+    'the parts of packet that are likely to repeat'
+    at = 1
+    while packet[at] & 0x80:
+        at += 1
+    at += 1
+    if packet[0] >> 4 == PUBLISH:
+        n = struct.unpack_from(">H", packet, at)[0]
+        yield packet[at:at+2+n]
+        at += 2 + n
+        if packet[0] & 0x06:
+            # packet id
+            at += 2
+        for s in NUMBERS.split(packet[at:]):
+            if len(s) >= MIN_SEGMENT:
+                yield s
+    elif len(packet) - at >= MIN_SEGMENT:
+        yield packet[at:]
+
+def train(packets, size):
+    'a dictionary of at most size bytes for packets'
+    count = collections.Counter()
+    for p in packets:
+        for s in segments(p):
+            count[bytes(s)] += 1
+
+    chosen = []
+    total = 0
+    for s, n in sorted(count.items(), key=lambda i: i[1]*len(i[0]), reverse=True):
+        if n < 2 or total + len(s) > size:
+            continue
+        if any(s in c for c in chosen):
+            continue
+        chosen.append(s)
+        total += len(s)
+    # best last
+    return b''.join(reversed(chosen))
+
+def evaluate(packets, zdict):
+    '''bytes on air of each packet as the first message of a new stream,
+       without and with zdict'''
+    without = sum(len(compression.Compressor().compress(p)) for p in packets)
+    used = sum(len(compression.Compressor(zdict=zdict).compress(p)) for p in packets)
+    return without, used
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("capture", help="sProxy debug logs or raw MQTT captures", nargs='+')
+    p.add_argument("-o", "--output", help="dictionary file to write", default="mqtt.zdict")
+    p.add_argument("-s", "--size", help="largest dictionary in bytes", type=int, default=4096)
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    LOG = logging.getLogger(__name__)
+
+    packets = []
+    for filename in args.capture:
+        n = len(packets)
+        for chunk in read_capture(filename):
+            packets.extend(split_packets(chunk))
+        LOG.info("{}: {} MQTT packets".format(filename, len(packets) - n))
+    if len(packets) == 0:
+        raise SystemExit("no MQTT packets found")
+
+    zdict = train(packets, args.size)
+    with open(args.output, 'wb') as f:
+        f.write(zdict)
+    LOG.info("wrote {} byte dictionary {:08x} to {}".format(len(zdict), compression.dict_id(zdict),
+                                                             args.output))
+
+    # this is measured on the training data, so it's optimistic
+    for name, subset in [('all', packets), ('PUBLISH', [p for p in packets if p[0] >> 4 == PUBLISH])]:
+        if len(subset) == 0:
+            continue
+        without, used = evaluate(subset, zdict)
+        LOG.info("{:8s} {:6d} packets {:8d} bytes, compressed {:8d} without and {:8d} with the dictionary ({:.0f}%)".format(
+            name, len(subset), sum(len(p) for p in subset), without, used, 100.0*used/without))